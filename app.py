@@ -3,24 +3,40 @@ import os as _os
 from dotenv import load_dotenv as _load_dotenv
 _load_dotenv(_os.path.join(_os.path.dirname(__file__), '.env'))
 
-from flask import Flask, request, jsonify, render_template, redirect, url_for, flash, session, Blueprint, send_file, abort
+from flask import Flask, request, jsonify, render_template, redirect, url_for, flash, session, Blueprint, send_file, abort, g
+from flask import Response, stream_with_context
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import or_, text as sa_text
-from datetime import datetime, timedelta, timezone
+from sqlalchemy import or_, event, text as sa_text
+from sqlalchemy.orm import joinedload
+from datetime import date, datetime, timedelta, timezone
 from flask_migrate import Migrate
 import os
 import json
 import hmac
+import hashlib
 import secrets
 import requests
 from uuid import uuid4
 from werkzeug.utils import secure_filename
 from werkzeug.security import generate_password_hash, check_password_hash
 from models.bosta import BostaService
+from models.fawaterak import FawaterakService
+from models.http_client import transport_stats
+from models.spreadsheet import csv_chunks, xlsx_chunks, CSV_MIMETYPE, XLSX_MIMETYPE
 import pandas as pd
 from io import BytesIO
 import shutil
 import subprocess
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import time
+import atexit
+import click
+import random
+from types import SimpleNamespace
+from itertools import groupby
+from markupsafe import Markup
+from itsdangerous import URLSafeSerializer, BadSignature
 from bs4 import BeautifulSoup
 from urllib.parse import urljoin, urlparse
 import re
@@ -165,8 +181,9 @@ UPLOAD_FOLDER = 'static/uploads'
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 db = SQLAlchemy(app)
-migrate = Migrate(app, db)
+migrate = Migrate(app, db, render_as_batch=True)
 bosta_service = BostaService()
+fawaterak_service = FawaterakService(app.config['FAWATERAK_API_KEY'], app.config['FAWATERAK_API_URL'])
 
 # Add apply_discount filter
 @app.template_filter('apply_discount')
@@ -175,131 +192,6 @@ def apply_discount(price, discount):
         return price
     return price * (1 - discount/100)
 
-# Check for shipping discount eligibility
-def check_shipping_discount(cart_items):
-    """
-    Check if the cart is eligible for free shipping based on specific product combination:
-    - Only applies when products with IDs 1, 2, and 3 are all in the cart
-    
-    Returns a dictionary with discount info
-    """
-    # Initialize product presence flags
-    has_product_1 = False
-    has_product_2 = False
-    has_product_3 = False
-    
-    # Check each cart item
-    for item in cart_items:
-        product_id = item.product_id if hasattr(item, 'product_id') else item.product.id 
-        
-        if product_id == 1:
-            has_product_1 = True
-        elif product_id == 2:
-            has_product_2 = True
-        elif product_id == 3:
-            has_product_3 = True
-    
-    # Determine discount eligibility - only applies when all three products are present
-    discount_eligible = has_product_1 and has_product_2 and has_product_3
-    
-    return {
-        "eligible": discount_eligible,
-        "discount_type": "combo_1_2_3" if discount_eligible else None
-    }
-
-# Check for promotional discount (10% off all orders for 5 days)
-def check_promotional_discount():
-    """
-    عرض خصم 10% على جميع الطلبات لمدة 5 أيام
-    Check for 10% promotional discount on all orders (valid for 5 days)
-    Returns dictionary with discount info
-    """
-
-    # Define promotional period (5 days from January 4, 2026)
-    promo_start_date = datetime(2026, 1, 4)  # تاريخ بداية العرض
-    promo_end_date = datetime(2026, 1, 9, 23, 59, 59)  # 5 أيام
-    current_date = datetime.now()
-
-    # Check if promotion is still active
-    if current_date < promo_start_date or current_date > promo_end_date:
-        return {
-            "eligible": False,
-            "discount_percent": 0,
-            "message": None,
-            "promo_active": False
-        }
-
-    return {
-        "eligible": True,
-        "discount_percent": 10,  # 10% خصم
-        "message": "خصم 10% على جميع الطلبات! 🎉",
-        "promo_active": True
-    }
-
-# Check for Eid Al-Adha shipping offer
-def check_eid_shipping_offer(cart_items, city_id):
-    """
-    Check for Eid Al-Adha special shipping offer (6 days duration):
-    - Free shipping for package #4 to Alexandria, Cairo, Giza, and Beheira
-    - 50% off shipping for package #4 to other governorates
-    Returns dictionary with offer details
-    """
-    
-    # Define offer period (6 days) - Eid Al-Adha 2025
-    offer_start_date = datetime(2025, 6, 5)  # يبدأ اليوم
-    offer_end_date = datetime(2025, 6, 11, 23, 59, 59)  # 6 days
-    current_date = datetime.now()
-    
-    # Check if offer is still active
-    if current_date < offer_start_date or current_date > offer_end_date:
-        return {"eligible": False, "discount": 0, "message": None, "offer_active": False}
-
-    # Check if cart contains package #4 (العناية الكاملة)
-    has_package_4 = False
-    for item in cart_items:
-        product_id = item.product_id if hasattr(item, 'product_id') else item.product.id 
-        if product_id == 4:
-            has_package_4 = True
-            break
-    
-    if not has_package_4:
-        return {"eligible": False, "discount": 0, "message": None, "offer_active": True}
-
-    # Define cities with free shipping (you'll need to check your actual city_id values)
-    free_shipping_cities = [
-        "الاسكندريه",  # الإسكندرية
-        "القاهره",       # القاهرة  
-        "الجيزه",        # الجيزة
-        "البحيره"      # البحيرة
-    ]
-    
-    # Get city name from database
-    try:
-        city = City.query.filter_by(city_id=city_id).first()
-        city_name = city.name if city else ""
-    except Exception:
-        city_name = ""
-    
-    # Check if city qualifies for free shipping
-    city_qualifies_for_free = any(free_city.lower() in city_name.lower() for free_city in free_shipping_cities)
-    
-    if city_qualifies_for_free:
-        return {
-            "eligible": True,
-            "discount": 1.0,  # 100% discount (free shipping)
-            "message": "🎉 شحن مجاني - عرض عيد الأضحى على باقة العناية الكاملة",
-            "offer_active": True,
-            "offer_type": "eid_free_shipping"
-        }
-    else:
-        return {
-            "eligible": True,
-            "discount": 0.5,  # 50% discount
-            "message": "🎉 خصم 50% على الشحن - عرض عيد الأضحى على باقة العناية الكاملة", 
-            "offer_active": True,
-            "offer_type": "eid_50_percent"
-        }
-
 # products and  Category and Card and Order and OrderItem and adintiol images and adintiol data to prodect amd promo code
 class Admins(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -310,7 +202,7 @@ class Admins(db.Model):
     created_at = db.Column(db.DateTime, nullable=False, default=utc_now)
 class Gusts(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    session = db.Column(db.String(100), nullable=False)
+    session = db.Column(db.String(100), nullable=False, index=True)
     name = db.Column(db.String(100), nullable=True)
     phone = db.Column(db.String(100), nullable=True) 
     address = db.Column(db.String(100), nullable=True)
@@ -330,15 +222,19 @@ class Product(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(100), nullable=False)
     price = db.Column(db.Float, nullable=False)
-    discount = db.Column(db.Float, nullable=False)
+    discount = db.Column(db.Float, nullable=False, index=True)
     stock = db.Column(db.Integer, nullable=False)
     description = db.Column(db.Text, nullable=False)
     image = db.Column(db.String(100), nullable=False)
-    views = db.Column(db.Integer, nullable=False, default=0)
+    views = db.Column(db.Integer, nullable=False, default=0, index=True)
     category_id = db.Column(db.Integer, db.ForeignKey('category.id'), nullable=False)
     additional_images = db.relationship('AdditionalImage', backref='product', lazy=True, cascade='all, delete-orphan')
     additional_data = db.relationship('AdditionalData', backref='product', lazy=True, cascade='all, delete-orphan')
-    created_at = db.Column(db.DateTime, nullable=False, default=utc_now)
+    created_at = db.Column(db.DateTime, nullable=False, default=utc_now, index=True)
+    __table_args__ = (
+        # Category listing: WHERE category_id = ? ORDER BY created_at DESC
+        db.Index('ix_product_category_id_created_at', 'category_id', 'created_at'),
+    )
 class AdditionalImage(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     image = db.Column(db.String(100), nullable=False)
@@ -353,16 +249,20 @@ class AdditionalData(db.Model):
 class Cart(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('gusts.id'), nullable=False)
-    product_id = db.Column(db.Integer, db.ForeignKey('product.id', ondelete='CASCADE'), nullable=False)
+    product_id = db.Column(db.Integer, db.ForeignKey('product.id', ondelete='CASCADE'), nullable=False, index=True)
     quantity = db.Column(db.Integer, nullable=False)
-    created_at = db.Column(db.DateTime, nullable=False, default=utc_now)
+    created_at = db.Column(db.DateTime, nullable=False, default=utc_now, index=True)
+    __table_args__ = (
+        # Also serves plain user_id lookups (cart page, badge count)
+        db.Index('ix_cart_user_id_product_id', 'user_id', 'product_id'),
+    )
     
     # إضافة العلاقة مع Product
     product = db.relationship('Product', backref='carts', lazy=True)
 
 class Order(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    user_id = db.Column(db.Integer, db.ForeignKey('gusts.id'), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('gusts.id'), nullable=False, index=True)
     name = db.Column(db.String(100), nullable=False)
     email = db.Column(db.String(100), nullable=False)
     phone = db.Column(db.String(100), nullable=False)
@@ -378,21 +278,31 @@ class Order(db.Model):
     payment_method = db.Column(db.String(50), nullable=False)
     package_size = db.Column(db.String(20), default='SMALL')
     package_type = db.Column(db.String(20), default='Parcel')
-    invoice_key = db.Column(db.String(100), nullable=True)
+    invoice_key = db.Column(db.String(100), nullable=True, index=True)
     invoice_id = db.Column(db.String(50), nullable=True)
     invoice_url = db.Column(db.String(200), nullable=True)
     payment_status = db.Column(db.String(20), default='pending', nullable=True)
-    created_at = db.Column(db.DateTime, nullable=False, default=utc_now)  
+    # Fawaterak invoice creation: NULL until requested, then creating, ready or failed
+    invoice_status = db.Column(db.String(20), nullable=True)
+    invoice_requested_at = db.Column(db.DateTime, nullable=True)
+    invoice_error = db.Column(db.String(255), nullable=True)
+    created_at = db.Column(db.DateTime, nullable=False, default=utc_now, index=True)
+    __table_args__ = (
+        # Dashboard/status counts and status filters bounded by date
+        db.Index('ix_order_shipping_status_created_at', 'shipping_status', 'created_at'),
+    )
 class OrderItem(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    order_id = db.Column(db.Integer, nullable=False)
-    product_id = db.Column(db.Integer, db.ForeignKey('product.id', ondelete='SET NULL'), nullable=True)
+    order_id = db.Column(db.Integer, db.ForeignKey('order.id'), nullable=False, index=True)
+    product_id = db.Column(db.Integer, db.ForeignKey('product.id', ondelete='SET NULL'), nullable=True, index=True)
     quantity = db.Column(db.Integer, nullable=False)
     created_at = db.Column(db.DateTime, nullable=False, default=utc_now)
 
+    product = db.relationship('Product', lazy=True)
+
 class PromoCode(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    code = db.Column(db.String(100), nullable=False)
+    code = db.Column(db.String(100), nullable=False, index=True)
     discount = db.Column(db.Float, nullable=False)
     count = db.Column(db.Integer, nullable=False)
     created_at = db.Column(db.DateTime, nullable=False, default=utc_now)
@@ -411,7 +321,7 @@ class Logs(db.Model):
 class City(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(100), nullable=False)
-    city_id = db.Column(db.String(100), nullable=False)
+    city_id = db.Column(db.String(100), nullable=False, index=True)
     created_at = db.Column(db.DateTime, nullable=False, default=utc_now)
     zones = db.relationship('Zone', backref='city', lazy=True, foreign_keys='Zone.city_id')
     price = db.relationship('ShippingCost', backref='city', lazy=True, foreign_keys='ShippingCost.city_id')
@@ -428,7 +338,7 @@ class City(db.Model):
 class Zone(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(100), nullable=False)
-    city_id = db.Column(db.Integer, db.ForeignKey('city.city_id'), nullable=False)
+    city_id = db.Column(db.Integer, db.ForeignKey('city.city_id'), nullable=False, index=True)
     zone_id = db.Column(db.String(100), nullable=False)
     created_at = db.Column(db.DateTime, nullable=False, default=utc_now)
     def serialize(self):
@@ -441,7 +351,7 @@ class Zone(db.Model):
 class District(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(100), nullable=False)
-    city_id = db.Column(db.Integer, db.ForeignKey('city.city_id'), nullable=False)
+    city_id = db.Column(db.Integer, db.ForeignKey('city.city_id'), nullable=False, index=True)
     district_id = db.Column(db.String(100), nullable=False)
     created_at = db.Column(db.DateTime, nullable=False, default=utc_now)
     def serialize(self):
@@ -453,7 +363,7 @@ class District(db.Model):
 
 class ShippingCost(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    city_id = db.Column(db.Integer, db.ForeignKey('city.city_id'), nullable=False)
+    city_id = db.Column(db.Integer, db.ForeignKey('city.city_id'), nullable=False, index=True)
     price = db.Column(db.Float, nullable=False)
     created_at = db.Column(db.DateTime, nullable=False, default=utc_now)
 
@@ -538,95 +448,991 @@ class HomeShowcase(db.Model):
         }
 
 
+class NotificationOutbox(db.Model):
+    """Outbound notification waiting for the background sender.
+
+    Rows are written in the same transaction as the event they announce and
+    move from 'pending' to 'sent', or to 'dead' once retries run out."""
+    __tablename__ = 'notification_outbox'
+    id = db.Column(db.Integer, primary_key=True)
+    channel = db.Column(db.String(50), nullable=False)                  # e.g. discord
+    payload = db.Column(db.Text, nullable=False)                        # JSON body
+    status = db.Column(db.String(20), nullable=False, default='pending')
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    next_attempt_at = db.Column(db.DateTime, nullable=False, default=utc_now)
+    last_error = db.Column(db.Text, nullable=True)
+    created_at = db.Column(db.DateTime, nullable=False, default=utc_now)
+    sent_at = db.Column(db.DateTime, nullable=True)
+    __table_args__ = (
+        # drain_notification_outbox(): WHERE status = 'pending' AND next_attempt_at <= ?
+        db.Index('ix_notification_outbox_status_next_attempt_at', 'status', 'next_attempt_at'),
+    )
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'channel': self.channel,
+            'status': self.status,
+            'attempts': self.attempts,
+            'next_attempt_at': self.next_attempt_at.isoformat() if self.next_attempt_at else None,
+            'last_error': self.last_error,
+            'created_at': self.created_at.isoformat() if self.created_at else None,
+            'sent_at': self.sent_at.isoformat() if self.sent_at else None,
+        }
+
+
+class BackgroundJob(db.Model):
+    """Long-running admin task (e.g. a Bosta sync) and its progress.
+
+    Kept in the database so any worker can report on a job another one runs."""
+    __tablename__ = 'background_job'
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(50), nullable=False)
+    status = db.Column(db.String(20), nullable=False, default='queued')  # queued, running, done, failed
+    progress = db.Column(db.Integer, nullable=False, default=0)
+    total = db.Column(db.Integer, nullable=True)
+    message = db.Column(db.String(255), nullable=True)
+    result = db.Column(db.Text, nullable=True)                           # JSON summary
+    error = db.Column(db.Text, nullable=True)
+    created_at = db.Column(db.DateTime, nullable=False, default=utc_now)
+    started_at = db.Column(db.DateTime, nullable=True)
+    finished_at = db.Column(db.DateTime, nullable=True)
+    updated_at = db.Column(db.DateTime, nullable=False, default=utc_now)
+    __table_args__ = (
+        db.Index('ix_background_job_kind_status', 'kind', 'status'),
+    )
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'kind': self.kind,
+            'status': self.status,
+            'progress': self.progress,
+            'total': self.total,
+            'message': self.message,
+            'result': json.loads(self.result) if self.result else None,
+            'error': self.error,
+            'created_at': self.created_at.isoformat() if self.created_at else None,
+            'started_at': self.started_at.isoformat() if self.started_at else None,
+            'finished_at': self.finished_at.isoformat() if self.finished_at else None,
+        }
+
+class PromotionRule(db.Model):
+    """A marketing offer priced at checkout.
+
+    A rule applies while now is inside [starts_at, ends_at] (either bound may
+    be open), the cart holds every product in ``product_ids`` and, when
+    ``city_ids`` is not empty, the order ships to one of those cities."""
+    __tablename__ = 'promotion_rule'
+    id = db.Column(db.Integer, primary_key=True)
+    slug = db.Column(db.String(50), nullable=False, unique=True)         # offer code, e.g. combo_1_2_3
+    name = db.Column(db.String(120), nullable=False)
+    message = db.Column(db.String(255), nullable=False, default='')      # shown to the customer
+    target = db.Column(db.String(20), nullable=False, default='items')   # items, shipping
+    discount_type = db.Column(db.String(20), nullable=False, default='percent')  # percent, fixed
+    amount = db.Column(db.Float, nullable=False, default=0)
+    product_ids = db.Column(db.Text, nullable=False, default='[]')       # JSON list, all required
+    city_ids = db.Column(db.Text, nullable=False, default='[]')          # JSON list, empty = any city
+    starts_at = db.Column(db.DateTime, nullable=True)                    # shop local time
+    ends_at = db.Column(db.DateTime, nullable=True)
+    priority = db.Column(db.Integer, nullable=False, default=100)        # lower wins
+    is_active = db.Column(db.Boolean, nullable=False, default=True)
+    created_at = db.Column(db.DateTime, nullable=False, default=utc_now)
+    updated_at = db.Column(db.DateTime, nullable=False, default=utc_now, onupdate=utc_now)
+
+    @property
+    def product_id_list(self):
+        return json.loads(self.product_ids or '[]')
+
+    @property
+    def city_id_list(self):
+        return json.loads(self.city_ids or '[]')
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'slug': self.slug,
+            'name': self.name,
+            'message': self.message or '',
+            'target': self.target,
+            'discount_type': self.discount_type,
+            'amount': self.amount,
+            'product_ids': self.product_id_list,
+            'city_ids': self.city_id_list,
+            'starts_at': self.starts_at.strftime('%Y-%m-%dT%H:%M') if self.starts_at else '',
+            'ends_at': self.ends_at.strftime('%Y-%m-%dT%H:%M') if self.ends_at else '',
+            'priority': self.priority,
+            'is_active': self.is_active,
+        }
+
+class DailySales(db.Model):
+    """Order totals of one day (by order creation date, UTC), kept by refresh_daily_sales().
+
+    Counts are by current shipping status; money columns are for delivered
+    orders except ``returned_shipping``. Shipping is the city's base rate."""
+    __tablename__ = 'daily_sales'
+    day = db.Column(db.Date, primary_key=True)
+    orders_count = db.Column(db.Integer, nullable=False, default=0)
+    pending_count = db.Column(db.Integer, nullable=False, default=0)
+    shipped_count = db.Column(db.Integer, nullable=False, default=0)
+    delivered_count = db.Column(db.Integer, nullable=False, default=0)
+    returned_count = db.Column(db.Integer, nullable=False, default=0)
+    cancelled_count = db.Column(db.Integer, nullable=False, default=0)
+    cod_collected = db.Column(db.Float, nullable=False, default=0)       # delivered cod_amount
+    shipping_cost = db.Column(db.Float, nullable=False, default=0)       # delivered
+    returned_shipping = db.Column(db.Float, nullable=False, default=0)
+    net_revenue = db.Column(db.Float, nullable=False, default=0)         # delivered, max(0, cod - shipping)
+    items_sold = db.Column(db.Integer, nullable=False, default=0)        # delivered
+    updated_at = db.Column(db.DateTime, nullable=False, default=utc_now)
+
+class DailyProductSales(db.Model):
+    """Delivered quantity and revenue (at the current price) per product per day."""
+    __tablename__ = 'daily_product_sales'
+    day = db.Column(db.Date, primary_key=True)
+    product_id = db.Column(db.Integer, db.ForeignKey('product.id', ondelete='CASCADE'), primary_key=True,
+                           index=True)
+    quantity = db.Column(db.Integer, nullable=False, default=0)
+    revenue = db.Column(db.Float, nullable=False, default=0)
+
 # changShippingCostFromcity_idIsIdToCityId()
 
 shop = Blueprint('shop', __name__)
 admin = Blueprint('admin', __name__)
 
+# ─── Background housekeeping ──────────────────────────────────
+# Periodic maintenance runs on one daemon thread per worker process instead of
+# inside request handlers, so a page view never pays for table-wide cleanup.
+
+app.config['HOUSEKEEPING_ENABLED'] = os.getenv('HOUSEKEEPING_ENABLED', '1') in ('1', 'true', 'True')
+app.config['HOUSEKEEPING_TICK'] = int(os.getenv('HOUSEKEEPING_TICK', '5'))
+app.config['CART_SWEEP_INTERVAL'] = int(os.getenv('CART_SWEEP_INTERVAL', '300'))
+app.config['CART_SWEEP_BATCH_SIZE'] = int(os.getenv('CART_SWEEP_BATCH_SIZE', '500'))
+# 'buffered' coalesces Gusts.last_activity writes in memory; 'immediate' commits inline
+app.config['GUEST_ACTIVITY_MODE'] = os.getenv('GUEST_ACTIVITY_MODE', 'buffered')
+app.config['GUEST_ACTIVITY_GRANULARITY'] = int(os.getenv('GUEST_ACTIVITY_GRANULARITY', '300'))
+app.config['GUEST_ACTIVITY_FLUSH_INTERVAL'] = int(os.getenv('GUEST_ACTIVITY_FLUSH_INTERVAL', '60'))
+app.config['PRODUCT_VIEW_FLUSH_INTERVAL'] = int(os.getenv('PRODUCT_VIEW_FLUSH_INTERVAL', '30'))
+
+CART_ITEM_LIFETIME = timedelta(hours=24)
+
+_housekeeping_tasks = {}
+_housekeeping_lock = threading.Lock()
+_housekeeping_thread = None
+
+
+def housekeeping_task(name, interval_key, at_exit=False):
+    """Register a function to run every ``app.config[interval_key]`` seconds.
+
+    The function's return value (e.g. number of rows touched) is kept as
+    ``last_result`` and summed into ``total`` for the metrics endpoint.
+    Tasks flagged ``at_exit`` also run once when the worker shuts down, so
+    in-memory buffers are not lost on a graceful restart."""
+    def decorator(fn):
+        _housekeeping_tasks[name] = {
+            'fn': fn,
+            'interval_key': interval_key,
+            'at_exit': at_exit,
+            'last_run': None,
+            'last_run_at': None,
+            'last_result': None,
+            'last_error': None,
+            'runs': 0,
+            'total': 0,
+        }
+        return fn
+    return decorator
+
+
+def run_housekeeping(force=False, only_at_exit=False):
+    """Run every registered task that is due, or all of them when ``force``."""
+    now = time.monotonic()
+    for name, task in _housekeeping_tasks.items():
+        if only_at_exit and not task['at_exit']:
+            continue
+        interval = app.config.get(task['interval_key'], 60)
+        if not force and task['last_run'] is not None and now - task['last_run'] < interval:
+            continue
+        task['last_run'] = now
+        with app.app_context():
+            try:
+                result = task['fn']()
+                task['last_result'] = result
+                task['last_error'] = None
+                if isinstance(result, int):
+                    task['total'] += result
+            except Exception as e:
+                db.session.rollback()
+                task['last_error'] = str(e)
+                app.logger.error(f'Housekeeping task {name} failed: {str(e)}')
+            finally:
+                task['runs'] += 1
+                task['last_run_at'] = utc_now()
+                db.session.remove()
+
+
+def housekeeping_stats():
+    """Snapshot of task counters for the admin metrics endpoint."""
+    return {
+        name: {
+            'interval': app.config.get(task['interval_key']),
+            'runs': task['runs'],
+            'last_run_at': task['last_run_at'].isoformat() if task['last_run_at'] else None,
+            'last_result': task['last_result'],
+            'total': task['total'],
+            'last_error': task['last_error'],
+        }
+        for name, task in _housekeeping_tasks.items()
+    }
+
+
+def _run_housekeeping_at_exit():
+    try:
+        run_housekeeping(force=True, only_at_exit=True)
+    except Exception:
+        pass
+
+
+atexit.register(_run_housekeeping_at_exit)
+
+
+def _housekeeping_loop():
+    while True:
+        time.sleep(app.config['HOUSEKEEPING_TICK'])
+        run_housekeeping()
+
+
+def start_housekeeping():
+    """Start the housekeeping thread once per worker (never under tests)."""
+    global _housekeeping_thread
+    if _housekeeping_thread is not None:
+        return
+    if app.config.get('TESTING') or not app.config['HOUSEKEEPING_ENABLED']:
+        return
+    with _housekeeping_lock:
+        if _housekeeping_thread is None:
+            thread = threading.Thread(target=_housekeeping_loop, name='housekeeping', daemon=True)
+            thread.start()
+            _housekeeping_thread = thread
+
+
+@housekeeping_task('cart_sweep', 'CART_SWEEP_INTERVAL')
 def cleanup_expired_cart_items():
-    """Delete cart items older than 24 hours"""
+    """Delete cart items older than 24 hours in batches; return rows removed."""
+    expiration_time = utc_now() - CART_ITEM_LIFETIME
+    batch_size = app.config['CART_SWEEP_BATCH_SIZE']
+    removed = 0
+    # Errors propagate so run_housekeeping rolls back and records them
+    while True:
+        expired_ids = db.select(Cart.id).where(Cart.created_at < expiration_time).limit(batch_size)
+        deleted = Cart.query.filter(Cart.id.in_(expired_ids)).delete(synchronize_session=False)
+        db.session.commit()
+        removed += deleted
+        if deleted < batch_size:
+            break
+    return removed
+
+_guest_activity_buffer = {}
+_guest_activity_lock = threading.Lock()
+
+
+def record_guest_activity(guest_id, seen_at):
+    """Queue a ``Gusts.last_activity`` update for the next bulk flush."""
+    with _guest_activity_lock:
+        _guest_activity_buffer[guest_id] = seen_at
+
+
+def latest_guest_activity(guest):
+    """Newest known activity for ``guest``: the stored value or a pending one."""
+    with _guest_activity_lock:
+        pending = _guest_activity_buffer.get(guest.id)
+    stored = guest.last_activity
+    if stored is not None and stored.tzinfo is not None:
+        stored = stored.replace(tzinfo=None)
+    if pending is None:
+        return stored
+    if stored is None:
+        return pending
+    return max(stored, pending)
+
+
+@housekeeping_task('guest_activity_flush', 'GUEST_ACTIVITY_FLUSH_INTERVAL', at_exit=True)
+def flush_guest_activity():
+    """Write buffered activity timestamps with one executemany; return rows."""
+    global _guest_activity_buffer
+    with _guest_activity_lock:
+        pending, _guest_activity_buffer = _guest_activity_buffer, {}
+    if not pending:
+        return 0
+    guests = Gusts.__table__
+    stmt = guests.update().where(guests.c.id == db.bindparam('guest_id')).values(
+        last_activity=db.bindparam('seen_at')
+    )
     try:
-        expiration_time = utc_now() - timedelta(hours=24)
-        expired_items = Cart.query.filter(Cart.created_at < expiration_time).all()
-        for item in expired_items:
-            db.session.delete(item)
+        db.session.execute(stmt, [
+            {'guest_id': guest_id, 'seen_at': seen_at} for guest_id, seen_at in pending.items()
+        ])
         db.session.commit()
-    except Exception as e:
-        app.logger.error(f'Error cleaning up expired cart items: {str(e)}')
+    except Exception:
         db.session.rollback()
+        # Put the batch back so the next flush retries it (newer values win)
+        with _guest_activity_lock:
+            for guest_id, seen_at in pending.items():
+                current = _guest_activity_buffer.get(guest_id)
+                if current is None or current < seen_at:
+                    _guest_activity_buffer[guest_id] = seen_at
+        raise
+    return len(pending)
+
+
+def touch_guest_activity(guest, now):
+    """Record activity at most once per ``GUEST_ACTIVITY_GRANULARITY`` seconds."""
+    last_seen = latest_guest_activity(guest)
+    granularity = timedelta(seconds=app.config['GUEST_ACTIVITY_GRANULARITY'])
+    if last_seen is not None and now - last_seen < granularity:
+        return
+    if app.config['GUEST_ACTIVITY_MODE'] == 'immediate':
+        guest.last_activity = now
+        db.session.commit()
+    else:
+        record_guest_activity(guest.id, now)
+
+_product_view_buffer = {}
+_product_view_lock = threading.Lock()
+
+
+def record_product_view(product_id, count=1):
+    """Count a product page view; it reaches ``Product.views`` on the next flush."""
+    with _product_view_lock:
+        _product_view_buffer[product_id] = _product_view_buffer.get(product_id, 0) + count
+
+
+@housekeeping_task('product_view_flush', 'PRODUCT_VIEW_FLUSH_INTERVAL', at_exit=True)
+def flush_product_views():
+    """Add buffered view counts with one executemany; return products updated.
+
+    The increment happens in SQL (``views = views + :n``), so flushes from
+    several workers never overwrite each other.
+    """
+    global _product_view_buffer
+    with _product_view_lock:
+        pending, _product_view_buffer = _product_view_buffer, {}
+    if not pending:
+        return 0
+    products = Product.__table__
+    stmt = products.update().where(products.c.id == db.bindparam('product_id')).values(
+        views=products.c.views + db.bindparam('increment')
+    )
+    try:
+        db.session.execute(stmt, [
+            {'product_id': product_id, 'increment': count} for product_id, count in pending.items()
+        ])
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        # Keep the counts for the next flush
+        with _product_view_lock:
+            for product_id, count in pending.items():
+                _product_view_buffer[product_id] = _product_view_buffer.get(product_id, 0) + count
+        raise
+    return len(pending)
+
+
+# ─── Process-local caches ─────────────────────────────────────
+# Small read-through caches for data that every page renders but that only
+# changes from the admin. Each worker keeps its own copy; invalidation is
+# shared through a version stamp file whose mtime every worker compares on
+# read, so an admin edit in one worker is seen by the others on their next
+# request without any extra DB round trip.
+
+app.config['CACHE_VERSION_DIR'] = os.getenv('CACHE_VERSION_DIR', os.path.join(app.instance_path, 'cache'))
+app.config['CATEGORY_CACHE_TTL'] = int(os.getenv('CATEGORY_CACHE_TTL', '300'))
+
+_process_caches = {}
+
+
+def _cache_version_path(name):
+    return os.path.join(app.config['CACHE_VERSION_DIR'], f'{name}.version')
+
+
+def cache_version(name):
+    """Return the shared version stamp of cache ``name`` (0 if never bumped)."""
+    try:
+        return os.stat(_cache_version_path(name)).st_mtime_ns
+    except OSError:
+        return 0
+
+
+def bump_cache_version(name):
+    """Invalidate cache ``name`` in every worker by advancing its stamp."""
+    path = _cache_version_path(name)
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        stamp = max(time.time_ns(), cache_version(name) + 1)
+        with open(path, 'a'):
+            pass
+        os.utime(path, ns=(stamp, stamp))
+    except OSError as e:
+        app.logger.error(f'Cache version bump failed for {name}: {e}')
+
+
+class VersionedCache:
+    """Per-process read-through cache bounded by a TTL and a shared version.
+
+    ``ttl_key`` names the config entry holding the lifetime in seconds; a
+    value of 0 disables caching. Values must be plain data (snapshots, ids,
+    rendered fragments) — never ORM instances, which are bound to the
+    session of the request that loaded them. ``max_entries`` bounds caches
+    keyed by user input.
+    """
+
+    clock = staticmethod(time.monotonic)
+
+    def __init__(self, name, ttl_key, max_entries=None):
+        self.name = name
+        self.ttl_key = ttl_key
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries = {}
+        self._lock = threading.Lock()
+        _process_caches[name] = self
+
+    def get(self, loader, key=None):
+        version = cache_version(self.name)
+        now = self.clock()
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] == version and now < entry[1]:
+            self.hits += 1
+            return entry[2]
+        value = loader()
+        ttl = app.config.get(self.ttl_key, 0)
+        with self._lock:
+            self.misses += 1
+            if ttl > 0:
+                if self.max_entries and len(self._entries) >= self.max_entries:
+                    self._evict(version, now)
+                self._entries[key] = (version, now + ttl, value)
+        return value
+
+    def _evict(self, version, now):
+        for key, entry in tuple(self._entries.items()):
+            if entry[0] != version or now >= entry[1]:
+                del self._entries[key]
+        if len(self._entries) >= self.max_entries:
+            self._entries.clear()
+
+    def invalidate(self):
+        """Drop this worker's entries and tell the other workers to do so."""
+        self.clear()
+        bump_cache_version(self.name)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'entries': len(self._entries),
+            'ttl': app.config.get(self.ttl_key, 0),
+            'version': cache_version(self.name),
+        }
+
+
+def cache_stats():
+    return {name: cache.stats() for name, cache in _process_caches.items()}
+
+
+def clear_process_caches():
+    """Empty every cache in this process and reset its counters."""
+    for cache in _process_caches.values():
+        cache.clear()
+        cache.hits = cache.misses = 0
+
+
+category_cache = VersionedCache('categories', 'CATEGORY_CACHE_TTL')
+
+
+def _load_category_snapshots():
+    counts = dict(
+        db.session.query(Product.category_id, db.func.count(Product.id))
+        .group_by(Product.category_id).all()
+    )
+    return tuple(
+        SimpleNamespace(id=cat_id, name=name, description=description,
+                        product_count=counts.get(cat_id, 0))
+        for cat_id, name, description in
+        db.session.query(Category.id, Category.name, Category.description)
+        .order_by(Category.id).all()
+    )
+
+
+def cached_categories():
+    """Category list (id, name, description, product_count) for menus and filters.
+
+    Cached per worker; call ``category_cache.invalidate()`` after committing
+    any change to categories or to which category a product belongs.
+    """
+    return category_cache.get(_load_category_snapshots)
+
+
+# ─── Home page fragments ──────────────────────────────────────
+# Each home page section is rendered on its own and cached as HTML. Banner and
+# showcase fragments live until an admin edit bumps their version; product
+# sections simply expire after HOME_PRODUCTS_CACHE_TTL seconds.
+
+app.config['HOME_CONTENT_CACHE_TTL'] = int(os.getenv('HOME_CONTENT_CACHE_TTL', '3600'))
+app.config['HOME_PRODUCTS_CACHE_TTL'] = int(os.getenv('HOME_PRODUCTS_CACHE_TTL', '60'))
+
+home_banner_cache = VersionedCache('home_banners', 'HOME_CONTENT_CACHE_TTL')
+home_showcase_cache = VersionedCache('home_showcase', 'HOME_CONTENT_CACHE_TTL')
+home_products_cache = VersionedCache('home_products', 'HOME_PRODUCTS_CACHE_TTL')
+
+
+def _render_home_hero():
+    # Hero banners from DB, fallback to hardcoded if none exist
+    banners = BannerSlide.query.filter_by(is_active=True).order_by(
+        BannerSlide.sort_order.asc(), BannerSlide.id.asc()
+    ).all()
+    return Markup(render_template('shop/components/home_hero.html', db_banners=banners))
+
+
+def _render_home_sale():
+    # Products with an active discount for "Limited Time Offer" section
+    sale_products = Product.query.filter(
+        Product.discount > 0, Product.stock > 0
+    ).order_by(Product.discount.desc()).limit(6).all()
+    return Markup(render_template('shop/components/home_sale.html', sale_products=sale_products))
+
+
+def _render_home_latest():
+    last_products = Product.query.order_by(Product.created_at.desc()).limit(8).all()
+    return Markup(render_template('shop/components/product_section.html',
+                                  section_id="featured-products",
+                                  section_title="أحدث المنتجات",
+                                  products=last_products))
+
+
+def _render_home_showcase():
+    # Product showcase section ('مجموعة العناية المتطورة') from DB
+    showcase_items = HomeShowcase.query.filter_by(is_active=True).order_by(
+        HomeShowcase.sort_order.asc(), HomeShowcase.id.asc()
+    ).all()
+    return Markup(render_template('shop/components/home_showcase.html', showcase_items=showcase_items))
+
+
+# ─── Related products ─────────────────────────────────────────
+# Product pages show a few "similar" products. Instead of sorting the whole
+# table with ORDER BY random() per view, each worker keeps a small candidate
+# pool per product (co-purchased first, then same category, then any product)
+# and samples it. Product add/edit/delete routes invalidate the pools.
+
+app.config['RELATED_PRODUCTS_TTL'] = int(os.getenv('RELATED_PRODUCTS_TTL', '900'))
+app.config['RELATED_PRODUCTS_POOL_SIZE'] = int(os.getenv('RELATED_PRODUCTS_POOL_SIZE', '24'))
+app.config['RELATED_PRODUCTS_COUNT'] = 6
+
+related_products_cache = VersionedCache('related_products', 'RELATED_PRODUCTS_TTL')
+
+
+def _build_related_index():
+    """Return ``{'pools': {product_id: (candidate ids)}, 'fallback': (ids)}``."""
+    size = app.config['RELATED_PRODUCTS_POOL_SIZE']
+    category_of = {}
+    by_category = {}
+    for product_id, category_id in db.session.query(Product.id, Product.category_id):
+        category_of[product_id] = category_id
+        by_category.setdefault(category_id, []).append(product_id)
+
+    bought, also = db.aliased(OrderItem), db.aliased(OrderItem)
+    co_purchased = {}
+    pairs = db.session.query(bought.product_id, also.product_id).join(
+        also, db.and_(also.order_id == bought.order_id, also.product_id != bought.product_id)
+    ).filter(
+        bought.product_id.isnot(None), also.product_id.isnot(None)
+    ).group_by(bought.product_id, also.product_id).order_by(db.func.count().desc())
+    for product_id, other_id in pairs:
+        if other_id in category_of:
+            co_purchased.setdefault(product_id, []).append(other_id)
+
+    all_ids = tuple(category_of)
+    fallback = tuple(random.sample(all_ids, min(len(all_ids), size + 1)))
+
+    pools = {}
+    for product_id, category_id in category_of.items():
+        pool = co_purchased.get(product_id, [])[:size]
+        seen = set(pool)
+        seen.add(product_id)
+        siblings = by_category[category_id]
+        # Small categories are topped up from the catalogue-wide sample
+        for other_id in (*random.sample(siblings, min(len(siblings), size + 1)), *fallback):
+            if len(pool) >= size:
+                break
+            if other_id not in seen:
+                pool.append(other_id)
+                seen.add(other_id)
+        if pool:
+            pools[product_id] = tuple(pool)
+
+    return {'pools': pools, 'fallback': fallback[:size]}
+
+
+def related_products(product_id, limit=None):
+    """Up to ``limit`` products to suggest next to ``product_id``."""
+    limit = limit or app.config['RELATED_PRODUCTS_COUNT']
+    index = related_products_cache.get(_build_related_index)
+    pool = index['pools'].get(product_id) or index['fallback']
+    candidates = [pid for pid in pool if pid != product_id]
+    picked = random.sample(candidates, min(limit, len(candidates)))
+    if not picked:
+        return []
+    found = {p.id: p for p in Product.query.filter(Product.id.in_(picked))}
+    return [found[pid] for pid in picked if pid in found]
+
+
+# ─── Product search ───────────────────────────────────────────
+# /shop?search= is served from an SQLite FTS5 table (rowid = product id) that
+# holds Arabic-normalized copies of name and description. Mapper events keep
+# it in step with the product table inside the same transaction. Databases
+# without FTS5 fall back to the old ILIKE scan.
+
+_ARABIC_DIACRITICS = re.compile('[\u0610-\u061a\u064b-\u065f\u0670\u06d6-\u06ed\u0640]')
+_ARABIC_LETTER_MAP = str.maketrans({
+    '\u0623': '\u0627', '\u0625': '\u0627', '\u0622': '\u0627', '\u0671': '\u0627',  # أ إ آ ٱ -> ا
+    '\u0629': '\u0647',  # ة -> ه
+    '\u0649': '\u064a',  # ى -> ي
+    '\u0624': '\u0648', '\u0626': '\u064a',  # ؤ -> و, ئ -> ي
+})
+_SEARCH_TOKEN = re.compile(r'\w+')
+_search_enabled = None
+
+
+def normalize_arabic(value):
+    """Fold Arabic spelling variants so "الإسكندرية" matches "الاسكندريه"."""
+    if not value:
+        return ''
+    value = _ARABIC_DIACRITICS.sub('', value)
+    return value.translate(_ARABIC_LETTER_MAP).lower()
+
+
+def search_index_enabled(connection=None):
+    """True when the ``product_search`` FTS5 table exists on this database."""
+    global _search_enabled
+    if _search_enabled is None:
+        try:
+            connection = connection or db.session.connection()
+            _search_enabled = connection.execute(sa_text(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'product_search'"
+            )).first() is not None
+        except Exception as e:
+            # Not latched: the next call checks again
+            app.logger.warning(f'Could not check for the search index: {e}')
+            return False
+    return _search_enabled
+
+
+def _index_product(connection, product_id, name, description):
+    connection.execute(sa_text('DELETE FROM product_search WHERE rowid = :id'), {'id': product_id})
+    connection.execute(
+        sa_text('INSERT INTO product_search (rowid, name, description) VALUES (:id, :name, :description)'),
+        {'id': product_id, 'name': normalize_arabic(name), 'description': normalize_arabic(description)},
+    )
+
+
+def rebuild_search_index():
+    """Re-index every product; returns the number of rows indexed."""
+    if not search_index_enabled():
+        return 0
+    connection = db.session.connection()
+    connection.execute(sa_text('DELETE FROM product_search'))
+    count = 0
+    for product_id, name, description in db.session.query(Product.id, Product.name, Product.description):
+        _index_product(connection, product_id, name, description)
+        count += 1
+    db.session.commit()
+    return count
+
+
+@event.listens_for(db.metadata, 'after_create')
+def _create_search_index(target, connection, **kw):
+    global _search_enabled
+    if connection.dialect.name != 'sqlite':
+        _search_enabled = False
+        return
+    try:
+        exists = connection.execute(sa_text(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'product_search'"
+        )).first() is not None
+        if not exists:
+            # Workers start together and may race here; IF NOT EXISTS lets the
+            # loser through, and re-indexing a product replaces its row
+            connection.execute(sa_text(
+                "CREATE VIRTUAL TABLE IF NOT EXISTS product_search USING fts5("
+                "name, description, tokenize = 'unicode61 remove_diacritics 2')"
+            ))
+            for product_id, name, description in connection.execute(
+                    sa_text('SELECT id, name, description FROM product')):
+                _index_product(connection, product_id, name, description)
+        _search_enabled = True
+    except Exception as e:
+        # Possibly transient (another worker holding the lock): leave the flag
+        # unset so search_index_enabled() looks at sqlite_master again
+        app.logger.error(f'Could not set up the FTS5 search index: {e}')
+        _search_enabled = None
+
+
+@event.listens_for(db.metadata, 'before_drop')
+def _drop_search_index(target, connection, **kw):
+    global _search_enabled
+    if connection.dialect.name == 'sqlite':
+        connection.execute(sa_text('DROP TABLE IF EXISTS product_search'))
+    _search_enabled = None
+
+
+@event.listens_for(Product, 'after_insert')
+def _search_index_insert(mapper, connection, target):
+    if search_index_enabled(connection):
+        _index_product(connection, target.id, target.name, target.description)
+
+
+@event.listens_for(Product, 'after_update')
+def _search_index_update(mapper, connection, target):
+    state = db.inspect(target)
+    if not (state.attrs.name.history.has_changes() or state.attrs.description.history.has_changes()):
+        return
+    if search_index_enabled(connection):
+        _index_product(connection, target.id, target.name, target.description)
+
+
+@event.listens_for(Product, 'after_delete')
+def _search_index_delete(mapper, connection, target):
+    if search_index_enabled(connection):
+        connection.execute(sa_text('DELETE FROM product_search WHERE rowid = :id'), {'id': target.id})
+
+
+def product_search_hits(search):
+    """Subquery of ``(product_id, rank)`` for ``search``; lower rank is better.
+
+    Returns None when the FTS index is unavailable or the query has no
+    searchable tokens, in which case callers fall back to ILIKE.
+    """
+    tokens = _SEARCH_TOKEN.findall(normalize_arabic(search))
+    if not tokens or not search_index_enabled():
+        return None
+    # Each token is a quoted prefix term; FTS5 ANDs them together
+    match = ' '.join('"{}"*'.format(token.replace('"', '""')) for token in tokens)
+    return sa_text(
+        'SELECT rowid AS product_id, bm25(product_search, 10.0, 1.0) AS rank '
+        'FROM product_search WHERE product_search MATCH :match'
+    ).bindparams(match=match).columns(
+        product_id=db.Integer, rank=db.Float
+    ).subquery('search_hits')
+
+
+@app.cli.command('reindex-search')
+def reindex_search_command():
+    """Rebuild the product full-text search index."""
+    print(f'Indexed {rebuild_search_index()} products')
+
+
+# ─── Keyset pagination ────────────────────────────────────────
+# Listing pages seek past the last row of the previous page on their sort key
+# (e.g. created_at, id) instead of using OFFSET, so deep pages cost the same
+# as the first one. Cursors are opaque signed tokens. Totals are only shown
+# as a hint, so by default they come from a short-lived count cache.
+
+app.config['LIST_COUNT_MODE'] = os.getenv('LIST_COUNT_MODE', 'cached')  # cached | exact | none
+app.config['LIST_COUNT_CACHE_TTL'] = int(os.getenv('LIST_COUNT_CACHE_TTL', '60'))
+
+list_count_cache = VersionedCache('list_counts', 'LIST_COUNT_CACHE_TTL', max_entries=1000)
+
+
+class KeysetPage:
+    """One page of a keyset walk, navigated with ``next_cursor``/``prev_cursor``."""
+
+    def __init__(self, items, per_page, number, has_prev, has_next, prev_cursor, next_cursor, total):
+        self.items = items
+        self.per_page = per_page
+        self.number = number
+        self.has_prev = has_prev
+        self.has_next = has_next
+        self.prev_cursor = prev_cursor
+        self.next_cursor = next_cursor
+        self.total = total
+
+    @property
+    def pages(self):
+        if self.total is None:
+            return None
+        return max(1, -(-self.total // self.per_page))
+
+    @property
+    def first_index(self):
+        return (self.number - 1) * self.per_page + 1
+
+
+def _cursor_serializer():
+    return URLSafeSerializer(app.secret_key, salt='keyset-cursor')
+
+
+def _encode_cursor(signature, direction, number, values):
+    values = [value.isoformat() if isinstance(value, datetime) else value for value in values]
+    return _cursor_serializer().dumps({'s': signature, 'd': direction, 'p': number, 'k': values})
+
+
+def _decode_cursor(cursor, signature, order):
+    try:
+        payload = _cursor_serializer().loads(cursor)
+    except BadSignature:
+        return None
+    # A cursor from another sort order or filter set is meaningless here
+    if not isinstance(payload, dict) or payload.get('s') != signature or len(payload.get('k') or ()) != len(order):
+        return None
+    values = []
+    for (column, _), value in zip(order, payload['k']):
+        if value is not None and isinstance(column.type, db.DateTime):
+            value = datetime.fromisoformat(value)
+        values.append(value)
+    payload['k'] = values
+    return payload
+
+
+def _seek_condition(order, values, forward):
+    """Rows strictly after ``values`` in ``order`` (before it if not ``forward``)."""
+    clauses = []
+    for i, (column, descending) in enumerate(order):
+        past = column < values[i] if descending == forward else column > values[i]
+        ties = [order[j][0] == values[j] for j in range(i)]
+        clauses.append(db.and_(*ties, past))
+    return db.or_(*clauses)
+
+
+def list_total(query, mode=None):
+    """Row count of ``query`` according to ``LIST_COUNT_MODE`` (None for 'none')."""
+    mode = mode or app.config['LIST_COUNT_MODE']
+    if mode == 'none':
+        return None
+    query = query.order_by(None)
+    if mode == 'exact':
+        return query.count()
+    compiled = query.statement.compile(db.engine)
+    key = (str(compiled), tuple(sorted(compiled.params.items())))
+    return list_count_cache.get(query.count, key=key)
+
+
+def keyset_paginate(query, order, per_page, cursor=None, page=1, signature='', key=None, count_mode=None,
+                    count_query=None):
+    """Return a ``KeysetPage`` of ``query`` walked in ``order``.
+
+    ``order`` is a sequence of ``(column, descending)`` pairs whose values
+    together are unique per row (end it with the primary key). ``key`` maps a
+    result row to those values and defaults to reading the column attributes.
+    ``signature`` should identify the filters and sort so that a cursor is
+    only honoured by the listing that issued it. A bare ``page`` > 1 (old
+    links) is served once with OFFSET; the cursors it returns take over.
+    ``count_query`` is counted instead of ``query`` when the listing only
+    adds one-to-one joins for display.
+    """
+    key = key or (lambda row: tuple(getattr(row, column.key) for column, _ in order))
+    payload = _decode_cursor(cursor, signature, order) if cursor else None
+    forward = payload is None or payload['d'] == 'next'
+    total = list_total(query if count_query is None else count_query, count_mode)
+
+    query = query.order_by(None)
+    if payload:
+        query = query.filter(_seek_condition(order, payload['k'], forward))
+    query = query.order_by(*[
+        column.desc() if descending == forward else column.asc() for column, descending in order
+    ])
+    if payload is None and page > 1:
+        query = query.offset((page - 1) * per_page)
+    rows = query.limit(per_page + 1).all()
+    more = len(rows) > per_page
+    rows = rows[:per_page]
+    if not forward:
+        rows.reverse()
+
+    if payload:
+        number = max(1, payload['p'])
+        has_next = more if forward else True
+        has_prev = True if forward else more
+    else:
+        number = max(1, page)
+        has_next = more
+        has_prev = number > 1
+    prev_cursor = next_cursor = None
+    if rows and has_prev:
+        prev_cursor = _encode_cursor(signature, 'prev', number - 1, key(rows[0]))
+    if rows and has_next:
+        next_cursor = _encode_cursor(signature, 'next', number + 1, key(rows[-1]))
+    return KeysetPage(rows, per_page, number, has_prev, has_next, prev_cursor, next_cursor, total)
+
 
 def check_session():
     """
     Check and manage user session, including:
     - Session creation/validation
-    - Cart cleanup
     - User activity tracking
     - Session expiration handling
+
+    Expired cart items are purged by the ``cart_sweep`` housekeeping task,
+    so an existing session costs a single lookup (guest row + cart size).
+    Activity timestamps are coarse (see ``touch_guest_activity``); the
+    30-day expiry compares against the newest stored or buffered value.
+
+    No ``Gusts`` row is created here: crawlers and one-shot visitors only
+    get a session token, and ``get_or_create_guest()`` inserts the row the
+    first time a stateful action (adding to cart) needs one.
     """
+    g.guest = None
     try:
         # 1. Check if session exists
         if 'session' not in session:
-            # Create new session
+            # Create new session token (the guest row is created lazily)
             session['session'] = os.urandom(24).hex()
             session['cart_count'] = 0
-            new_guest = Gusts(
-                session=session['session'],
-                last_activity=utc_now()
-            )
-            db.session.add(new_guest)
-            db.session.commit()
             return
 
-        # 2. Get existing guest
-        guest = Gusts.query.filter_by(session=session['session']).first()
-        
-        if guest:
-            # 3. Keep previous last activity for expiration check
-            previous_last_activity = guest.last_activity
-            
-            # 4. Clean up expired cart items
-            cleanup_expired_cart_items()
-            
-            # 5. Update cart count
-            cart_count = Cart.query.filter_by(user_id=guest.id).count()
-            session['cart_count'] = cart_count
-            
-            # 6. Check for session expiration (30 days of inactivity)
-            expiration_time = utc_now() - timedelta(days=30)
-            if previous_last_activity:
-                if previous_last_activity.tzinfo is not None:
-                    previous_last_activity = previous_last_activity.replace(tzinfo=None)
-                if previous_last_activity < expiration_time:
-                    # Clear old cart items
-                    Cart.query.filter_by(user_id=guest.id).delete()
-                    # Create new session
-                    session.clear()
-                    session['session'] = os.urandom(24).hex()
-                    session['cart_count'] = 0
-                    new_guest = Gusts(
-                        session=session['session'],
-                        last_activity=utc_now()
-                    )
-                    db.session.add(new_guest)
-                    db.session.commit()
-                    return
+        # 2. Get existing guest together with its cart size
+        cart_count_query = (
+            db.select(db.func.count(Cart.id))
+            .where(Cart.user_id == Gusts.id)
+            .correlate(Gusts)
+            .scalar_subquery()
+        )
+        row = db.session.query(Gusts, cart_count_query).filter(
+            Gusts.session == session['session']
+        ).first()
 
-            # Update activity only after expiration check
-            guest.last_activity = utc_now()
-                
+        if not row:
+            # Session that never needed a guest row yet
+            session['cart_count'] = 0
+            return
+
+        guest, cart_count = row
+        now = utc_now()
+        # 3. Keep previous last activity for expiration check
+        previous_last_activity = latest_guest_activity(guest)
+
+        # 4. Update cart count
+        session['cart_count'] = cart_count
+
+        # 5. Check for session expiration (30 days of inactivity)
+        expiration_time = now - timedelta(days=30)
+        if previous_last_activity and previous_last_activity < expiration_time:
+            # Clear old cart items
+            Cart.query.filter_by(user_id=guest.id).delete()
             db.session.commit()
-        else:
-            # 7. Handle orphaned session
+            # Start a new session; its guest row is created on demand
             session.clear()
             session['session'] = os.urandom(24).hex()
             session['cart_count'] = 0
-            new_guest = Gusts(
-                session=session['session'],
-                last_activity=utc_now()
-            )
-            db.session.add(new_guest)
-            db.session.commit()
-            
+            return
+
+        # Update activity only after expiration check
+        touch_guest_activity(guest, now)
+        g.guest = guest
+
     except Exception as e:
         app.logger.error(f'Error in check_session: {str(e)}')
         db.session.rollback()
@@ -636,6 +1442,32 @@ def check_session():
             session['cart_count'] = 0
 
 
+def current_guest():
+    """Guest row for this browser session, or None if it never needed one."""
+    if 'guest' in g:
+        return g.guest
+    token = session.get('session')
+    g.guest = Gusts.query.filter_by(session=token).first() if token else None
+    return g.guest
+
+
+def get_or_create_guest():
+    """Return the guest for this session, inserting the row on first use.
+
+    The new row is flushed, not committed: it is persisted together with
+    the cart item or order that needed it."""
+    guest = current_guest()
+    if guest:
+        return guest
+    if 'session' not in session:
+        session['session'] = os.urandom(24).hex()
+    guest = Gusts(session=session['session'], last_activity=utc_now())
+    db.session.add(guest)
+    db.session.flush()
+    g.guest = guest
+    return guest
+
+
 def generate_csrf_token():
     token = session.get('_csrf_token')
     if not token:
@@ -652,7 +1484,7 @@ def inject_csrf_token():
 def inject_global_data():
     """Inject categories and other global data into all templates"""
     try:
-        all_categories = Category.query.all()
+        all_categories = cached_categories()
     except Exception:
         all_categories = []
     return {'all_categories': all_categories}
@@ -663,8 +1495,10 @@ def test_honeybadger():
     return f"{1/0}"
 @app.before_request
 def before_request():
+    start_housekeeping()
+    if request.endpoint == 'static':
+        return
     check_session()
-    cleanup_expired_cart_items()  # Clean up expired items on each request
     session.permanent = True
     session.modified = True
 
@@ -703,37 +1537,21 @@ def date_format(value):
     return value.strftime('%Y-%m-%d %I:%M %p')
 @shop.route('/')
 def home():
-    check_session()
-    categories = Category.query.all()
-    last_products = Product.query.order_by(Product.created_at.desc()).limit(8).all()
-    trending_products = Product.query.order_by(Product.views.desc()).limit(8).all()
-    # Products with an active discount for "Limited Time Offer" section
-    sale_products = Product.query.filter(
-        Product.discount > 0, Product.stock > 0
-    ).order_by(Product.discount.desc()).limit(6).all()
-    # Hero banners from DB, fallback to hardcoded if none exist
-    banners = BannerSlide.query.filter_by(is_active=True).order_by(
-        BannerSlide.sort_order.asc(), BannerSlide.id.asc()
-    ).all()
-    # Product showcase section ('مجموعة العناية المتطورة') from DB
-    showcase_items = HomeShowcase.query.filter_by(is_active=True).order_by(
-        HomeShowcase.sort_order.asc(), HomeShowcase.id.asc()
-    ).all()
+    categories = cached_categories()
+    home_fragments = {
+        'hero': home_banner_cache.get(_render_home_hero),
+        'sale': home_products_cache.get(_render_home_sale, key='sale'),
+        'latest': home_products_cache.get(_render_home_latest, key='latest'),
+        'showcase': home_showcase_cache.get(_render_home_showcase),
+    }
     return render_template("shop/index.html",
-                           last_products=last_products,
-                           most_viewed=trending_products,
                            categories=categories,
-                           section_id="featured-products",
-                           section_title="أحدث المنتجات",
-                           products=last_products,
-                           sale_products=sale_products,
-                           db_banners=banners,
-                           showcase_items=showcase_items)
+                           home_fragments=home_fragments)
 
 @shop.route('/shop')
 def list():
     page = request.args.get('page', 1, type=int)  # Current page
-    per_page = request.args.get('per_page', 9, type=int)  # Items per page
+    per_page = min(max(request.args.get('per_page', 9, type=int), 1), 60)  # Items per page
     sort = request.args.get('sort', 'default')  # Sorting option
     search = request.args.get('search', '')  # Search query
     category = request.args.get('category', '')  # Category filter
@@ -741,13 +1559,18 @@ def list():
 
     # Base query
     query = Product.query
+    search_hits = None
 
     # Apply filters
     if search:
-      query = query.filter(or_(
-        Product.name.ilike(f'%{search}%'),
-        Product.description.ilike(f'%{search}%')
-      ))
+      search_hits = product_search_hits(search)
+      if search_hits is not None:
+        query = query.join(search_hits, search_hits.c.product_id == Product.id)
+      else:
+        query = query.filter(or_(
+          Product.name.ilike(f'%{search}%'),
+          Product.description.ilike(f'%{search}%')
+        ))
     if category:
       query = query.filter(Product.category_id == category)
     if price:
@@ -768,39 +1591,51 @@ def list():
           # Silently handle invalid price formats
           app.logger.warning(f"Invalid price filter format: {price}")
 
-    # Apply sorting
+    # Apply sorting (each order ends with the primary key so cursors are unique)
+    row_key = None
     if sort == 'name-asc':
-      query = query.order_by(Product.name.asc())
+      order = [(Product.name, False), (Product.id, False)]
     elif sort == 'name-desc':
-      query = query.order_by(Product.name.desc())
+      order = [(Product.name, True), (Product.id, True)]
     elif sort == 'price-asc':
-      query = query.order_by(Product.price.asc())
+      order = [(Product.price, False), (Product.id, False)]
     elif sort == 'price-desc':
-      query = query.order_by(Product.price.desc())
+      order = [(Product.price, True), (Product.id, True)]
     elif sort == 'rating-asc' or sort == 'rating-desc':
       # Handle rating sort by falling back to default sort for now (newest products)
       # This prevents errors when rating is requested but the field doesn't exist
       app.logger.warning(f"Rating sort requested but not implemented. Falling back to default sort.")
-      query = query.order_by(Product.created_at.desc())
+      order = [(Product.created_at, True), (Product.id, True)]
     elif sort == 'model-asc' or sort == 'model-desc':
       # Handle model sort by falling back to default sort
       app.logger.warning(f"Model sort requested but not implemented. Falling back to default sort.")
-      query = query.order_by(Product.created_at.desc())
+      order = [(Product.created_at, True), (Product.id, True)]
+    elif search_hits is not None:
+      # Best full-text matches first; the rank is selected so it can key the cursor
+      query = query.add_columns(search_hits.c.rank)
+      order = [(search_hits.c.rank, False), (Product.id, True)]
+      row_key = lambda row: (row.rank, row.Product.id)
     else:
-      query = query.order_by(Product.created_at.desc())
+      order = [(Product.created_at, True), (Product.id, True)]
 
-    # Pagination
-    paginated_products = query.paginate(page=page, per_page=per_page, error_out=False)
-    products = paginated_products.items
+    # Keyset pagination
+    pagination = keyset_paginate(
+      query, order, per_page,
+      cursor=request.args.get('cursor'), page=page, key=row_key,
+      signature=f'{sort}|{search}|{category}|{price}|{per_page}',
+    )
+    products = pagination.items
+    if row_key is not None:
+      products = [row.Product for row in products]
 
     # Get all categories for the sidebar
-    categories = Category.query.all()
+    categories = cached_categories()
 
     # Render the template with filtered products and pagination data
     return render_template('shop/shop.html', 
                   products=products, 
                   categories=categories, 
-                  pagination=paginated_products,
+                  pagination=pagination,
                   current_filters={
                     'sort': sort,
                     'search': search,
@@ -815,16 +1650,12 @@ def product(product_id):
         abort(404)
     additional_images = AdditionalImage.query.filter_by(product_id=product_id).all()
     additional_data = AdditionalData.query.filter_by(product_id=product_id).all()
-    product.views += 1
-    db.session.commit()
-    random_products = Product.query.order_by(db.func.random()).limit(6).all()
-    return render_template('shop/product.html', product=product, additional_images=additional_images, additional_data=additional_data, products=random_products)
+    record_product_view(product.id)
+    similar_products = related_products(product.id)
+    return render_template('shop/product.html', product=product, additional_images=additional_images, additional_data=additional_data, products=similar_products)
 @shop.route('/cart/add/<int:product_id>', methods=['POST'])
 def add_to_cart(product_id):
     try:
-        # Clean up expired items first
-        cleanup_expired_cart_items()
-        
         # Get product and validate
         product = db.session.get(Product, product_id)
         if not product:
@@ -847,11 +1678,8 @@ def add_to_cart(product_id):
             flash('الكمية المطلوبة غير متوفرة في المخزون', 'danger')
             return redirect(url_for('shop.product', product_id=product_id))
         
-        # Get or create user session
-        user = Gusts.query.filter_by(session=session['session']).first()
-        if not user:
-            flash('حدث خطأ في جلسة المستخدم', 'danger')
-            return redirect(url_for('shop.product', product_id=product_id))
+        # Get or create the guest row (first stateful action of this session)
+        user = get_or_create_guest()
         
         # Check if item exists in cart
         cart_item = Cart.query.filter_by(user_id=user.id, product_id=product_id).first()
@@ -897,15 +1725,13 @@ def add_to_cart(product_id):
 
 @shop.route('/cart/update/<int:item_id>', methods=['POST'])
 def update_cart(item_id):
-    user = Gusts.query.filter_by(session=session['session']).first()
+    user = current_guest()
     if not user:
         return jsonify({'success': False, 'message': 'يرجى تحديث الصفحة'}), 400
-    cart_item = db.session.get(Cart, item_id)
-    if not cart_item:
-        abort(404)
-    product = db.session.get(Product, cart_item.product_id)
-    if not product:
+    cart_item = cart_repository.cart_item(user.id, item_id)
+    if not cart_item or not cart_item.product:
         abort(404)
+    product = cart_item.product
     
     if not request.json:
         return jsonify({'success': False, 'message': 'بيانات غير صحيحة'}), 400
@@ -925,12 +1751,12 @@ def update_cart(item_id):
     return jsonify({
         'success': True,
         'new_total': product.price * new_quantity,
-        'new_subtotal': sum(item.product.price * item.quantity for item in user.carts)
+        'new_subtotal': cart_repository.subtotal(user.id)
     })
 
 @shop.route('/cart/remove/<int:item_id>')
 def remove_from_cart(item_id):
-    user = Gusts.query.filter_by(session=session['session']).first()
+    user = current_guest()
     if not user:
         flash('يرجى تحديث الصفحة', 'danger')
         return redirect(url_for('shop.home'))
@@ -942,41 +1768,236 @@ def remove_from_cart(item_id):
     db.session.commit()
     flash('تم حذف المنتج من السلة', 'success')
     return redirect(url_for('shop.cart'))
+# ─── Cart and order lines ─────────────────────────────────────
+# Pages that walk cart or order lines load them here, each line with its
+# product and the product's category in one joined query, instead of one
+# lazy load per line. Product.image is the first image, so nothing else is
+# needed to render a line. tests/conftest.py's ``query_counter`` keeps the
+# cart and checkout pages at a fixed number of statements.
+
+class CartRepository:
+    """Cart and order lines loaded together with their products."""
+
+    @staticmethod
+    def _with_products(relationship):
+        return joinedload(relationship).joinedload(Product.category)
+
+    def cart_items(self, user_id):
+        """Cart lines of ``user_id``; lines whose product was deleted are removed."""
+        items = (Cart.query.filter_by(user_id=user_id)
+                 .options(self._with_products(Cart.product))
+                 .order_by(Cart.id).all())
+        missing = [item.id for item in items if item.product is None]
+        if missing:
+            Cart.query.filter(Cart.id.in_(missing)).delete(synchronize_session=False)
+            db.session.commit()
+        return [item for item in items if item.product is not None]
+
+    def cart_item(self, user_id, item_id):
+        """One cart line of ``user_id`` with its product, or None."""
+        return (Cart.query.filter_by(id=item_id, user_id=user_id)
+                .options(joinedload(Cart.product)).first())
+
+    def subtotal(self, user_id):
+        """Price of the cart before any offer, summed by the database."""
+        return db.session.scalar(
+            db.select(db.func.coalesce(db.func.sum(Product.price * Cart.quantity), 0))
+            .join(Cart.product)
+            .where(Cart.user_id == user_id)
+        )
+
+    def order_items(self, order_id):
+        """Lines of ``order_id``; ``product`` is None for deleted products."""
+        return (OrderItem.query.filter_by(order_id=order_id)
+                .options(self._with_products(OrderItem.product))
+                .order_by(OrderItem.id).all())
+
+
+cart_repository = CartRepository()
+
 from urllib.parse import quote
 
+# ─── Promotion rules ──────────────────────────────────────────
+# Offers are rows of promotion_rule rather than code. The enabled rules are
+# compiled once per worker into a PromotionEngine of plain namespaces and
+# frozensets, refreshed through the promotions cache version whenever an
+# admin edits a rule, so pricing a cart costs no queries. Date windows are
+# checked on every evaluation, so an offer starts and ends without a refresh.
+
+app.config['PROMOTION_CACHE_TTL'] = int(os.getenv('PROMOTION_CACHE_TTL', '3600'))
+
+PROMOTION_TARGETS = ('items', 'shipping')
+PROMOTION_DISCOUNT_TYPES = ('percent', 'fixed')
+
+
+class PromotionEngine:
+    """Prices carts against a compiled snapshot of the enabled rules.
+
+    Rules are tried in priority order and the first match per target wins,
+    so an offer on shipping never stacks with another shipping offer."""
+
+    def __init__(self, rules):
+        self.rules = tuple(sorted(rules, key=lambda rule: (rule.priority, rule.id)))
+
+    @staticmethod
+    def compile(rule):
+        return SimpleNamespace(
+            id=rule.id,
+            slug=rule.slug,
+            name=rule.name,
+            message=rule.message or None,
+            target=rule.target,
+            discount_type=rule.discount_type,
+            amount=float(rule.amount or 0),
+            product_ids=frozenset(int(product_id) for product_id in rule.product_id_list),
+            city_ids=frozenset(str(city_id) for city_id in rule.city_id_list),
+            starts_at=rule.starts_at,
+            ends_at=rule.ends_at,
+            priority=rule.priority,
+        )
+
+    @staticmethod
+    def discount(rule, amount):
+        """What ``rule`` takes off ``amount``, never more than ``amount`` itself."""
+        if rule.discount_type == 'percent':
+            off = amount * (rule.amount / 100)
+        else:
+            off = rule.amount
+        return min(max(off, 0), amount)
+
+    def evaluate(self, product_ids, subtotal=0.0, city_id=None, shipping=None, now=None):
+        """Apply the first matching rule per target in one pass over the rules.
+
+        ``shipping`` is the base shipping price; leave it None when only the
+        items are being priced (city-bound rules then never match either)."""
+        now = now or datetime.now()
+        product_ids = frozenset(product_ids)
+        city_id = None if city_id is None else str(city_id)
+        applied = {}
+        for rule in self.rules:
+            if rule.target in applied or (rule.target == 'shipping' and shipping is None):
+                continue
+            if (rule.starts_at and now < rule.starts_at) or (rule.ends_at and now > rule.ends_at):
+                continue
+            if not rule.product_ids <= product_ids:
+                continue
+            if rule.city_ids and city_id not in rule.city_ids:
+                continue
+            applied[rule.target] = rule
+            if len(applied) == len(PROMOTION_TARGETS):
+                break
+
+        items_rule = applied.get('items')
+        shipping_rule = applied.get('shipping')
+        items_discount = self.discount(items_rule, subtotal) if items_rule else 0
+        shipping_discount = self.discount(shipping_rule, shipping) if shipping_rule else 0
+        return SimpleNamespace(
+            items_rule=items_rule,
+            items_discount=items_discount,
+            items_total=subtotal - items_discount,
+            shipping_rule=shipping_rule,
+            shipping_discount=shipping_discount,
+            shipping_price=None if shipping is None else shipping - shipping_discount,
+        )
+
+
+promotion_cache = VersionedCache('promotions', 'PROMOTION_CACHE_TTL')
+
+
+def _compile_promotions():
+    rules = PromotionRule.query.filter_by(is_active=True).all()
+    return PromotionEngine(PromotionEngine.compile(rule) for rule in rules)
+
+
+def promotion_engine():
+    """The compiled rules of this worker; ``promotion_cache.invalidate()`` after edits."""
+    return promotion_cache.get(_compile_promotions)
+
+
+def apply_promotions(cart_items, subtotal=0.0, city_id=None, shipping=None):
+    """Price ``cart_items`` (anything with a ``product_id``) with the active offers."""
+    product_ids = {item.product_id for item in cart_items}
+    return promotion_engine().evaluate(product_ids, subtotal, city_id, shipping)
+
+
+# The offers that used to be hardcoded, loaded by ``flask seed-promotions``.
+# Cities are given by name fragments and resolved to city ids when seeding.
+DEFAULT_PROMOTIONS = (
+    {
+        'slug': 'promo_10_jan_2026', 'name': 'خصم 10%', 'message': 'خصم 10% على جميع الطلبات! 🎉',
+        'target': 'items', 'discount_type': 'percent', 'amount': 10,
+        'starts_at': datetime(2026, 1, 4), 'ends_at': datetime(2026, 1, 9, 23, 59, 59), 'priority': 10,
+    },
+    {
+        'slug': 'eid_free_shipping', 'name': 'عرض عيد الأضحى - شحن مجاني',
+        'message': '🎉 شحن مجاني - عرض عيد الأضحى على باقة العناية الكاملة',
+        'target': 'shipping', 'discount_type': 'percent', 'amount': 100, 'product_ids': [4],
+        'city_names': ('الاسكندريه', 'القاهره', 'الجيزه', 'البحيره'),
+        'starts_at': datetime(2025, 6, 5), 'ends_at': datetime(2025, 6, 11, 23, 59, 59), 'priority': 10,
+    },
+    {
+        'slug': 'eid_50_percent', 'name': 'عرض عيد الأضحى - خصم 50% على الشحن',
+        'message': '🎉 خصم 50% على الشحن - عرض عيد الأضحى على باقة العناية الكاملة',
+        'target': 'shipping', 'discount_type': 'percent', 'amount': 50, 'product_ids': [4],
+        'starts_at': datetime(2025, 6, 5), 'ends_at': datetime(2025, 6, 11, 23, 59, 59), 'priority': 20,
+    },
+    {
+        'slug': 'combo_1_2_3', 'name': 'شحن مجاني للمنتجات 1 و2 و3',
+        'message': 'Free shipping - Special offer for products #1, #2, and #3',
+        'target': 'shipping', 'discount_type': 'percent', 'amount': 100, 'product_ids': [1, 2, 3],
+        'priority': 30,
+    },
+)
+
+
+def seed_default_promotions():
+    """Insert the DEFAULT_PROMOTIONS that are missing; return how many were added."""
+    existing = {slug for (slug,) in db.session.execute(db.select(PromotionRule.slug))}
+    cities = db.session.execute(db.select(City.city_id, City.name)).all()
+    added = 0
+    for spec in DEFAULT_PROMOTIONS:
+        if spec['slug'] in existing:
+            continue
+        spec = dict(spec)
+        city_names = spec.pop('city_names', ())
+        city_ids = [str(city_id) for city_id, name in cities
+                    if any(fragment in (name or '') for fragment in city_names)]
+        if city_names and not city_ids:
+            # An empty city set means every city; keep it off until cities exist
+            spec['is_active'] = False
+        spec['product_ids'] = json.dumps(spec.get('product_ids', []))
+        spec['city_ids'] = json.dumps(city_ids)
+        db.session.add(PromotionRule(**spec))
+        added += 1
+    db.session.commit()
+    promotion_cache.invalidate()
+    return added
+
+
+@app.cli.command('seed-promotions')
+def seed_promotions_command():
+    """Load the built-in promotions that are not in the database yet."""
+    print(f'Added {seed_default_promotions()} promotion rule(s)')
+
+
 @shop.route('/checkout')
 def checkout():
-    user = Gusts.query.filter_by(session=session['session']).first()
+    user = current_guest()
     if not user:
-        flash('يرجى تحديث الصفحة', 'danger')
-        return redirect(url_for('shop.home'))
-    
-    # استخدام LEFT JOIN للتعامل مع المنتجات المحذوفة
-    cart_items_query = db.session.query(Cart).outerjoin(Product).filter(Cart.user_id == user.id).all()
-    
-    # تصفية العناصر التي منتجاتها محذوفة
-    cart_items = [item for item in cart_items_query if item.product is not None]
+        # No guest row means nothing was ever added to the cart
+        flash('سلة التسوق فارغة', 'danger')
+        return redirect(url_for('shop.cart'))
     
-    # حذف عناصر السلة للمنتجات المحذوفة
-    deleted_items = [item.id for item in cart_items_query if item.product is None]
-    if deleted_items:
-        Cart.query.filter(Cart.id.in_(deleted_items)).delete(synchronize_session=False)
-        db.session.commit()
+    # Lines with their products; lines of deleted products are dropped
+    cart_items = cart_repository.cart_items(user.id)
     
     if not cart_items:
         flash('سلة التسوق فارغة', 'danger')
         return redirect(url_for('shop.cart'))
 
-    subtotal = sum(item.product.price * item.quantity for item in cart_items)
-
-    # Check for promotional discount (10% off)
-    promo_info = check_promotional_discount()
-    if promo_info['eligible']:
-        discount_amount = subtotal * (promo_info['discount_percent'] / 100)
-        total = subtotal - discount_amount
-    else:
-        discount_amount = 0
-        total = subtotal
+    # Item offers; shipping and promo codes are priced by /api/cart/quote
+    # once the customer picks a city or enters a code
+    cart_quote = quote_cart(cart_items, {item.product_id: item.product for item in cart_items})
 
     cities = City.query.all()
 
@@ -996,83 +2017,131 @@ def checkout():
     return render_template(
         'shop/checkout.html',
         cart_items=cart_items,
-        total=total,
-        subtotal=subtotal,
-        promo_info=promo_info,
-        discount_amount=discount_amount,
+        total=cart_quote.items_total,
+        subtotal=cart_quote.subtotal,
+        promotion=cart_quote.promotion,
+        discount_amount=cart_quote.promotion_discount,
         cities=cities,
         whatsapp_link=whatsapp_link
     )
 
 
-def handle_fawaterak_payment(order):
+# ─── Fawaterak invoices ───────────────────────────────────────
+# A visa order is committed first; its invoice is then claimed with a
+# conditional UPDATE on order.invoice_status, so however often the customer
+# reloads or retries there is at most one invoice call in flight per order
+# and none once invoice_url is stored. The call runs on a small thread pool
+# over the pooled Fawaterak transport while the customer waits on
+# /payment/processing, which polls /payment/status for the invoice URL. A
+# claim whose worker died is taken over once its lease runs out.
+
+app.config['FAWATERAK_INVOICE_WORKERS'] = int(os.getenv('FAWATERAK_INVOICE_WORKERS', '4'))
+app.config['FAWATERAK_INVOICE_LEASE'] = int(os.getenv('FAWATERAK_INVOICE_LEASE', '60'))
+app.config['FAWATERAK_POLL_INTERVAL_MS'] = int(os.getenv('FAWATERAK_POLL_INTERVAL_MS', '1500'))
+
+_invoice_pool = None
+_invoice_pool_lock = threading.Lock()
+
+
+def _invoice_executor():
+    global _invoice_pool
+    with _invoice_pool_lock:
+        if _invoice_pool is None:
+            _invoice_pool = ThreadPoolExecutor(max_workers=app.config['FAWATERAK_INVOICE_WORKERS'],
+                                               thread_name_prefix='fawaterak-invoice')
+        return _invoice_pool
+
+
+def claim_invoice(order_id, retry_failed=False):
+    """Take the invoice of ``order_id`` for this worker; True if it is ours to create.
+
+    Orders that already have an invoice, or whose invoice is being created
+    within the lease, are never claimed twice. Failed invoices are only
+    claimed again when the customer asks for a retry."""
+    now = utc_now()
+    claimable = [Order.invoice_status.is_(None),
+                 db.and_(Order.invoice_status == 'creating',
+                         Order.invoice_requested_at < now - timedelta(seconds=app.config['FAWATERAK_INVOICE_LEASE']))]
+    if retry_failed:
+        claimable.append(Order.invoice_status == 'failed')
+    result = db.session.execute(
+        db.update(Order)
+        .where(Order.id == order_id, Order.payment_method == 'visa', Order.invoice_url.is_(None), or_(*claimable))
+        .values(invoice_status='creating', invoice_requested_at=now, invoice_error=None)
+        .execution_options(synchronize_session=False)
+    )
+    db.session.commit()
+    return result.rowcount == 1
+
+
+def request_invoice(order_id, retry_failed=False):
+    """Start creating the invoice of ``order_id`` in the background unless it already is.
+
+    Call it inside a request: the invoice's redirect URLs use its host."""
+    if not claim_invoice(order_id, retry_failed):
+        return False
+    _invoice_executor().submit(_run_invoice, order_id, request.host_url)
+    return True
+
+
+def _run_invoice(order_id, base_url):
+    with app.app_context():
+        try:
+            create_order_invoice(order_id, base_url)
+        except Exception as e:
+            db.session.rollback()
+            app.logger.error(f'Fawaterak invoice for order #{order_id} failed: {str(e)}')
+            db.session.execute(
+                db.update(Order).where(Order.id == order_id)
+                .values(invoice_status='failed', invoice_error=str(e)[:255])
+                .execution_options(synchronize_session=False)
+            )
+            db.session.commit()
+        finally:
+            db.session.remove()
+
+
+def fawaterak_invoice_payload(order):
+    """The createInvoiceLink body for ``order``; ValueError if it cannot be built."""
     customer_name = order.name.strip().split(maxsplit=1)
-    first_name = customer_name[0]
+    first_name = customer_name[0] if customer_name else ''
     last_name = customer_name[1] if len(customer_name) > 1 else 'N/A'
-
     if not all([first_name, last_name, order.phone]):
-        flash('البيانات الأساسية للعميل غير مكتملة', 'danger')
-        return redirect(url_for('shop.checkout'))
+        raise ValueError('customer name or phone missing')
 
-    order_items = OrderItem.query.filter_by(order_id=order.id).all()
-    shipping_cost = ShippingCost.query.filter_by(city_id=order.city).first()
-    
-    if not shipping_cost:
-        flash('تكلفة الشحن غير متوفرة لهذه المدينة', 'danger')
-        return redirect(url_for('shop.checkout'))
+    base_shipping_price = shipping_quotes.rate(order.city)
+    if base_shipping_price is None:
+        raise ValueError(f'no shipping rate for city {order.city}')
 
-    cart_items = []
+    # Shipping goes first; its price is known once the offers are applied below
+    order_items = cart_repository.order_items(order.id)
+    shipping_line = {"name": "Shipping Cost", "price": None, "quantity": "1"}
+    cart_items = [shipping_line]
     products_total = 0.0
-
-    # Add shipping cost to cart items and total
-    shipping_price = float(shipping_cost.price)
-    cart_items.append({
-        "name": "Shipping Cost",
-        "price": str(round(shipping_price, 2)),
-        "quantity": "1"
-    })
-
-    # Add product items to cart items and total
     for item in order_items:
-        product = db.session.get(Product, item.product_id)
-        if product:
-            try:
-                price = float(product.price)
-                quantity = int(item.quantity)
-            except (ValueError, TypeError):
-                flash('خطأ في بيانات المنتج', 'danger')
-                return redirect(url_for('shop.checkout'))
-
+        if item.product:
+            price = float(item.product.price)
+            quantity = int(item.quantity)
             cart_items.append({
-                "name": product.name[:255],
+                "name": item.product.name[:255],
                 "price": str(round(price, 2)),
                 "quantity": str(quantity)
             })
             products_total += round(price * quantity, 2)
 
-    if not cart_items:
-        flash('سلة التسوق فارغة', 'danger')
-        return redirect(url_for('shop.checkout'))
-
-    # Apply promotional discount (10% off) if eligible
-    promo_info = check_promotional_discount()
-    if promo_info['eligible']:
-        promo_discount = products_total * (promo_info['discount_percent'] / 100)
-        discounted_products_total = products_total - promo_discount
+    # Same offers as the order was placed with, so the invoice matches cod_amount
+    pricing = apply_promotions(order_items, products_total, order.city, base_shipping_price)
+    shipping_line["price"] = str(round(pricing.shipping_price, 2))
+    if pricing.items_rule:
         # Add discount as negative line item for Fawaterak
         cart_items.append({
-            "name": "خصم 10% - عرض خاص",
-            "price": str(round(-promo_discount, 2)),
+            "name": pricing.items_rule.name[:255],
+            "price": str(round(-pricing.items_discount, 2)),
             "quantity": "1"
         })
-        app.logger.info(f"Promotional discount applied to Fawaterak payment: {promo_discount}")
-    else:
-        discounted_products_total = products_total
-
-    cart_total = discounted_products_total + shipping_price
+    cart_total = pricing.items_total + pricing.shipping_price
 
-    # Prepare the payload for Fawaterak
-    payload = {
+    return {
         "cartTotal": str(round(cart_total, 2)),
         "currency": "EGP",
         "customer": {
@@ -1089,223 +2158,428 @@ def handle_fawaterak_payment(order):
             "webhookUrl": url_for('shop.payment_webhook', _external=True)
         },
         "cartItems": cart_items,
+        "payLoad": {"order_id": order.id},
         "sendEmail": False,
         "sendSMS": False
     }
 
-    headers = {
-        'Authorization': f'Bearer {app.config["FAWATERAK_API_KEY"]}',
-        'Content-Type': 'application/json'
-    }
 
-    app.logger.debug("Fawaterak Payload:")
-    app.logger.debug(json.dumps(payload, indent=2))
+def create_order_invoice(order_id, base_url):
+    """Call Fawaterak for a claimed order and store the invoice on it."""
+    order = db.session.get(Order, order_id)
+    # Runs outside the customer's request; rebuild its host for the redirect URLs
+    with app.test_request_context(base_url=base_url):
+        payload = fawaterak_invoice_payload(order)
+    app.logger.debug(f"Fawaterak payload for order #{order_id}: {json.dumps(payload)}")
+
+    invoice = fawaterak_service.create_invoice(payload)
+    order.invoice_key = invoice['invoiceKey']
+    order.invoice_id = str(invoice['invoiceId'])
+    order.invoice_url = invoice['url']
+    order.invoice_status = 'ready'
+    order.invoice_error = None
+    db.session.commit()
+    return order
 
-    try:
-        response = requests.post(
-            app.config['FAWATERAK_API_URL'],
-            headers=headers,
-            json=payload,
-            timeout=10
-        )
 
-        if not response.ok:
-            app.logger.error(f"Fawaterak API Error: {response.status_code} - {response.text}")
-            response.raise_for_status()
+# ─── Notification outbox ──────────────────────────────────────
+# Checkout only inserts a NotificationOutbox row inside the order transaction;
+# the housekeeping thread (or `flask drain-notifications` in its own process)
+# delivers it later with exponential backoff, so a slow or unavailable
+# webhook never delays the customer. Entries that keep failing are parked as
+# 'dead' for an admin to inspect and retry.
+
+app.config['NOTIFICATION_OUTBOX_INTERVAL'] = int(os.getenv('NOTIFICATION_OUTBOX_INTERVAL', '10'))
+app.config['NOTIFICATION_BATCH_SIZE'] = int(os.getenv('NOTIFICATION_BATCH_SIZE', '20'))
+app.config['NOTIFICATION_SEND_TIMEOUT'] = int(os.getenv('NOTIFICATION_SEND_TIMEOUT', '10'))
+app.config['NOTIFICATION_MAX_ATTEMPTS'] = int(os.getenv('NOTIFICATION_MAX_ATTEMPTS', '8'))
+app.config['NOTIFICATION_RETRY_BASE'] = int(os.getenv('NOTIFICATION_RETRY_BASE', '30'))
+app.config['NOTIFICATION_RETRY_MAX'] = int(os.getenv('NOTIFICATION_RETRY_MAX', '3600'))
+app.config['NOTIFICATION_RETENTION_DAYS'] = int(os.getenv('NOTIFICATION_RETENTION_DAYS', '7'))
+
+
+def queue_notification(channel, payload):
+    """Add a notification to the current transaction; it is sent after commit."""
+    entry = NotificationOutbox(channel=channel, payload=json.dumps(payload, ensure_ascii=False))
+    db.session.add(entry)
+    return entry
+
+
+def _send_discord(payload):
+    webhook_url = os.getenv('DISCORD_WEBHOOK_URL', '')
+    if not webhook_url:
+        raise RuntimeError('DISCORD_WEBHOOK_URL is not configured')
+    response = requests.post(webhook_url, json=payload,
+                             timeout=app.config['NOTIFICATION_SEND_TIMEOUT'])
+    if response.status_code >= 300:
+        raise RuntimeError(f'Discord returned {response.status_code}: {response.text[:200]}')
+
+
+NOTIFICATION_SENDERS = {
+    'discord': _send_discord,
+}
 
-        fawaterak_data = response.json()
-        if fawaterak_data.get('status') != 'success':
-            app.logger.error(f"Fawaterak API Error: {fawaterak_data}")
-            flash('فشل في إنشاء فاتورة الدفع', 'danger')
-            return redirect(url_for('shop.checkout'))
 
-        order.invoice_key = fawaterak_data['data']['invoiceKey']
-        order.invoice_id = fawaterak_data['data']['invoiceId']
-        order.invoice_url = fawaterak_data['data']['url']
+def notification_retry_delay(attempts):
+    """Seconds to wait after the ``attempts``-th failure: doubling, capped, jittered."""
+    delay = min(app.config['NOTIFICATION_RETRY_MAX'],
+                app.config['NOTIFICATION_RETRY_BASE'] * 2 ** (attempts - 1))
+    return random.uniform(delay / 2, delay)
+
+
+def _claim_notification(entry_id, now):
+    """Take ``entry_id`` for this worker by pushing its due time past the send.
+
+    Several workers drain the same table; the conditional UPDATE lets exactly
+    one of them win. If the winner dies mid-send the lease simply runs out and
+    the entry is retried."""
+    lease = timedelta(seconds=app.config['NOTIFICATION_SEND_TIMEOUT'] * 3)
+    result = db.session.execute(
+        db.update(NotificationOutbox)
+        .where(NotificationOutbox.id == entry_id,
+               NotificationOutbox.status == 'pending',
+               NotificationOutbox.next_attempt_at <= now)
+        .values(next_attempt_at=now + lease, attempts=NotificationOutbox.attempts + 1)
+        .execution_options(synchronize_session=False)
+    )
+    db.session.commit()
+    return result.rowcount == 1
+
+
+@housekeeping_task('notification_outbox', 'NOTIFICATION_OUTBOX_INTERVAL')
+def drain_notification_outbox():
+    """Deliver due outbox entries; return how many were sent."""
+    now = utc_now()
+    due_ids = db.session.execute(
+        db.select(NotificationOutbox.id)
+        .where(NotificationOutbox.status == 'pending', NotificationOutbox.next_attempt_at <= now)
+        .order_by(NotificationOutbox.next_attempt_at, NotificationOutbox.id)
+        .limit(app.config['NOTIFICATION_BATCH_SIZE'])
+    ).scalars().all()
+
+    sent = 0
+    for entry_id in due_ids:
+        if not _claim_notification(entry_id, now):
+            continue
+        entry = db.session.get(NotificationOutbox, entry_id)
+        try:
+            NOTIFICATION_SENDERS[entry.channel](json.loads(entry.payload))
+        except Exception as e:
+            entry.last_error = str(e)[:1000]
+            if entry.attempts >= app.config['NOTIFICATION_MAX_ATTEMPTS']:
+                entry.status = 'dead'
+                app.logger.error(f'Notification #{entry.id} ({entry.channel}) gave up after '
+                                 f'{entry.attempts} attempts: {entry.last_error}')
+            else:
+                entry.next_attempt_at = utc_now() + timedelta(seconds=notification_retry_delay(entry.attempts))
+        else:
+            entry.status = 'sent'
+            entry.sent_at = utc_now()
+            entry.last_error = None
+            sent += 1
         db.session.commit()
 
-        return redirect(fawaterak_data['data']['url'])
+    cutoff = now - timedelta(days=app.config['NOTIFICATION_RETENTION_DAYS'])
+    NotificationOutbox.query.filter(
+        NotificationOutbox.status == 'sent', NotificationOutbox.sent_at < cutoff
+    ).delete(synchronize_session=False)
+    db.session.commit()
+    return sent
+
 
-    except requests.exceptions.RequestException as e:
-        app.logger.error(f"Fawaterak API Request Failed: {e}")
-        flash('فشل في الاتصال بخدمة الدفع، الرجاء المحاولة مرة أخرى', 'danger')
-        return redirect(url_for('shop.checkout'))
+def notification_outbox_stats():
+    """Entry counts per status plus the most recent dead letters."""
+    counts = dict(db.session.execute(
+        db.select(NotificationOutbox.status, db.func.count(NotificationOutbox.id))
+        .group_by(NotificationOutbox.status)
+    ).all())
+    dead = NotificationOutbox.query.filter_by(status='dead').order_by(
+        NotificationOutbox.id.desc()).limit(20).all()
+    return {
+        'counts': {status: counts.get(status, 0) for status in ('pending', 'sent', 'dead')},
+        'dead': [entry.to_dict() for entry in dead],
+    }
+
+
+@app.cli.command('drain-notifications')
+@click.option('--loop', is_flag=True, help='Keep draining instead of making a single pass.')
+def drain_notifications_command(loop):
+    """Send pending outbox notifications (for running outside the web workers)."""
+    if not loop:
+        print(f'Sent {drain_notification_outbox()} notifications')
+        return
+    while True:
+        try:
+            drain_notification_outbox()
+        except Exception as e:
+            db.session.rollback()
+            app.logger.error(f'Error draining notification outbox: {str(e)}')
+        finally:
+            db.session.remove()
+        time.sleep(app.config['NOTIFICATION_OUTBOX_INTERVAL'])
+
+
+def discord_order_message(order, order_items, products, shipping_price, city_name):
+    """Build the professional bilingual Discord webhook body for an order.
+
+    ``products`` maps product id to the rows already loaded by checkout."""
+    # Calculate order totals and build product details
+    total_amount = 0
+    total_items = 0
+    product_details_ar = []
+    product_details_en = []
     
-def send_discord_notification(order, order_items):
-    """Send professional bilingual order notification to Discord webhook"""
-    try:
-        webhook_url = os.getenv('DISCORD_WEBHOOK_URL', '')
-        if not webhook_url:
-            return  # Skip notification if webhook not configured
-        
-        # Get shipping cost and city info
-        shipping_cost = ShippingCost.query.filter_by(city_id=order.city).first()
-        shipping_price = shipping_cost.price if shipping_cost else 0
-        city = City.query.filter_by(city_id=order.city).first()
-        city_name = city.name if city else "Unknown City"
-        
-        # Calculate order totals and build product details
-        total_amount = 0
-        total_items = 0
-        product_details_ar = []
-        product_details_en = []
-        
-        # Enhanced product emoji mapping
-        product_emojis = {
-            'زيت': '🌿', 'oil': '🌿',
-            'سبراي': '💨', 'spray': '💨',
-            'سيروم': '✨', 'serum': '✨',
-            'كريم': '🧴', 'cream': '🧴',
-            'شامبو': '🧴', 'shampoo': '🧴',
-            'بلسم': '💧', 'conditioner': '💧',
-            'ماسك': '🎭', 'mask': '🎭',
-            'لوشن': '🧴', 'lotion': '🧴'
-        }
-        
-        for item in order_items:
-            product = db.session.get(Product, item.product_id)
-            if product:
-                item_total = product.price * item.quantity
-                total_amount += item_total
-                total_items += item.quantity
-                
-                # Get appropriate emoji for product
-                product_emoji = '🛍️'
-                product_name_lower = product.name.lower()
-                for key, emoji in product_emojis.items():
-                    if key in product_name_lower:
-                        product_emoji = emoji
-                        break
-                
-                # Arabic product details
-                product_details_ar.append(
-                    f"{product_emoji} **{product.name}**\n"
-                    f"   └ الكمية: `{item.quantity}` × `{product.price:.0f} EGP` = **{item_total:.0f} EGP**"
-                )
-                
-                # English product details
-                product_details_en.append(
-                    f"{product_emoji} **{product.name}**\n"
-                    f"   └ Qty: `{item.quantity}` × `{product.price:.0f} EGP` = **{item_total:.0f} EGP**"
-                )
-        
-        total_with_shipping = total_amount + shipping_price
-        
-        # Enhanced payment method formatting with better colors
-        payment_info = {
-            'visa': {'emoji': '💳', 'text_ar': 'بطاقة ائتمان', 'text_en': 'Credit Card', 'color': 0x4285f4},
-            'vodafone_cash': {'emoji': '📱', 'text_ar': 'فودافون كاش', 'text_en': 'Vodafone Cash', 'color': 0xe60000},
-            'cash_on_delivery': {'emoji': '💵', 'text_ar': 'الدفع عند الاستلام', 'text_en': 'Cash on Delivery', 'color': 0x34a853},
-            'cod': {'emoji': '💵', 'text_ar': 'الدفع عند الاستلام', 'text_en': 'Cash on Delivery', 'color': 0x34a853}
-        }
-        
-        payment_method = order.payment_method if order.payment_method in payment_info else 'cod'
-        payment = payment_info[payment_method]
-        
-        # WhatsApp and admin links
-        phone_clean = order.phone.replace(" ", "").replace("+", "")
-        if not phone_clean.startswith("2"):
-            phone_clean = "2" + phone_clean
-        whatsapp_link = f"https://wa.me/{phone_clean}"
-        admin_url = os.getenv('ADMIN_URL', '/admin/orders')
-        
-        # Create professional Discord embed with bilingual content
-        embed = {
-            "title": f"🎉 New Order Received! | طلب جديد وصل! #{order.id}",
-            "description": (
-                f"### 🌟 A new customer has placed an order for our premium products!\n"
-                f"### عميل جديد قام بطلب منتجاتنا المميزة!\n\n"
-                f"> 💼 **[Order Management | إدارة الطلبات]({admin_url})**\n"
-                f"> 📱 **[WhatsApp Contact | تواصل واتساب]({whatsapp_link})**"
-            ),
-            "color": payment['color'],
-            "fields": [
-                {
-                    "name": "👤 Customer Information | بيانات العميل",
-                    "value": (
-                        f"```yaml\n"
-                        f"Name     | الاسم    : {order.name}\n"
-                        f"Phone    | الهاتف   : {order.phone}\n"
-                        f"Email    | الإيميل  : {order.email or 'Not provided | غير متوفر'}\n"
-                        f"City     | المدينة  : {city_name}\n"
-                        f"Address  | العنوان  : {order.address}\n"
-                        f"```"
-                    ),
-                    "inline": False
-                },
-                {
-                    "name": "🛒 Order Items | منتجات الطلب",
-                    "value": "\n".join(product_details_en) if product_details_en else "❌ No products found",
-                    "inline": False
-                },
-                {
-                    "name": "💰 Financial Summary | الملخص المالي",
-                    "value": (
-                        f"```diff\n"
-                        f"+ Products Value | قيمة المنتجات: {total_amount:.0f} EGP\n"
-                        f"+ Shipping Cost | رسوم الشحن   : {shipping_price:.0f} EGP\n"
-                        f"- - - - - - - - - - - - - - - - - - - - - - - -\n"
-                        f"= Total Amount  | الإجمالي      : {total_with_shipping:.0f} EGP\n"
-                        f"```"
-                    ),
-                    "inline": True
-                },
-                {
-                    "name": "📊 Order Details | تفاصيل الطلب",
-                    "value": (
-                        f"{payment['emoji']} **Payment | الدفع:** {payment['text_en']} | {payment['text_ar']}\n"
-                        f"📦 **Items Count | عدد القطع:** {total_items}\n"
-                        f"🕐 **Time | التوقيت:** {order.created_at.strftime('%d/%m/%Y - %H:%M')}\n"
-                        f"🆔 **Order ID | رقم الطلب:** `#{order.id}`\n"
-                        f"🏪 **Store | المتجر:** Al Hamd"
-                    ),
-                    "inline": True
-                }
-            ],
-            "thumbnail": {
-                "url": os.getenv('LOGO_URL', '/static/img/logo.png')
+    # Enhanced product emoji mapping
+    product_emojis = {
+        'زيت': '🌿', 'oil': '🌿',
+        'سبراي': '💨', 'spray': '💨',
+        'سيروم': '✨', 'serum': '✨',
+        'كريم': '🧴', 'cream': '🧴',
+        'شامبو': '🧴', 'shampoo': '🧴',
+        'بلسم': '💧', 'conditioner': '💧',
+        'ماسك': '🎭', 'mask': '🎭',
+        'لوشن': '🧴', 'lotion': '🧴'
+    }
+    
+    for item in order_items:
+        product = products.get(item.product_id)
+        if product:
+            item_total = product.price * item.quantity
+            total_amount += item_total
+            total_items += item.quantity
+            
+            # Get appropriate emoji for product
+            product_emoji = '🛍️'
+            product_name_lower = product.name.lower()
+            for key, emoji in product_emojis.items():
+                if key in product_name_lower:
+                    product_emoji = emoji
+                    break
+            
+            # Arabic product details
+            product_details_ar.append(
+                f"{product_emoji} **{product.name}**\n"
+                f"   └ الكمية: `{item.quantity}` × `{product.price:.0f} EGP` = **{item_total:.0f} EGP**"
+            )
+            
+            # English product details
+            product_details_en.append(
+                f"{product_emoji} **{product.name}**\n"
+                f"   └ Qty: `{item.quantity}` × `{product.price:.0f} EGP` = **{item_total:.0f} EGP**"
+            )
+    
+    total_with_shipping = total_amount + shipping_price
+    
+    # Enhanced payment method formatting with better colors
+    payment_info = {
+        'visa': {'emoji': '💳', 'text_ar': 'بطاقة ائتمان', 'text_en': 'Credit Card', 'color': 0x4285f4},
+        'vodafone_cash': {'emoji': '📱', 'text_ar': 'فودافون كاش', 'text_en': 'Vodafone Cash', 'color': 0xe60000},
+        'cash_on_delivery': {'emoji': '💵', 'text_ar': 'الدفع عند الاستلام', 'text_en': 'Cash on Delivery', 'color': 0x34a853},
+        'cod': {'emoji': '💵', 'text_ar': 'الدفع عند الاستلام', 'text_en': 'Cash on Delivery', 'color': 0x34a853}
+    }
+    
+    payment_method = order.payment_method if order.payment_method in payment_info else 'cod'
+    payment = payment_info[payment_method]
+    
+    # WhatsApp and admin links
+    phone_clean = order.phone.replace(" ", "").replace("+", "")
+    if not phone_clean.startswith("2"):
+        phone_clean = "2" + phone_clean
+    whatsapp_link = f"https://wa.me/{phone_clean}"
+    admin_url = os.getenv('ADMIN_URL', '/admin/orders')
+    
+    # Create professional Discord embed with bilingual content
+    embed = {
+        "title": f"🎉 New Order Received! | طلب جديد وصل! #{order.id}",
+        "description": (
+            f"### 🌟 A new customer has placed an order for our premium products!\n"
+            f"### عميل جديد قام بطلب منتجاتنا المميزة!\n\n"
+            f"> 💼 **[Order Management | إدارة الطلبات]({admin_url})**\n"
+            f"> 📱 **[WhatsApp Contact | تواصل واتساب]({whatsapp_link})**"
+        ),
+        "color": payment['color'],
+        "fields": [
+            {
+                "name": "👤 Customer Information | بيانات العميل",
+                "value": (
+                    f"```yaml\n"
+                    f"Name     | الاسم    : {order.name}\n"
+                    f"Phone    | الهاتف   : {order.phone}\n"
+                    f"Email    | الإيميل  : {order.email or 'Not provided | غير متوفر'}\n"
+                    f"City     | المدينة  : {city_name}\n"
+                    f"Address  | العنوان  : {order.address}\n"
+                    f"```"
+                ),
+                "inline": False
             },
-            "image": {
-                "url": os.getenv('LOGO_URL', '/static/img/logo.png')
+            {
+                "name": "🛒 Order Items | منتجات الطلب",
+                "value": "\n".join(product_details_en) if product_details_en else "❌ No products found",
+                "inline": False
             },
-            "timestamp": utc_now().isoformat(),
-            "footer": {
-                "text": "💎 Al Hamd - Premium Products | منتجات مميزة",
-                "icon_url": os.getenv('LOGO_URL', '/static/img/logo.png')
+            {
+                "name": "💰 Financial Summary | الملخص المالي",
+                "value": (
+                    f"```diff\n"
+                    f"+ Products Value | قيمة المنتجات: {total_amount:.0f} EGP\n"
+                    f"+ Shipping Cost | رسوم الشحن   : {shipping_price:.0f} EGP\n"
+                    f"- - - - - - - - - - - - - - - - - - - - - - - -\n"
+                    f"= Total Amount  | الإجمالي      : {total_with_shipping:.0f} EGP\n"
+                    f"```"
+                ),
+                "inline": True
             },
-            "author": {
-                "name": "Order Management System | نظام إدارة الطلبات",
-                "icon_url": os.getenv('LOGO_URL', '/static/img/logo.png'),
-                "url": admin_url
+            {
+                "name": "📊 Order Details | تفاصيل الطلب",
+                "value": (
+                    f"{payment['emoji']} **Payment | الدفع:** {payment['text_en']} | {payment['text_ar']}\n"
+                    f"📦 **Items Count | عدد القطع:** {total_items}\n"
+                    f"🕐 **Time | التوقيت:** {order.created_at.strftime('%d/%m/%Y - %H:%M')}\n"
+                    f"🆔 **Order ID | رقم الطلب:** `#{order.id}`\n"
+                    f"🏪 **Store | المتجر:** Al Hamd"
+                ),
+                "inline": True
             }
+        ],
+        "thumbnail": {
+            "url": os.getenv('LOGO_URL', '/static/img/logo.png')
+        },
+        "image": {
+            "url": os.getenv('LOGO_URL', '/static/img/logo.png')
+        },
+        "timestamp": utc_now().isoformat(),
+        "footer": {
+            "text": "💎 Al Hamd - Premium Products | منتجات مميزة",
+            "icon_url": os.getenv('LOGO_URL', '/static/img/logo.png')
+        },
+        "author": {
+            "name": "Order Management System | نظام إدارة الطلبات",
+            "icon_url": os.getenv('LOGO_URL', '/static/img/logo.png'),
+            "url": admin_url
         }
-        
-        # Create the complete professional message
-        message = {
-            "username": "🌟 Al Hamd",
-            "avatar_url": "https://k.top4top.io/p_3515e1v1u1.png",
-            "content": (
-                f"@everyone 🔔 **NEW ORDER ALERT | تنبيه طلب جديد**\n"
-                f"📋 **Order #{order.id}** | **Customer:** {order.name} | **Amount:** {total_with_shipping:.0f} EGP\n"
-                f"🎯 **Payment:** {payment['text_en']} | {payment['text_ar']}"
-            ),
-            "embeds": [embed]
-        }
-        
-        # Send to Discord
-        response = requests.post(
-            webhook_url,
-            json=message,
-            headers={'Content-Type': 'application/json'}
-        )
-        
-        if response.status_code == 204:
-            app.logger.info(f"Professional Discord notification sent successfully for order #{order.id}")
-        else:
-            app.logger.error(f"Discord notification failed: {response.status_code} - {response.text}")
-            
+    }
+    
+    # Create the complete professional message
+    message = {
+        "username": "🌟 Al Hamd",
+        "avatar_url": "https://k.top4top.io/p_3515e1v1u1.png",
+        "content": (
+            f"@everyone 🔔 **NEW ORDER ALERT | تنبيه طلب جديد**\n"
+            f"📋 **Order #{order.id}** | **Customer:** {order.name} | **Amount:** {total_with_shipping:.0f} EGP\n"
+            f"🎯 **Payment:** {payment['text_en']} | {payment['text_ar']}"
+        ),
+        "embeds": [embed]
+    }
+    return message
+
+
+def queue_order_notification(order, order_items, products, shipping_price):
+    """Add the new-order Discord alert to the outbox; the caller commits."""
+    if not os.getenv('DISCORD_WEBHOOK_URL', ''):
+        return None  # Skip notification if webhook not configured
+    try:
+        message = discord_order_message(order, order_items, products, shipping_price,
+                                        shipping_quotes.city_name(order.city, "Unknown City"))
     except Exception as e:
-        app.logger.error(f"Error sending Discord notification: {str(e)}")
+        # A formatting bug must never cost us the order itself
+        app.logger.error(f"Error building Discord notification: {str(e)}")
+        return None
+    return queue_notification('discord', message)
+
+# ─── Order placement ──────────────────────────────────────────
+# place_order() writes the order, its items, stock reservations, promo code
+# use and cart cleanup in one transaction. Counters are decremented with
+# conditional UPDATEs whose rowcount says whether the reservation won, so two
+# concurrent checkouts can never both take the last unit.
+
+class CheckoutError(Exception):
+    """Checkout cannot go ahead; the message is shown to the customer."""
+
+
+def load_cart_products(cart_items):
+    """Map product id -> Product for ``cart_items`` with a single IN query."""
+    product_ids = {item.product_id for item in cart_items}
+    if not product_ids:
+        return {}
+    return {product.id: product for product in Product.query.filter(Product.id.in_(product_ids))}
+
+
+def reserve_stock(product, quantity):
+    """Take ``quantity`` units of ``product`` or raise ``CheckoutError``."""
+    result = db.session.execute(
+        db.update(Product)
+        .where(Product.id == product.id, Product.stock >= quantity)
+        .values(stock=Product.stock - quantity)
+        .execution_options(synchronize_session=False)
+    )
+    if result.rowcount != 1:
+        raise CheckoutError(f'الكمية المتاحة من {product.name} غير كافية')
+
+
+def redeem_promo_code(code):
+    """Use up one redemption of ``code``; return its discount percent or None."""
+    promo_code = PromoCode.query.filter_by(code=code).first()
+    if not promo_code:
+        return None
+    result = db.session.execute(
+        db.update(PromoCode)
+        .where(PromoCode.id == promo_code.id, PromoCode.count > 0)
+        .values(count=PromoCode.count - 1)
+        .execution_options(synchronize_session=False)
+    )
+    return promo_code.discount if result.rowcount == 1 else None
+
+
+def check_promo_code(code):
+    """Look ``code`` up without using it; return (PromoCode or None, message, status)."""
+    if not code:
+        return None, 'الرجاء إدخال كود الخصم', 400
+    promo_code = PromoCode.query.filter_by(code=code).first()
+    if not promo_code:
+        return None, 'كود الخصم غير صحيح', 404
+    if promo_code.count <= 0:
+        return None, 'كود الخصم منتهي الصلاحية', 410
+    return promo_code, f'تم تطبيق خصم {promo_code.discount:.0f}%!', 200
+
+
+def quote_cart(cart_items, products, city_id=None, promo_code='', redeem=False):
+    """Price a cart exactly the way ``place_order()`` charges it.
+
+    ``products`` maps product id -> Product (see ``load_cart_products``).
+    Shipping is only priced when ``city_id`` is given; ``shipping`` and
+    ``total`` stay None when that city has no rate. With ``redeem`` the promo
+    code is used up inside the caller's transaction instead of just checked."""
+    subtotal = sum(products[item.product_id].price * item.quantity for item in cart_items)
+    base_shipping = shipping_quotes.rate(city_id) if city_id else None
+    pricing = apply_promotions(cart_items, subtotal, city_id, base_shipping)
+
+    code = (promo_code or '').strip().upper()
+    promo_percent, promo_message = None, None
+    if code and redeem:
+        promo_percent = redeem_promo_code(code)
+    elif code:
+        promo, promo_message, _ = check_promo_code(code)
+        promo_percent = promo.discount if promo else None
+    items_total = pricing.items_total
+    promo_code_discount = items_total * (promo_percent / 100) if promo_percent is not None else 0
+    items_total -= promo_code_discount
+
+    shipping = pricing.shipping_price
+    return SimpleNamespace(
+        subtotal=subtotal,
+        promotion=pricing.items_rule,
+        promotion_discount=pricing.items_discount,
+        promo_code=code or None,
+        promo_code_percent=promo_percent,
+        promo_code_discount=promo_code_discount,
+        promo_code_message=promo_message,
+        items_total=items_total,
+        base_shipping=base_shipping,
+        shipping_rule=pricing.shipping_rule,
+        shipping_discount=pricing.shipping_discount,
+        shipping=shipping,
+        total=None if shipping is None else items_total + shipping,
+    )
 
 @shop.route('/checkout/place_order', methods=['POST'])
 def place_order():
@@ -1318,10 +2592,10 @@ def place_order():
             return redirect(url_for('shop.checkout'))
 
         # 2. Get user and validate cart
-        user = Gusts.query.filter_by(session=session['session']).first()
+        user = current_guest()
         if not user:
-            flash('حدث خطأ في جلسة المستخدم', 'danger')
-            return redirect(url_for('shop.checkout'))
+            flash('سلة التسوق فارغة', 'danger')
+            return redirect(url_for('shop.cart'))
 
         cart_items = Cart.query.filter_by(user_id=user.id).all()
         if not cart_items:
@@ -1335,71 +2609,34 @@ def place_order():
             flash('طريقة الدفع المختارة غير متاحة', 'danger')
             return redirect(url_for('shop.checkout'))
 
-        # 4. Get and validate shipping cost
-        shipping_cost = ShippingCost.query.filter_by(city_id=request.form['city']).first()
-        if not shipping_cost:
+        # 4. The chosen city must have a shipping rate
+        if shipping_quotes.rate(request.form['city']) is None:
             flash('تكلفة الشحن غير متوفرة لهذه المدينة', 'danger')
             return redirect(url_for('shop.checkout'))
 
-        # 5. Calculate product total server-side (secure calculation)
-        product_subtotal = 0
-        for item in cart_items:
-            product = db.session.get(Product, item.product_id)
-            if product:
-                product_subtotal += product.price * item.quantity
-
-        # Apply promotional discount (10% off) if eligible
-        promo_info = check_promotional_discount()
-        if promo_info['eligible']:
-            promo_discount = product_subtotal * (promo_info['discount_percent'] / 100)
-            product_total = product_subtotal - promo_discount
-            app.logger.info(f"Promotional discount applied: {promo_info['discount_percent']}% off - saved {promo_discount}")
-        else:
-            product_total = product_subtotal
-
-        # Apply promo code discount if provided
-        promo_code_input = (request.form.get('promo_code') or '').strip().upper()
-        if promo_code_input:
-            promo_code_obj = PromoCode.query.filter_by(code=promo_code_input).first()
-            if promo_code_obj and promo_code_obj.count > 0:
-                promo_code_discount = product_total * (promo_code_obj.discount / 100)
-                product_total -= promo_code_discount
-                promo_code_obj.count -= 1
-                app.logger.info(f"Promo code '{promo_code_input}' applied: {promo_code_obj.discount}% off")
-
-        # 6. Check stock availability
-        for cart_item in cart_items:
-            product = db.session.get(Product, cart_item.product_id)
-            if not product:
-                flash(f'المنتج غير موجود', 'danger')
-                return redirect(url_for('shop.cart'))
-            
-            if product.stock < cart_item.quantity:
-                flash(f'الكمية المتاحة من {product.name} غير كافية', 'danger')
-                return redirect(url_for('shop.cart'))
+        # 5. Every product in the cart must still exist
+        products = load_cart_products(cart_items)
+        if any(item.product_id not in products for item in cart_items):
+            flash(f'المنتج غير موجود', 'danger')
+            return redirect(url_for('shop.cart'))
 
-        # 7. Check for Eid Al-Adha shipping offer first (takes priority)
-        eid_offer_info = check_eid_shipping_offer(cart_items, request.form['city'])
-        
-        # 8. Check for regular shipping discount eligibility
-        discount_info = check_shipping_discount(cart_items)
-        
-        # 9. Calculate shipping cost (with Eid offer or regular discount if applicable)
-        if eid_offer_info['eligible']:
-            # Apply Eid offer discount
-            discount_amount = shipping_cost.price * eid_offer_info['discount']
-            shipping_price = shipping_cost.price - discount_amount
-            app.logger.info(f"Eid Al-Adha offer applied - discount: {eid_offer_info['discount']*100}%, offer type: {eid_offer_info['offer_type']}")
-        elif discount_info['eligible']:
-            # Free shipping if regular discount is eligible
-            shipping_price = 0
-            app.logger.info(f"Free shipping applied for order - discount type: {discount_info['discount_type']}")
-        else:
-            # Regular shipping cost
-            shipping_price = shipping_cost.price
+        # 6. Price server-side with the same code path as /api/cart/quote;
+        # a promo code is used up atomically here
+        cart_quote = quote_cart(cart_items, products, request.form['city'],
+                                request.form.get('promo_code'), redeem=True)
+        if cart_quote.promotion:
+            app.logger.info(f"Promotion {cart_quote.promotion.slug} applied: saved {cart_quote.promotion_discount}")
+        if cart_quote.promo_code_percent is not None:
+            app.logger.info(f"Promo code '{cart_quote.promo_code}' applied: {cart_quote.promo_code_percent}% off")
+        if cart_quote.shipping_rule:
+            app.logger.info(f"Shipping offer applied - {cart_quote.shipping_rule.slug}: {cart_quote.shipping_discount} off")
 
-        # 9. Calculate final total
-        total_amount = product_total + shipping_price
+        # 7. Reserve stock; fails if another checkout took the last units
+        for cart_item in sorted(cart_items, key=lambda item: item.product_id):
+            reserve_stock(products[cart_item.product_id], cart_item.quantity)
+
+        # 8. Final total, shipping offers included
+        total_amount = cart_quote.total
 
         # 10. Create order
         order = Order(
@@ -1416,14 +2653,14 @@ def place_order():
             status='pending'
         )
 
-        # 11. Add order to session and commit to get the order ID
+        # 11. Flush (not commit) to get the order ID inside the same transaction
         db.session.add(order)
-        db.session.commit()
+        db.session.flush()
 
-        # 12. Create order items and update stock
+        # 12. Create order items and empty the cart
         order_items = []
+        cart_lines = []
         for cart_item in cart_items:
-            product = db.session.get(Product, cart_item.product_id)
             order_item = OrderItem(
                 order_id=order.id,
                 product_id=cart_item.product_id,
@@ -1431,29 +2668,26 @@ def place_order():
             )
             order_items.append(order_item)
             db.session.add(order_item)
-            
-            # Update product stock
-            product.stock -= cart_item.quantity
-            
-            # Delete cart item
+            cart_lines.append((products[cart_item.product_id].name, cart_item.quantity))
             db.session.delete(cart_item)
 
-        # 13. Commit all changes
-        db.session.commit()
+        # 13. Queue the Discord alert; it is sent in the background after commit
+        queue_order_notification(order, order_items, products, cart_quote.base_shipping)
 
-        # 14. Send Discord notification
-        send_discord_notification(order, order_items)
+        # 14. Commit order, items, stock, promo code, cart and notification together
+        db.session.commit()
 
-        # 15. Handle payment method
+        # 15. Handle payment method; the invoice is created in the background
         if payment_method == 'visa':
-            return handle_fawaterak_payment(order)
+            request_invoice(order.id)
+            return redirect(url_for('shop.payment_processing', order_id=order.id))
 
         flash('تم إنشاء الطلب بنجاح!', 'success')
         # if payment method is vodafone cash
         admin_phone = os.getenv('ADMIN_PHONE', '')
         message_lines = ["السلام عليكم، انا عاوز اشتري:"]
-        for item in cart_items:
-            message_lines.append(f"- {item.product.name} × {item.quantity}")
+        for product_name, quantity in cart_lines:
+            message_lines.append(f"- {product_name} × {quantity}")
         message_lines.append("\nمن موقع Al Hamd، وعاوز ادفع بالمحافظ الإلكترونية.")
         full_message = "\n".join(message_lines)
         encoded_message = quote(full_message)
@@ -1462,6 +2696,10 @@ def place_order():
             return redirect(whatsapp_link)
         return redirect(url_for('shop.order_confirmation', order_id=order.id))
 
+    except CheckoutError as e:
+        db.session.rollback()
+        flash(str(e), 'danger')
+        return redirect(url_for('shop.cart'))
     except Exception as e:
         db.session.rollback()
         app.logger.error(f'Error in place_order: {str(e)}')
@@ -1472,9 +2710,9 @@ def place_order():
 @shop.route('/order_confirmation')
 def order_confirmation():
     # get gusts session
-    user = Gusts.query.filter_by(session=session['session']).first()
+    user = current_guest()
     if not user:
-        flash('يرجى تحديث الصفحة', 'danger')
+        flash('لا يوجد طلبات', 'info')
         return redirect(url_for('shop.home'))
     # get order by user id
     order = Order.query.filter_by(user_id=user.id).order_by(Order.created_at.desc()).first()
@@ -1482,10 +2720,7 @@ def order_confirmation():
         flash('لا يوجد طلبات', 'info')
         return redirect(url_for('shop.home'))
     # get order items by order id
-    order_items = OrderItem.query.filter_by(order_id=order.id).all()
-    for item in order_items:
-        product = db.session.get(Product, item.product_id)
-        item.product = product
+    order_items = cart_repository.order_items(order.id)
     return render_template('shop/order_confirmation.html', order=order, order_items=order_items)
 
 # order_detail
@@ -1493,10 +2728,10 @@ def order_confirmation():
 def order_detail():
     try:
         # get gusts session
-        user = Gusts.query.filter_by(session=session['session']).first()
+        user = current_guest()
         
         # get order by user id
-        order = Order.query.filter_by(user_id=user.id).order_by(Order.id.desc()).first()
+        order = Order.query.filter_by(user_id=user.id).order_by(Order.id.desc()).first() if user else None
         
         # Check if order exists
         if not order:
@@ -1504,24 +2739,68 @@ def order_detail():
             return redirect(url_for('shop.cart'))
         
         # get order items by order id
-        shipping_cost = ShippingCost.query.filter_by(city_id=order.city).first()
-        order_items = OrderItem.query.filter_by(order_id=order.id).all()
-        
-        for item in order_items:
-            product = db.session.get(Product, item.product_id)
-            item.product = product
+        shipping_price = shipping_quotes.rate(order.city)
+        order_items = cart_repository.order_items(order.id)
             
         productsPrice = 0 
         for item in order_items:
             productsPrice += item.product.price * item.quantity
             
-        return render_template('shop/order_detail.html', order=order, order_items=order_items, shipping_cost=shipping_cost, productsPrice=productsPrice)
+        return render_template('shop/order_detail.html', order=order, order_items=order_items, shipping_price=shipping_price, productsPrice=productsPrice)
     
     except Exception as e:
         app.logger.error(f"Error in order_detail: {str(e)}")
         flash('حدث خطأ أثناء عرض تفاصيل الطلب', 'danger')
         return redirect(url_for('shop.cart'))
 
+def _own_order(order_id):
+    """``order_id`` if it belongs to the current guest, else 404."""
+    user = current_guest()
+    order = db.session.get(Order, order_id)
+    if not user or not order or order.user_id != user.id:
+        abort(404)
+    return order
+
+
+@shop.route('/payment/processing/<int:order_id>')
+def payment_processing(order_id):
+    """Wait page for a visa order; it redirects once the invoice link is ready."""
+    order = _own_order(order_id)
+    if order.invoice_url:
+        return redirect(order.invoice_url)
+    request_invoice(order.id)
+    return render_template('shop/payment_processing.html', order=order,
+                           poll_interval=app.config['FAWATERAK_POLL_INTERVAL_MS'])
+
+
+@shop.route('/payment/retry/<int:order_id>', methods=['POST'])
+def payment_retry(order_id):
+    order = _own_order(order_id)
+    request_invoice(order.id, retry_failed=True)
+    return redirect(url_for('shop.payment_processing', order_id=order.id))
+
+
+@shop.route('/payment/status/<int:order_id>')
+def payment_status(order_id):
+    """Polled by the wait page: one indexed row read, no ORM objects."""
+    user = current_guest()
+    row = db.session.execute(
+        db.select(Order.user_id, Order.invoice_status, Order.invoice_url, Order.invoice_requested_at)
+        .where(Order.id == order_id)
+    ).first()
+    if not user or not row or row.user_id != user.id:
+        return jsonify({'error': 'Order not found'}), 404
+    status = row.invoice_status
+    lease = timedelta(seconds=app.config['FAWATERAK_INVOICE_LEASE'])
+    if status is None or (status == 'creating' and row.invoice_requested_at < utc_now() - lease):
+        # Never requested, or the worker that claimed it is gone
+        if request_invoice(order_id):
+            status = 'creating'
+    response = jsonify({'status': status, 'url': row.invoice_url})
+    response.cache_control.no_store = True
+    return response
+
+
 @shop.route('/payment/success/<int:order_id>')
 def payment_success(order_id):
     order = db.session.get(Order, order_id)
@@ -1529,9 +2808,10 @@ def payment_success(order_id):
         abort(404)
     order.payment_status = 'paid'
     db.session.commit()
-    user = Gusts.query.filter_by(session=session['session']).first()
-    Cart.query.filter_by(user_id=user.id).delete()
-    db.session.commit()
+    user = current_guest()
+    if user:
+        Cart.query.filter_by(user_id=user.id).delete()
+        db.session.commit()
     return render_template('shop/payment_success.html', order=order)
 
 @shop.route('/payment/fail/<int:order_id>')
@@ -1590,74 +2870,251 @@ def payment_webhook():
     except Exception as e:
         return jsonify({'status': 'error', 'message': str(e)}), 500
 
+# ─── Geography snapshot ───────────────────────────────────────
+# Cities, zones and districts only change when an admin edits a city or a
+# Bosta sync runs, so the checkout APIs serve pre-serialised JSON built with
+# three queries per change. Every body carries a strong ETag (a hash of its
+# content, identical across workers) so browsers and nginx revalidate with a
+# 304 instead of downloading the tree again.
+
+app.config['GEOGRAPHY_CACHE_TTL'] = int(os.getenv('GEOGRAPHY_CACHE_TTL', '86400'))
+app.config['GEOGRAPHY_MAX_AGE'] = int(os.getenv('GEOGRAPHY_MAX_AGE', '60'))
+
+geography_cache = VersionedCache('geography', 'GEOGRAPHY_CACHE_TTL')
+
+EMPTY_GEOGRAPHY_ZONES = json.dumps({'zones': []}).encode()
+EMPTY_GEOGRAPHY_DISTRICTS = json.dumps({'districts': []}).encode()
+
+
+def _json_body(data):
+    body = json.dumps(data, ensure_ascii=False, separators=(',', ':')).encode()
+    return body, hashlib.sha256(body).hexdigest()[:32]
+
+
+def _build_geography_snapshot():
+    zones, districts = {}, {}
+    for row in db.session.execute(db.select(Zone.id, Zone.name, Zone.zone_id, Zone.city_id).order_by(Zone.id)):
+        zones.setdefault(str(row.city_id), []).append({'id': row.id, 'name': row.name, 'zone_id': row.zone_id})
+    for row in db.session.execute(
+            db.select(District.id, District.name, District.district_id, District.city_id).order_by(District.id)):
+        districts.setdefault(str(row.city_id), []).append(
+            {'id': row.id, 'name': row.name, 'district_id': row.district_id})
+    prices = {str(city_id): price for city_id, price in db.session.execute(
+        db.select(ShippingCost.city_id, ShippingCost.price).order_by(ShippingCost.id.desc()))}
+
+    tree, by_city = [], {}
+    for city in db.session.execute(db.select(City.id, City.name, City.city_id).order_by(City.id)):
+        city_zones = zones.get(city.city_id, [])
+        city_districts = districts.get(city.city_id, [])
+        tree.append({
+            'id': city.id,
+            'name': city.name,
+            'city_id': city.city_id,
+            'shipping_price': prices.get(city.city_id),
+            'zones': city_zones,
+            'districts': city_districts,
+        })
+        by_city[city.city_id] = {
+            'zones': _json_body({'zones': city_zones}),
+            'districts': _json_body({'districts': city_districts}),
+        }
+    return SimpleNamespace(cities=_json_body({'city': tree}), by_city=by_city, zones=zones)
+
+
+def geography_snapshot():
+    return geography_cache.get(_build_geography_snapshot)
+
+
+def _geography_response(body_and_etag):
+    body, etag = body_and_etag
+    response = app.response_class(body, mimetype='application/json')
+    response.set_etag(etag)
+    response.cache_control.public = True
+    response.cache_control.max_age = app.config['GEOGRAPHY_MAX_AGE']
+    response.cache_control.must_revalidate = True
+    return response.make_conditional(request)
+
+
+def _city_geography_response(city_id, part):
+    city = geography_snapshot().by_city.get(city_id)
+    if city is None:
+        empty = EMPTY_GEOGRAPHY_ZONES if part == 'zones' else EMPTY_GEOGRAPHY_DISTRICTS
+        return _geography_response((empty, hashlib.sha256(empty).hexdigest()[:32]))
+    return _geography_response(city[part])
+
+
 @shop.route('/api/cities')
 def get_cities():
-    cities = City.query.all()
-    return jsonify(city=[city.serialize() for city in cities])
+    return _geography_response(geography_snapshot().cities)
 
 # /api/zones?city_id=
 @shop.route('/api/zones')
 def get_zones_api():
-    city_id = request.args.get('city_id')
-    zones = Zone.query.filter_by(city_id=city_id).all()
-    return jsonify(zones=[zone.serialize() for zone in zones])
+    return _city_geography_response(request.args.get('city_id', ''), 'zones')
 
 # /api/districts?city_id=
 @shop.route('/api/districts')
 def get_districts_api():
-    city_id = request.args.get('city_id')
-    districts = District.query.filter_by(city_id=city_id).all()
-    return jsonify(districts=[district.serialize() for district in districts])
+    return _city_geography_response(request.args.get('city_id', ''), 'districts')
+
+# ─── Shipping quotes ──────────────────────────────────────────
+# Every shipping price lookup goes through shipping_quotes, which keeps the
+# ShippingCost + City tables as plain dicts in this worker. The rate table
+# shares the geography cache version, so the edits that rebuild the checkout
+# snapshot refresh it too. Reports price any number of orders with
+# quote_many() instead of a query per order.
+
+class ShippingQuoteService:
+    """Shipping prices from the process-local rate table."""
+
+    @staticmethod
+    def _load():
+        names = {str(city_id): name for city_id, name in db.session.execute(db.select(City.city_id, City.name))}
+        prices = {}
+        # Lowest id wins, matching the old ``.first()`` lookups
+        for city_id, price in db.session.execute(
+                db.select(ShippingCost.city_id, ShippingCost.price).order_by(ShippingCost.id.desc())):
+            prices[str(city_id)] = float(price)
+        return SimpleNamespace(prices=prices, names=names)
+
+    def rates(self):
+        return geography_cache.get(self._load, key='shipping_rates')
+
+    def rate(self, city_id):
+        """Base price for ``city_id``, or None when the city has no rate."""
+        return self.rates().prices.get(str(city_id))
+
+    def city_name(self, city_id, default=''):
+        return self.rates().names.get(str(city_id), default)
+
+    def quote(self, city_id, cart_items=(), default=None):
+        """Price shipping ``cart_items`` to ``city_id`` with any shipping offer.
+
+        Cities without a rate are priced at ``default``; with no default the
+        result is None. Otherwise it is a namespace with ``base_price``,
+        ``price``, ``discount``, ``offer`` and ``message``."""
+        rates = self.rates()
+        base_price = rates.prices.get(str(city_id), default)
+        if base_price is None:
+            return None
+        pricing = apply_promotions(cart_items, city_id=city_id, shipping=base_price)
+        rule = pricing.shipping_rule
+        return SimpleNamespace(
+            city_id=str(city_id),
+            city_name=rates.names.get(str(city_id), ''),
+            base_price=base_price,
+            price=pricing.shipping_price,
+            discount=pricing.shipping_discount,
+            offer=rule.slug if rule else None,
+            message=rule.message if rule else None,
+        )
+
+    def quote_many(self, city_ids, default=0.0):
+        """Base price per city id for bulk pricing; ``default`` where there is no rate."""
+        prices = self.rates().prices
+        return {city_id: prices.get(str(city_id), default) for city_id in set(city_ids)}
+
+
+shipping_quotes = ShippingQuoteService()
+
 
 @shop.route('/api/shipping-cost')
 def get_shipping_cost_api():    
     city_id = request.args.get('city_id')
-    shipping_cost = ShippingCost.query.filter_by(city_id=city_id).first()
+    shipping_price = shipping_quotes.rate(city_id)
 
-    if shipping_cost is None:
+    if shipping_price is None:
         return jsonify(error="Shipping cost not found"), 404  # Return error response
 
-    return jsonify(cost=shipping_cost.price)
+    return jsonify(cost=shipping_price)
 
 @shop.route('/api/validate_promo', methods=['POST'])
 def validate_promo():
     """Validate a promo code and return its discount percentage."""
     data = request.get_json(silent=True) or {}
-    code = (data.get('code') or '').strip().upper()
-    if not code:
-        return jsonify({'valid': False, 'message': 'الرجاء إدخال كود الخصم'}), 400
-    promo = PromoCode.query.filter_by(code=code).first()
+    promo, message, status = check_promo_code((data.get('code') or '').strip().upper())
     if not promo:
-        return jsonify({'valid': False, 'message': 'كود الخصم غير صحيح'}), 404
-    if promo.count <= 0:
-        return jsonify({'valid': False, 'message': 'كود الخصم منتهي الصلاحية'}), 410
-    return jsonify({'valid': True, 'discount': promo.discount, 'message': f'تم تطبيق خصم {promo.discount:.0f}%!'})
+        return jsonify({'valid': False, 'message': message}), status
+    return jsonify({'valid': True, 'discount': promo.discount, 'message': message})
+
+
+def _money(value):
+    return None if value is None else round(float(value), 2)
+
+
+# /api/cart/quote?city=&zone_id=&promo_code=
+@shop.route('/api/cart/quote')
+def cart_quote_api():
+    """The whole checkout summary in one call, priced by quote_cart().
+
+    With a city the response also carries that city's zones, so picking a
+    city on the checkout page is a single round trip."""
+    city_id = request.args.get('city', '').strip()
+    zone_id = request.args.get('zone_id', '').strip()
+    promo_code = request.args.get('promo_code', '')
+
+    user = current_guest()
+    cart_items = Cart.query.filter_by(user_id=user.id).all() if user else []
+    products = load_cart_products(cart_items)
+    cart_items = [item for item in cart_items if item.product_id in products]
+    if not cart_items:
+        return jsonify({'error': 'سلة التسوق فارغة'}), 404
+
+    zones = None
+    if city_id:
+        if not shipping_quotes.city_name(city_id):
+            return jsonify({'error': 'City not found'}), 404
+        zones = geography_snapshot().zones.get(city_id, [])
+        zone_ids = {str(zone[key]) for zone in zones for key in ('zone_id', 'id') if zone[key] is not None}
+        if zone_id and zones and zone_id not in zone_ids:
+            return jsonify({'error': 'المنطقة غير صحيحة'}), 400
+
+    cart_quote = quote_cart(cart_items, products, city_id or None, promo_code)
+    if city_id and cart_quote.shipping is None:
+        return jsonify({'error': 'تكلفة الشحن غير متوفرة لهذه المدينة'}), 422
+
+    promotion = cart_quote.promotion
+    shipping_rule = cart_quote.shipping_rule
+    response = jsonify({
+        'subtotal': _money(cart_quote.subtotal),
+        'promotion': promotion and {
+            'slug': promotion.slug,
+            'name': promotion.name,
+            'message': promotion.message,
+            'discount': _money(cart_quote.promotion_discount),
+        },
+        'promo_code': cart_quote.promo_code and {
+            'code': cart_quote.promo_code,
+            'valid': cart_quote.promo_code_percent is not None,
+            'percent': cart_quote.promo_code_percent,
+            'discount': _money(cart_quote.promo_code_discount),
+            'message': cart_quote.promo_code_message,
+        },
+        'items_total': _money(cart_quote.items_total),
+        'shipping': None if cart_quote.shipping is None else {
+            'standard_cost': _money(cart_quote.base_shipping),
+            'cost': _money(cart_quote.shipping),
+            'discount': _money(cart_quote.shipping_discount),
+            'offer': shipping_rule.slug if shipping_rule else None,
+            'message': shipping_rule.message if shipping_rule else None,
+        },
+        'total': _money(cart_quote.total),
+        'zones': zones,
+    })
+    # Priced per cart, so never shared or reused
+    response.cache_control.no_store = True
+    return response
 
 @shop.route('/cart')
 def cart():
-    user = Gusts.query.filter_by(session=session['session']).first()
+    user = current_guest()
     if not user:
-        flash('يرجى تحديث الصفحة', 'danger')
-        return redirect(url_for('shop.home'))
-    # استخدام LEFT JOIN للتعامل مع المنتجات المحذوفة
-    cart_query_result = db.session.query(Cart, Product).outerjoin(Product).filter(Cart.user_id == user.id).all()
-    
-    # حذف عناصر السلة للمنتجات المحذوفة
-    deleted_items = [item.Cart.id for item in cart_query_result if item.Product is None]
-    if deleted_items:
-        Cart.query.filter(Cart.id.in_(deleted_items)).delete(synchronize_session=False)
-        db.session.commit()
-        cart_query_result = [item for item in cart_query_result if item.Product is not None]
-    
-    total = sum(item.Product.price * item.Cart.quantity for item in cart_query_result)
+        # Visitors who never added anything have no guest row yet
+        return render_template('shop/cart.html', cart_items=[], total=0, all_last_orders=[])
+    # Lines with their products; lines of deleted products are dropped
+    cart_items = cart_repository.cart_items(user.id)
+    total = sum(item.product.price * item.quantity for item in cart_items)
     all_last_orders = Order.query.filter_by(user_id=user.id).order_by(Order.id.desc()).limit(10).all()
-    cart_items = [
-        {
-            'id': item.Cart.id,
-            'product': item.Product, 
-            'quantity': item.Cart.quantity
-        } for item in cart_query_result
-    ]
     return render_template('shop/cart.html', cart_items=cart_items, total=total, all_last_orders=all_last_orders)
 
 @shop.route('/return-policy')
@@ -1745,16 +3202,16 @@ def contact():
 # chang-quantity/plus/1
 @shop.route('/cart/change-quantity/<action>/<int:item_id>')
 def change_quantity(action, item_id):
-    user = Gusts.query.filter_by(session=session['session']).first()
+    user = current_guest()
     if not user:
         flash('يرجى تحديث الصفحة', 'danger')
         return redirect(url_for('shop.home'))
-    cart_item = Cart.query.filter_by(id=item_id, user_id=user.id).first()
+    cart_item = cart_repository.cart_item(user.id, item_id)
     if not cart_item:
         abort(404)
     
     if action == 'plus':
-        product = db.session.get(Product, cart_item.product_id)
+        product = cart_item.product
         if product and cart_item.quantity < product.stock:
             cart_item.quantity += 1
         else:
@@ -1817,7 +3274,7 @@ def login():
             return redirect(url_for('admin.login'))
     
     return render_template('admin/login.html')
-from functools import wraps
+from functools import partial, wraps
 # ...existing code...
 def admin_required(f):
     @wraps(f)
@@ -1827,10 +3284,312 @@ def admin_required(f):
         return f(*args, **kwargs)
     return decorated_function
 
-@admin.route('/logout')
-def logout():
-    session.pop('admin', None)
-    return redirect(url_for('admin.login'))
+@admin.route('/logout')
+def logout():
+    session.pop('admin', None)
+    return redirect(url_for('admin.login'))
+
+
+# ─── Admin dashboard ──────────────────────────────────────────
+# Every order figure on the dashboard is a SUM over the daily sales rollup
+# (see below), so the page costs the same handful of queries however many
+# orders there are. Revenue is net of shipping: each delivered order is
+# joined to its city's base rate (the lowest ShippingCost id, as in
+# shipping_quotes) when its day is rolled up. The charts are fetched
+# separately from the time-series endpoint below.
+
+
+def _city_rates():
+    """Subquery of (city_id as text, price) with one rate per city."""
+    first_rates = db.select(db.func.min(ShippingCost.id)).group_by(ShippingCost.city_id)
+    return (db.select(db.cast(ShippingCost.city_id, db.String).label('city_id'), ShippingCost.price)
+            .where(ShippingCost.id.in_(first_rates))
+            .subquery())
+
+
+def delivered_revenue_columns():
+    """(from clause, shipping, net revenue) expressions for delivered-order aggregates."""
+    rates = _city_rates()
+    shipping = db.func.coalesce(rates.c.price, 0)
+    net = db.case((Order.cod_amount - shipping > 0, Order.cod_amount - shipping), else_=0)
+    source = db.outerjoin(Order, rates, rates.c.city_id == Order.city)
+    return source, shipping, net
+
+
+# ─── Daily sales rollup ───────────────────────────────────────
+# daily_sales / daily_product_sales hold per-day totals so dashboards and
+# exports never aggregate the whole order history. Any flush that creates or
+# deletes an order, changes its status, amount, city or date, or touches its
+# items recomputes the affected days from the raw rows (a handful of indexed
+# statements per day, in the same transaction). Adding, changing or removing
+# the shipping rate of a city that has orders can touch its whole history, so
+# once the change commits a background job recomputes that city's days in
+# short batches, newest first, each in its own transaction. Product revenue is
+# priced when the day is rolled up; readers that need current prices multiply
+# the quantity themselves. `flask --app app backfill-daily-sales` rebuilds
+# every day from scratch.
+
+app.config['DAILY_SALES_REPRICE_BATCH'] = int(os.getenv('DAILY_SALES_REPRICE_BATCH', '31'))
+
+ROLLUP_ORDER_FIELDS = ('shipping_status', 'cod_amount', 'city', 'created_at')
+
+
+def _as_day(value):
+    if value is None:
+        return None
+    if isinstance(value, str):
+        return date.fromisoformat(value[:10])
+    return value.date() if isinstance(value, datetime) else value
+
+
+def refresh_daily_sales(connection, days):
+    """Recompute the rollup rows of ``days`` from the orders table."""
+    source, shipping, net = delivered_revenue_columns()
+    delivered = Order.shipping_status == 'delivered'
+
+    def by_status(status):
+        return db.func.coalesce(db.func.sum(db.case((Order.shipping_status == status, 1), else_=0)), 0)
+
+    def delivered_sum(value, when=delivered):
+        return db.func.coalesce(db.func.sum(db.case((when, value), else_=0)), 0)
+
+    for day in sorted(days):
+        start = datetime(day.year, day.month, day.day)
+        in_day = (Order.created_at >= start, Order.created_at < start + timedelta(days=1))
+        connection.execute(db.delete(DailySales).where(DailySales.day == day))
+        connection.execute(db.delete(DailyProductSales).where(DailyProductSales.day == day))
+
+        totals = connection.execute(
+            db.select(
+                db.func.count(Order.id),
+                by_status('pending'), by_status('shipped'), by_status('delivered'),
+                by_status('returned'), by_status('cancelled'),
+                delivered_sum(db.func.coalesce(Order.cod_amount, 0)),
+                delivered_sum(shipping),
+                delivered_sum(shipping, Order.shipping_status == 'returned'),
+                delivered_sum(net),
+            )
+            .select_from(source)
+            .where(*in_day)
+        ).one()
+        if not totals[0]:
+            continue
+
+        products = connection.execute(
+            db.select(OrderItem.product_id, db.func.sum(OrderItem.quantity),
+                      db.func.sum(OrderItem.quantity * Product.price))
+            .join(Order, OrderItem.order_id == Order.id)
+            .join(Product, OrderItem.product_id == Product.id)
+            .where(delivered, *in_day)
+            .group_by(OrderItem.product_id)
+        ).all()
+        if products:
+            connection.execute(db.insert(DailyProductSales), [
+                {'day': day, 'product_id': product_id, 'quantity': quantity, 'revenue': revenue or 0}
+                for product_id, quantity, revenue in products
+            ])
+
+        (orders_count, pending, shipped, delivered_count, returned, cancelled,
+         cod_collected, shipping_cost, returned_shipping, net_revenue) = totals
+        connection.execute(db.insert(DailySales).values(
+            day=day, orders_count=orders_count, pending_count=pending, shipped_count=shipped,
+            delivered_count=delivered_count, returned_count=returned, cancelled_count=cancelled,
+            cod_collected=cod_collected, shipping_cost=shipping_cost, returned_shipping=returned_shipping,
+            net_revenue=net_revenue, items_sold=sum(row[1] for row in products), updated_at=utc_now(),
+        ))
+
+
+@event.listens_for(db.session, 'after_flush')
+def _refresh_daily_sales_after_flush(session, flush_context):
+    days = set()
+    item_orders = set()
+    rate_cities = set()
+    # Deleted rows are gone from the database, so only read what is already loaded
+    changed = [(obj, db.inspect(obj).dict) for obj in session.deleted]
+    changed += [(obj, None) for obj in session.new]
+    changed += [(obj, None) for obj in session.dirty if not isinstance(obj, Order) or any(
+        db.inspect(obj).attrs[field].history.has_changes() for field in ROLLUP_ORDER_FIELDS)]
+    for obj, loaded in changed:
+        if isinstance(obj, Order):
+            days.add(_as_day(loaded.get('created_at') if loaded is not None else obj.created_at))
+            days.update(_as_day(value) for value in db.inspect(obj).attrs.created_at.history.deleted)
+        elif isinstance(obj, OrderItem):
+            order_id = loaded.get('order_id') if loaded is not None else obj.order_id
+            if order_id is not None:
+                item_orders.add(order_id)
+        elif isinstance(obj, ShippingCost):
+            rate_cities.add(loaded.get('city_id') if loaded is not None else obj.city_id)
+            rate_cities.update(db.inspect(obj).attrs.city_id.history.deleted)
+    rate_cities.discard(None)
+    if not days and not item_orders and not rate_cities:
+        return
+    connection = session.connection()
+    if item_orders:
+        days.update(_as_day(created_at) for created_at in connection.execute(
+            db.select(Order.created_at).where(Order.id.in_(item_orders))).scalars())
+    if rate_cities:
+        # Cities without orders (e.g. new ones from a Bosta sync) need no job
+        session.info.setdefault('daily_sales_reprice', set()).update(connection.execute(
+            db.select(Order.city).distinct()
+            .where(Order.city.in_([str(city_id) for city_id in rate_cities]))).scalars())
+    days.discard(None)
+    if days:
+        refresh_daily_sales(connection, days)
+
+
+@event.listens_for(db.session, 'after_commit')
+def _reprice_daily_sales_after_commit(session):
+    cities = session.info.pop('daily_sales_reprice', None)
+    if cities:
+        # Not exclusive: every rate change gets a job that reads the rates as
+        # they are when it runs, so a change made during a running job is not lost
+        job_id = _claim_background_job('daily_sales_reprice', exclusive=False)
+        _spawn_background_job(job_id, 'daily_sales_reprice', partial(reprice_daily_sales, sorted(cities)))
+
+
+@event.listens_for(db.session, 'after_rollback')
+def _forget_daily_sales_reprice(session):
+    session.info.pop('daily_sales_reprice', None)
+
+
+def reprice_daily_sales(cities, report):
+    """Recompute every rollup day with an order to one of ``cities``."""
+    days = sorted({_as_day(day) for day in db.session.execute(
+        db.select(db.func.date(Order.created_at)).distinct().where(Order.city.in_(cities))).scalars()},
+        reverse=True)
+    db.session.rollback()
+    batch = app.config['DAILY_SALES_REPRICE_BATCH']
+    for done in range(0, len(days), batch):
+        refresh_daily_sales(db.session.connection(), days[done:done + batch])
+        db.session.commit()
+        report(min(done + batch, len(days)), len(days))
+    return {'cities': cities, 'days': len(days)}
+
+
+def rebuild_daily_sales():
+    """Recompute the whole rollup from the orders table; return the number of days."""
+    connection = db.session.connection()
+    connection.execute(db.delete(DailyProductSales))
+    connection.execute(db.delete(DailySales))
+    days = {_as_day(day) for day in connection.execute(
+        db.select(db.func.date(Order.created_at)).distinct()).scalars()}
+    days.discard(None)
+    refresh_daily_sales(connection, days)
+    db.session.commit()
+    return len(days)
+
+
+@app.cli.command('backfill-daily-sales')
+def backfill_daily_sales_command():
+    """Rebuild the daily sales rollup from all orders."""
+    print(f'Rolled up {rebuild_daily_sales()} days of orders')
+
+
+# ─── Sales time series ────────────────────────────────────────
+# /admin/api/metrics/timeseries serves the dashboard charts, which load it
+# after the page has rendered. Each series is one GROUP BY over the daily
+# rollup on the calendar day, ISO week (Monday) or calendar month, and is
+# zero-filled in Python so empty periods still show up.
+
+TIMESERIES_METRICS = {
+    'revenue': DailySales.cod_collected,
+    'net_revenue': DailySales.net_revenue,
+    'shipping_cost': DailySales.shipping_cost,
+    'orders': DailySales.orders_count,
+    'delivered_orders': DailySales.delivered_count,
+    'items_sold': DailySales.items_sold,
+}
+# Default span (in buckets) when ``from`` is not given
+TIMESERIES_DEFAULT_SPAN = {'day': 30, 'week': 12, 'month': 6}
+TIMESERIES_MAX_BUCKETS = 400
+
+
+def bucket_start(day, bucket):
+    """First day of the day/week/month bucket containing ``day``."""
+    if bucket == 'week':
+        return day - timedelta(days=day.weekday())
+    if bucket == 'month':
+        return day.replace(day=1)
+    return day
+
+
+def _next_bucket(start, bucket):
+    if bucket == 'week':
+        return start + timedelta(days=7)
+    if bucket == 'month':
+        return (start.replace(day=28) + timedelta(days=4)).replace(day=1)
+    return start + timedelta(days=1)
+
+
+def bucket_starts(start, end, bucket):
+    """Start dates of the buckets covering ``start``..``end``, oldest first."""
+    current = bucket_start(start, bucket)
+    starts = []
+    while current <= end:
+        starts.append(current)
+        current = _next_bucket(current, bucket)
+    return starts
+
+
+def _bucket_key(bucket):
+    if bucket == 'week':
+        # The Monday on or before the day, as text like the other keys
+        return db.func.date(DailySales.day, 'weekday 0', '-6 days')
+    if bucket == 'month':
+        return db.func.strftime('%Y-%m-01', DailySales.day)
+    return db.func.strftime('%Y-%m-%d', DailySales.day)
+
+
+def sales_timeseries(metric, bucket, starts, end):
+    """[(bucket start, total)] of ``metric`` for the buckets in ``starts`` up to ``end``."""
+    if not starts:
+        return []
+    key = _bucket_key(bucket)
+    found = dict(db.session.execute(
+        db.select(key, db.func.coalesce(db.func.sum(TIMESERIES_METRICS[metric]), 0))
+        .where(DailySales.day.between(starts[0], end))
+        .group_by(key)
+    ).all())
+    return [(start, found.get(start.isoformat(), 0)) for start in starts]
+
+
+@admin.route('/api/metrics/timeseries')
+@admin_required
+def metrics_timeseries():
+    """Zero-filled totals of a daily sales metric per day, week or month."""
+    metric = request.args.get('metric', 'revenue')
+    bucket = request.args.get('bucket', 'month')
+    if metric not in TIMESERIES_METRICS:
+        return jsonify({'success': False, 'message': f'metric must be one of {", ".join(TIMESERIES_METRICS)}'}), 400
+    if bucket not in TIMESERIES_DEFAULT_SPAN:
+        return jsonify({'success': False, 'message': 'bucket must be day, week or month'}), 400
+    try:
+        end = datetime.strptime(request.args['to'], '%Y-%m-%d').date() if request.args.get('to') \
+            else utc_now().date()
+        if request.args.get('from'):
+            start = datetime.strptime(request.args['from'], '%Y-%m-%d').date()
+        else:
+            start = bucket_start(end, bucket)
+            for _ in range(TIMESERIES_DEFAULT_SPAN[bucket] - 1):
+                start = bucket_start(start - timedelta(days=1), bucket)
+    except ValueError:
+        return jsonify({'success': False, 'message': 'from/to must be YYYY-MM-DD dates'}), 400
+    if start > end:
+        return jsonify({'success': False, 'message': 'from must not be after to'}), 400
+    starts = bucket_starts(start, end, bucket)
+    if len(starts) > TIMESERIES_MAX_BUCKETS:
+        return jsonify({'success': False, 'message': f'at most {TIMESERIES_MAX_BUCKETS} buckets'}), 400
+
+    series = sales_timeseries(metric, bucket, starts, end)
+    return jsonify({
+        'success': True,
+        'metric': metric,
+        'bucket': bucket,
+        'from': starts[0].isoformat(),
+        'to': end.isoformat(),
+        'labels': [start.isoformat() for start, _ in series],
+        'values': [value for _, value in series],
+    })
 
 
 @admin.route('/')
@@ -1841,15 +3600,13 @@ def home():
         start_date = request.args.get('start_date')
         end_date = request.args.get('end_date')
         
-        # Create base query with date filter if provided
-        base_query = Order.query
+        # Date filter for the revenue figures, if provided (both days included)
+        date_filter = []
         if start_date and end_date:
             try:
-                start = datetime.strptime(start_date, '%Y-%m-%d')
-                end = datetime.strptime(end_date, '%Y-%m-%d')
-                # Add one day to end date to include all records of the end date
-                end = end + timedelta(days=1)
-                base_query = base_query.filter(Order.created_at.between(start, end))
+                start = datetime.strptime(start_date, '%Y-%m-%d').date()
+                end = datetime.strptime(end_date, '%Y-%m-%d').date()
+                date_filter = [DailySales.day.between(start, end)]
             except ValueError:
                 flash('صيغة التاريخ غير صحيحة', 'error')
 
@@ -1870,91 +3627,70 @@ def home():
         customers_count = 0
         new_customers = 0
         repeat_customers = 0
-        delivered_orders = []
-        pending_orders = []
+        shipping_status_distribution = []
+        now = utc_now()
         
         try:
             # Product and category statistics
-            products = Product.query.all()
-            products_count = len(products)
-            categories_count = Category.query.count()
-            active_products = sum(1 for p in products if p.stock > 0)
+            products_count, active_products = db.session.execute(
+                db.select(db.func.count(Product.id),
+                          db.func.coalesce(db.func.sum(db.case((Product.stock > 0, 1), else_=0)), 0))
+            ).one()
+            categories_count = db.session.scalar(db.select(db.func.count(Category.id)))
         except Exception as e:
             app.logger.error(f'Error counting products: {str(e)}')
         
         try:
-            # Order statistics using query filters for better performance
-            orders_count = Order.query.count()
-            delivered_orders = Order.query.filter_by(shipping_status='delivered').all()
-            delivered_orders_count = len(delivered_orders)
-            pending_orders = Order.query.filter_by(shipping_status='pending').all()
-            pending_orders_count = len(pending_orders)
-            
-            shipped_orders_count = Order.query.filter_by(shipping_status='shipped').count()
-            returned_orders_count = Order.query.filter_by(shipping_status='returned').count()
-            
-            # Update variables used in template
-            shipped_orders = shipped_orders_count
-            returned_orders = returned_orders_count
+            # Order counts per status, summed over the daily rollup
+            statuses = ('pending', 'shipped', 'delivered', 'returned', 'cancelled')
+            orders_count, *counts = db.session.execute(
+                db.select(db.func.coalesce(db.func.sum(DailySales.orders_count), 0),
+                          *(db.func.coalesce(db.func.sum(getattr(DailySales, f'{status}_count')), 0)
+                            for status in statuses))
+            ).one()
+            status_counts = dict(zip(statuses, counts))
+            shipping_status_distribution = [(status, count) for status, count in status_counts.items() if count]
+            pending_orders_count = status_counts['pending']
+            shipped_orders_count = status_counts['shipped']
+            returned_orders_count = status_counts['returned']
         except Exception as e:
             app.logger.error(f'Error calculating order statistics: {str(e)}')
         
         try:
             # Customer statistics
-            customers_count = Gusts.query.count()
-            new_customers = Gusts.query.filter(
-                Gusts.created_at >= datetime.now() - timedelta(days=30)
-            ).count()
+            customers_count, new_customers = db.session.execute(
+                db.select(db.func.count(Gusts.id),
+                          db.func.coalesce(db.func.sum(db.case(
+                              (Gusts.created_at >= now - timedelta(days=30), 1), else_=0)), 0))
+            ).one()
             
             # Calculate repeat customers
-            repeat_customers = db.session.query(Gusts).join(Order).group_by(Gusts.id).having(
-                db.func.count(Order.id) > 1
-            ).count()
+            repeat_customers = db.session.scalar(
+                db.select(db.func.count()).select_from(
+                    db.select(Order.user_id).group_by(Order.user_id)
+                    .having(db.func.count(Order.id) > 1).subquery()
+                )
+            )
         except Exception as e:
             app.logger.error(f'Error calculating customer statistics: {str(e)}')
         
         try:
-            # Calculate revenue statistics for delivered orders
-            delivered_query = base_query.filter(
-                Order.shipping_status == 'delivered',
-                Order.cod_amount.isnot(None)
-            )
-            
-            for order in delivered_query.all():
-                try:
-                    shipping_cost = ShippingCost.query.filter_by(city_id=order.city).first()
-                    shipping_price = float(shipping_cost.price) if shipping_cost else 0
-                    total_shipping_cost += shipping_price
-                    
-                    order_amount = float(order.cod_amount) if order.cod_amount else 0
-                    total_revenue += max(0, order_amount - shipping_price)
-                except (ValueError, TypeError, AttributeError) as e:
-                    app.logger.error(f'Error processing order {order.id}: {str(e)}')
-                    continue
+            # Revenue of delivered orders, net of shipping, from the daily rollup
+            net = DailySales.net_revenue
+            (delivered_orders_count, total_shipping_cost, total_revenue,
+             monthly_revenue, daily_revenue) = db.session.execute(
+                db.select(
+                    db.func.coalesce(db.func.sum(DailySales.delivered_count), 0),
+                    db.func.coalesce(db.func.sum(DailySales.shipping_cost), 0),
+                    db.func.coalesce(db.func.sum(net), 0),
+                    db.func.coalesce(db.func.sum(db.case((DailySales.day >= bucket_start(now.date(), 'month'), net), else_=0)), 0),
+                    db.func.coalesce(db.func.sum(db.case((DailySales.day == now.date(), net), else_=0)), 0),
+                )
+                .where(*date_filter)
+            ).one()
             
             # Calculate average order value
             avg_order_value = total_revenue / delivered_orders_count if delivered_orders_count > 0 else 0
-            
-            # Calculate monthly and daily revenue
-            current_month = datetime.now().month
-            current_year = datetime.now().year
-            today = datetime.now().date()
-            
-            for order in delivered_query.all():
-                try:
-                    shipping_cost = ShippingCost.query.filter_by(city_id=order.city).first()
-                    shipping_price = float(shipping_cost.price) if shipping_cost else 0
-                    order_amount = float(order.cod_amount) if order.cod_amount else 0
-                    revenue = max(0, order_amount - shipping_price)
-                    
-                    if order.created_at.date() == today:
-                        daily_revenue += revenue
-                    if order.created_at.month == current_month and order.created_at.year == current_year:
-                        monthly_revenue += revenue
-                except Exception as e:
-                    app.logger.error(f'Error processing revenue for order {order.id}: {str(e)}')
-                    continue
-                    
         except Exception as e:
             app.logger.error(f'Error calculating revenue statistics: {str(e)}')
 
@@ -1965,70 +3701,26 @@ def home():
             app.logger.error(f'Error fetching recent orders: {str(e)}')
             recent_orders = []
         
-        # Initialize chart data
-        revenue_chart = {'labels': [], 'data': []}
-        orders_chart = {'labels': [], 'data': []}
-        
-        try:
-            # Generate chart data for the last 6 months
-            current_date = datetime.now()
-            for i in range(6):
-                month_date = current_date - timedelta(days=30*i)
-                month_name = month_date.strftime('%B')
-                
-                # Revenue data
-                monthly_revenue = db.session.query(db.func.sum(Order.cod_amount)).filter(
-                    Order.shipping_status == 'delivered',
-                    db.extract('month', Order.created_at) == month_date.month,
-                    db.extract('year', Order.created_at) == month_date.year
-                ).scalar() or 0
-                
-                # Orders data
-                monthly_orders = Order.query.filter(
-                    Order.shipping_status == 'delivered',
-                    db.extract('month', Order.created_at) == month_date.month,
-                    db.extract('year', Order.created_at) == month_date.year
-                ).count()
-                
-                revenue_chart['labels'].insert(0, month_name)
-                revenue_chart['data'].insert(0, monthly_revenue)
-                orders_chart['labels'].insert(0, month_name)
-                orders_chart['data'].insert(0, monthly_orders)
-        except Exception as e:
-            app.logger.error(f'Error generating chart data: {str(e)}')
-        
         # Get top selling products
         try:
             top_products = db.session.query(
                 Product,
-                db.func.sum(OrderItem.quantity).label('total_sold')
+                db.func.sum(DailyProductSales.quantity).label('total_sold')
             ).select_from(Product).join(
-                OrderItem, Product.id == OrderItem.product_id
-            ).join(
-                Order, OrderItem.order_id == Order.id
-            ).filter(
-                Order.shipping_status == 'delivered'
+                DailyProductSales, Product.id == DailyProductSales.product_id
             ).group_by(Product.id).order_by(
                 db.desc('total_sold')
             ).limit(5).all()
         except Exception as e:
             app.logger.error(f'Error fetching top products: {str(e)}')
             top_products = []
-        try:
-            shipping_status_distribution = db.session.query(
-                Order.shipping_status,
-                db.func.count(Order.id).label('count')
-            ).group_by(Order.shipping_status).all()
-        except Exception as e:
-            app.logger.error(f'Error fetching shipping status distribution: {str(e)}')
-            shipping_status_distribution = []
 
         return render_template('admin/index.html',
             products_count=products_count,
             categories_count=categories_count,
             active_products=active_products,
             orders_count=orders_count,
-            delivered_orders=delivered_orders,
+            delivered_orders=delivered_orders_count,
             pending_orders=pending_orders_count,
             shipped_orders=shipped_orders_count,
             returned_orders=returned_orders_count,
@@ -2041,8 +3733,6 @@ def home():
             total_shipping_cost=total_shipping_cost,
             avg_order_value=avg_order_value,
             recent_orders=recent_orders,
-            revenue_chart=revenue_chart,
-            orders_chart=orders_chart,
             top_products=top_products,
             shipping_status_distribution=shipping_status_distribution)
                             
@@ -2124,6 +3814,8 @@ def add_product():
         )
         db.session.add(new_product)
         db.session.commit()
+        category_cache.invalidate()
+        related_products_cache.invalidate()
 
         # معالجة الصور الإضافية
         additional_images = request.files.getlist('additional_images')
@@ -2177,6 +3869,7 @@ def add_category():
         new_category = Category(name=name, description=description)
         db.session.add(new_category)
         db.session.commit()
+        category_cache.invalidate()
         flash('تمت إضافة التصنيف بنجاح!', 'success')
         
     except Exception as e:
@@ -2190,7 +3883,7 @@ def add_category():
 @admin_required
 def products():
     products = Product.query.all()
-    categories = Category.query.all()
+    categories = cached_categories()
     return render_template('admin/products.html', products=products, categories=categories)
 
 
@@ -2225,6 +3918,8 @@ def delete_product(product_id):
     
     db.session.delete(product)
     db.session.commit()
+    category_cache.invalidate()
+    related_products_cache.invalidate()
     flash('تم حذف المنتج بنجاح!', 'success')
     return redirect(url_for('admin.products'))
 
@@ -2235,7 +3930,7 @@ def get_edit_product_form(product_id):
     product = db.session.get(Product, product_id)
     if not product:
         abort(404)
-    categories = Category.query.all()
+    categories = cached_categories()
 
     # If loaded via AJAX (modal), return just the form fragment
     if request.headers.get('X-Requested-With') == 'XMLHttpRequest':
@@ -2307,6 +4002,8 @@ def edit_product(product_id):
                     db.session.add(additional_image)
 
         db.session.commit()
+        category_cache.invalidate()
+        related_products_cache.invalidate()
         flash('تم تعديل المنتج بنجاح!', 'success')
     except ValueError as e:
         db.session.rollback()
@@ -2378,35 +4075,293 @@ def bulk_delete_categories():
         except Exception:
             continue
     db.session.commit()
+    if deleted:
+        category_cache.invalidate()
     if deleted:
         flash(f'تم حذف {deleted} تصنيف بنجاح!', 'success')
     if skipped:
         flash(f'تم تخطي {skipped} تصنيف لاحتوائها على منتجات', 'error')
     return redirect(url_for('admin.categories'))
 
+# ─── Background jobs ──────────────────────────────────────────
+# Admin actions that take longer than a request should (a full Bosta sync)
+# run on a daemon thread and record progress in a BackgroundJob row, which
+# the admin page polls through /admin/api/jobs/<id>.
+
+app.config['BACKGROUND_JOB_STALE_AFTER'] = int(os.getenv('BACKGROUND_JOB_STALE_AFTER', '600'))
+
+_job_threads = {}
+
+
+def _update_job(job_id, **values):
+    """Write job state on its own connection, outside the job's transaction."""
+    values['updated_at'] = utc_now()
+    with db.engine.begin() as connection:
+        connection.execute(
+            db.update(BackgroundJob).where(BackgroundJob.id == job_id).values(**values)
+        )
+
+
+def report_job_progress(job_id, progress, total=None, message=None):
+    values = {'progress': progress}
+    if total is not None:
+        values['total'] = total
+    if message is not None:
+        values['message'] = message[:255]
+    _update_job(job_id, **values)
+
+
+def _run_background_job(job_id, fn):
+    with app.app_context():
+        _update_job(job_id, status='running', started_at=utc_now())
+        try:
+            result = fn(lambda progress, total=None, message=None:
+                        report_job_progress(job_id, progress, total, message))
+        except Exception as e:
+            db.session.rollback()
+            app.logger.error(f'Background job #{job_id} failed: {str(e)}')
+            _update_job(job_id, status='failed', error=str(e)[:1000], finished_at=utc_now())
+        else:
+            _update_job(job_id, status='done', result=json.dumps(result, ensure_ascii=False),
+                        finished_at=utc_now())
+        finally:
+            db.session.remove()
+            _job_threads.pop(job_id, None)
+
+
+def _claim_background_job(kind, exclusive=True):
+    """Insert a queued job row and return its id.
+
+    With ``exclusive`` the row is only inserted when no fresh queued or
+    running job of ``kind`` exists, checked in the same statement so two
+    workers cannot both claim it; ``None`` is returned when one does. Runs on
+    its own connection and never touches the caller's session."""
+    now = utc_now()
+    row = db.select(db.literal(kind), db.literal('queued'), db.literal(0),
+                    db.literal(now, db.DateTime), db.literal(now, db.DateTime))
+    if exclusive:
+        fresh_since = now - timedelta(seconds=app.config['BACKGROUND_JOB_STALE_AFTER'])
+        row = row.where(~db.exists().where(
+            BackgroundJob.kind == kind,
+            BackgroundJob.status.in_(('queued', 'running')),
+            BackgroundJob.updated_at >= fresh_since,
+        ))
+    with db.engine.begin() as connection:
+        return connection.execute(
+            db.insert(BackgroundJob)
+            .from_select(['kind', 'status', 'progress', 'created_at', 'updated_at'], row)
+            .returning(BackgroundJob.id)
+        ).scalar()
+
+
+def _spawn_background_job(job_id, kind, fn):
+    thread = threading.Thread(target=_run_background_job, args=(job_id, fn),
+                              name=f'job-{kind}-{job_id}', daemon=True)
+    _job_threads[job_id] = thread
+    thread.start()
+
+
+def start_background_job(kind, fn):
+    """Run ``fn(report)`` on a daemon thread; return ``(job, started)``.
+
+    ``report(progress, total=None, message=None)`` records progress. If a job
+    of the same kind is still running (and has reported recently) it is
+    returned instead of starting a second one."""
+    job_id = _claim_background_job(kind)
+    if job_id is None:
+        active = BackgroundJob.query.filter(
+            BackgroundJob.kind == kind,
+            BackgroundJob.status.in_(('queued', 'running')),
+        ).order_by(BackgroundJob.id.desc()).first()
+        if active:
+            return active, False
+        # The active job finished in between: claim again
+        return start_background_job(kind, fn)
+    _spawn_background_job(job_id, kind, fn)
+    return db.session.get(BackgroundJob, job_id), True
+
+
+# ─── Bosta geography sync ─────────────────────────────────────
+# Cities come from one call; zones and districts need two calls per city,
+# which run on a bounded thread pool. The result is diffed in memory against
+# the local rows and applied with executemany inserts/updates and IN-list
+# deletes in a single transaction. Cities are only ever added or renamed:
+# manually added cities and their shipping prices are left alone, and a city
+# whose zones could not be fetched keeps its current rows.
+
+app.config['BOSTA_SYNC_WORKERS'] = int(os.getenv('BOSTA_SYNC_WORKERS', '8'))
+
+GEOGRAPHY_DELETE_CHUNK = 500
+
+
+def _bosta_ref(item, id_keys, name_keys):
+    ref = next((str(item[key]) for key in id_keys if item.get(key)), '')
+    name = next((item[key] for key in name_keys if item.get(key)), '')
+    return ref, name
+
+
+def _bosta_refs(items, id_keys, name_keys):
+    refs = {}
+    for item in items:
+        ref, name = _bosta_ref(item, id_keys, name_keys)
+        if ref and name:
+            refs[ref] = name
+    return refs
+
+
+def _bosta_district_items(data):
+    """Bosta lists districts either flat or grouped under their zone."""
+    for item in data:
+        if 'districts' in item:
+            yield from item['districts'] or ()
+        else:
+            yield item
+
+
+def _fetch_city_children(city_ref):
+    zones = _bosta_refs(bosta_service.get_zones(city_ref), ('_id', 'id', 'zoneId'), ('name', 'nameEn', 'zoneName'))
+    districts = _bosta_refs(_bosta_district_items(bosta_service.get_districts(city_ref)),
+                            ('_id', 'id', 'districtId'), ('name', 'nameEn', 'districtName'))
+    return zones, districts
+
+
+def fetch_bosta_geography(report=None):
+    """Return ``(cities, children, failed)`` fetched from Bosta.
+
+    ``cities`` maps Bosta city id to name, ``children`` maps city id to a
+    ``(zones, districts)`` pair of id -> name dicts, ``failed`` lists the
+    cities whose zones or districts could not be fetched."""
+    cities = _bosta_refs(bosta_service.get_cities(), ('_id', 'id'), ('name', 'nameEn'))
+    children, failed = {}, []
+    with ThreadPoolExecutor(max_workers=app.config['BOSTA_SYNC_WORKERS']) as pool:
+        futures = {pool.submit(_fetch_city_children, ref): ref for ref in cities}
+        for done, future in enumerate(as_completed(futures), 1):
+            ref = futures[future]
+            try:
+                children[ref] = future.result()
+            except Exception as e:
+                failed.append(ref)
+                app.logger.error(f'Bosta sync: fetching zones/districts of city {ref} failed: {str(e)}')
+            if report:
+                report(done, len(cities), f'{cities[ref]} ({done}/{len(cities)})')
+    return cities, children, failed
+
+
+def _apply_geography_rows(model, ref_column, wanted):
+    """Bring ``model`` rows of the cities in ``wanted`` in line with it.
+
+    ``wanted`` maps city id to a ref -> name dict. Returns the counts."""
+    table = model.__table__
+    ref_col = table.c[ref_column]
+    existing = {}
+    duplicates = []
+    rows = db.session.execute(
+        db.select(table.c.id, table.c.city_id, ref_col, table.c.name)
+        .where(table.c.city_id.in_(tuple(wanted)))
+    ).all()
+    for row_id, city_id, ref, name in rows:
+        key = (str(city_id), ref)
+        if key in existing:
+            duplicates.append(row_id)
+        else:
+            existing[key] = (row_id, name)
+
+    inserts, updates = [], []
+    for city_id, refs in wanted.items():
+        for ref, name in refs.items():
+            current = existing.pop((city_id, ref), None)
+            if current is None:
+                inserts.append({'city_id': city_id, ref_column: ref, 'name': name})
+            elif current[1] != name:
+                updates.append({'row_id': current[0], 'new_name': name})
+    deletes = duplicates + [row_id for row_id, _ in existing.values()]
+
+    if inserts:
+        db.session.execute(db.insert(model), inserts)
+    if updates:
+        db.session.execute(
+            table.update().where(table.c.id == db.bindparam('row_id')).values(name=db.bindparam('new_name')),
+            updates,
+        )
+    for start in range(0, len(deletes), GEOGRAPHY_DELETE_CHUNK):
+        chunk = deletes[start:start + GEOGRAPHY_DELETE_CHUNK]
+        db.session.execute(table.delete().where(table.c.id.in_(chunk)))
+    return {'inserted': len(inserts), 'updated': len(updates), 'deleted': len(deletes)}
+
+
+def apply_bosta_geography(cities, children):
+    """Write fetched geography in one transaction; return the counts."""
+    local = {}
+    for row_id, city_id, name in db.session.execute(db.select(City.id, City.city_id, City.name)):
+        local.setdefault(city_id, (row_id, name))
+    new_cities = [{'city_id': ref, 'name': name} for ref, name in cities.items() if ref not in local]
+    renamed = [{'row_id': local[ref][0], 'new_name': name}
+               for ref, name in cities.items() if ref in local and local[ref][1] != name]
+    if new_cities:
+        db.session.execute(db.insert(City), new_cities)
+    if renamed:
+        cities_table = City.__table__
+        db.session.execute(
+            cities_table.update().where(cities_table.c.id == db.bindparam('row_id'))
+            .values(name=db.bindparam('new_name')),
+            renamed,
+        )
+    summary = {
+        'cities': {'inserted': len(new_cities), 'updated': len(renamed), 'deleted': 0},
+        'zones': _apply_geography_rows(Zone, 'zone_id', {ref: pair[0] for ref, pair in children.items()}),
+        'districts': _apply_geography_rows(District, 'district_id', {ref: pair[1] for ref, pair in children.items()}),
+    }
+    db.session.commit()
+    geography_cache.invalidate()
+    return summary
+
+
+def sync_bosta_geography(report=None):
+    """Fetch cities, zones and districts from Bosta and sync the local tables."""
+    cities, children, failed = fetch_bosta_geography(report)
+    if report:
+        report(len(cities), len(cities), 'جاري حفظ البيانات...')
+    summary = apply_bosta_geography(cities, children)
+    summary['failed_cities'] = failed
+    return summary
+
+
+@app.cli.command('sync-geography')
+def sync_geography_command():
+    """Sync cities, zones and districts from Bosta."""
+    def report(done, total, message):
+        print(f'[{done}/{total}] {message}')
+
+    summary = sync_bosta_geography(report)
+    for name in ('cities', 'zones', 'districts'):
+        counts = summary[name]
+        print(f"{name}: +{counts['inserted']} ~{counts['updated']} -{counts['deleted']}")
+    if summary['failed_cities']:
+        print(f"Failed cities (kept as they were): {', '.join(summary['failed_cities'])}")
+
+
 @admin.route('/sync_bosta_cities', methods=['POST'])
 @admin_required
 def sync_bosta_cities():
-    """Fetch cities, zones and districts from Bosta API and sync to local DB."""
-    try:
-        cities_data = bosta_service.get_cities()
-        synced = 0
-        for city_info in cities_data:
-            bosta_city_id = str(city_info.get('_id') or city_info.get('id', ''))
-            city_name = city_info.get('name') or city_info.get('nameEn', '')
-            if not bosta_city_id or not city_name:
-                continue
-            existing = City.query.filter_by(city_id=bosta_city_id).first()
-            if not existing:
-                city = City(name=city_name, city_id=bosta_city_id)
-                db.session.add(city)
-            synced += 1
-        db.session.commit()
-        flash(f'تمت مزامنة {synced} مدينة من Bosta بنجاح!', 'success')
-    except Exception as e:
-        db.session.rollback()
-        flash(f'خطأ في المزامنة: {str(e)}', 'error')
-    return redirect(url_for('admin.categories'))
+    """Start a background sync of cities, zones and districts from Bosta."""
+    job, started = start_background_job('bosta_geography', sync_bosta_geography)
+    if request.accept_mimetypes.best == 'application/json':
+        return jsonify({'success': True, 'started': started, 'job': job.to_dict()}), 202
+    if started:
+        flash('بدأت مزامنة المدن والمناطق من Bosta في الخلفية', 'success')
+    else:
+        flash('مزامنة Bosta قيد التشغيل بالفعل', 'info')
+    return redirect(url_for('admin.shipping'))
+
+
+@admin.route('/api/jobs/<int:job_id>')
+@admin_required
+def background_job_status(job_id):
+    """Progress of a background job."""
+    job = db.session.get(BackgroundJob, job_id)
+    if not job:
+        return jsonify({'success': False, 'message': 'المهمة غير موجودة'}), 404
+    return jsonify({'success': True, 'job': job.to_dict()})
 
 @admin.route('/delete_category/<int:category_id>', methods=['POST'])
 @admin_required
@@ -2420,6 +4375,7 @@ def delete_category(category_id):
         return redirect(url_for('admin.categories'))
     db.session.delete(category)
     db.session.commit()
+    category_cache.invalidate()
     flash('تم حذف القسم بنجاح!', 'success')
     return redirect(url_for('admin.categories'))
 
@@ -2435,6 +4391,7 @@ def edit_category(category_id):
         if 'description' in request.form:
             category.description = request.form['description']
         db.session.commit()
+        category_cache.invalidate()
         flash('تم تعديل القسم بنجاح!', 'success')
     except Exception as e:
         db.session.rollback()
@@ -2709,7 +4666,7 @@ def download_image_from_url(image_url):
 @admin_required
 def dropshipping():
     items = DropshipProduct.query.order_by(DropshipProduct.created_at.desc()).all()
-    categories = Category.query.all()
+    categories = cached_categories()
     return render_template('admin/dropshipping.html', items=items, categories=categories)
 
 
@@ -2812,6 +4769,8 @@ def dropshipping_import(item_id):
         )
         db.session.add(new_product)
         db.session.commit()
+        category_cache.invalidate()
+        related_products_cache.invalidate()
         
         # Download additional images
         if item.additional_images:
@@ -2848,12 +4807,16 @@ def dropshipping_delete(item_id):
     if not item:
         abort(404)
     # Also delete the associated Product if it was imported
+    product = None
     if item.imported_product_id:
         product = db.session.get(Product, item.imported_product_id)
         if product:
             db.session.delete(product)
     db.session.delete(item)
     db.session.commit()
+    if product:
+        category_cache.invalidate()
+        related_products_cache.invalidate()
     flash('تم حذف المنتج من قائمة الدروب شوبينج والمتجر', 'success')
     return redirect(url_for('admin.dropshipping'))
 
@@ -2889,16 +4852,18 @@ def shipping():
         total_districts = 0
         total_shipping_cost = 0.0
         cities_with_shipping = 0
+        created_defaults = False
         
         # Process each city and prepare data
         for city in cities:
             try:
                 # Get shipping cost for this city
-                shipping_cost = ShippingCost.query.filter_by(city_id=city.city_id).first()
-                if not shipping_cost:
+                shipping_price = shipping_quotes.rate(city.city_id)
+                if shipping_price is None:
                     # Create default shipping cost if it doesn't exist
-                    shipping_cost = ShippingCost(city_id=city.city_id, price=100)
-                    db.session.add(shipping_cost)
+                    db.session.add(ShippingCost(city_id=city.city_id, price=100))
+                    shipping_price = 100.0
+                    created_defaults = True
                     
                 # Count zones and districts with more robust handling
                 zones_count = 0
@@ -2930,9 +4895,8 @@ def shipping():
                 total_zones += zones_count
                 total_districts += districts_count
                 
-                if shipping_cost and hasattr(shipping_cost, 'price'):
-                    total_shipping_cost += float(shipping_cost.price)
-                    cities_with_shipping += 1
+                total_shipping_cost += shipping_price
+                cities_with_shipping += 1
                 
                 # Prepare city data
                 city_data = {
@@ -2944,7 +4908,7 @@ def shipping():
                     'districts_count': districts_count,
                     'zones': [],  # Don't pass the actual relationship objects
                     'districts': [],  # Don't pass the actual relationship objects
-                    'shipping_price': float(shipping_cost.price) if shipping_cost and hasattr(shipping_cost, 'price') else 100.0
+                    'shipping_price': shipping_price
                 }
                 cities_data.append(city_data)
                 
@@ -2976,6 +4940,8 @@ def shipping():
         }
         
         db.session.commit()
+        if created_defaults:
+            geography_cache.invalidate()
         return render_template('admin/shipping.html', cities=cities_data, stats=stats)
         
     except Exception as e:
@@ -2994,8 +4960,9 @@ def delete_city(id):
         if not city:
             abort(404)
         
-        # Delete associated shipping costs
-        ShippingCost.query.filter_by(city_id=city.city_id).delete()
+        # Delete associated shipping costs (one by one, so the sales rollup is repriced)
+        for shipping_cost in ShippingCost.query.filter_by(city_id=city.city_id):
+            db.session.delete(shipping_cost)
         
         # Delete associated zones
         Zone.query.filter_by(city_id=city.city_id).delete()
@@ -3006,6 +4973,7 @@ def delete_city(id):
         # Delete the city
         db.session.delete(city)
         db.session.commit()
+        geography_cache.invalidate()
         
         flash('تم حذف المدينة بنجاح!', 'success')
         
@@ -3043,6 +5011,7 @@ def add_city():
         shipping = ShippingCost(city_id=city_id, price=shipping_price)
         db.session.add(shipping)
         db.session.commit()
+        geography_cache.invalidate()
         flash(f'تمت إضافة المدينة "{name}" بنجاح!', 'success')
     except Exception as e:
         db.session.rollback()
@@ -3070,6 +5039,7 @@ def update_shipping_cost():
             shipping_cost.price = price
             
         db.session.commit()
+        geography_cache.invalidate()
         flash('تم تحديث تكلفة الشحن بنجاح!', 'success')
         
     except Exception as e:
@@ -3129,6 +5099,7 @@ def banner_add():
         )
         db.session.add(banner)
         db.session.commit()
+        home_banner_cache.invalidate()
         flash('تمت إضافة البانر بنجاح!', 'success')
     except Exception as e:
         db.session.rollback()
@@ -3164,6 +5135,7 @@ def banner_edit(banner_id):
             banner.image_url = new_image_url
 
         db.session.commit()
+        home_banner_cache.invalidate()
         flash('تم تحديث البانر بنجاح!', 'success')
     except Exception as e:
         db.session.rollback()
@@ -3180,6 +5152,7 @@ def banner_delete(banner_id):
         abort(404)
     db.session.delete(banner)
     db.session.commit()
+    home_banner_cache.invalidate()
     flash('تم حذف البانر', 'success')
     return redirect(url_for('admin.banners'))
 
@@ -3192,11 +5165,135 @@ def banner_toggle(banner_id):
         abort(404)
     banner.is_active = not banner.is_active
     db.session.commit()
+    home_banner_cache.invalidate()
     state = 'مفعّل' if banner.is_active else 'مخفي'
     flash(f'البانر الآن {state}', 'info')
     return redirect(url_for('admin.banners'))
 
 
+# ─── Promotions Admin ─────────────────────────────────────────
+
+def _parse_promotion_datetime(value):
+    value = (value or '').strip()
+    return datetime.strptime(value, '%Y-%m-%dT%H:%M') if value else None
+
+
+def _apply_promotion_form(rule, form):
+    """Copy the admin form onto ``rule``; raise ValueError with a message to flash."""
+    slug = form.get('slug', '').strip()
+    name = form.get('name', '').strip()
+    if not slug or not name:
+        raise ValueError('الاسم والرمز مطلوبان')
+    duplicate = PromotionRule.query.filter(PromotionRule.slug == slug, PromotionRule.id != rule.id).first()
+    if duplicate:
+        raise ValueError('يوجد عرض آخر بنفس الرمز')
+    target = form.get('target', 'items')
+    discount_type = form.get('discount_type', 'percent')
+    if target not in PROMOTION_TARGETS or discount_type not in PROMOTION_DISCOUNT_TYPES:
+        raise ValueError('نوع العرض غير صالح')
+    try:
+        amount = float(form.get('amount', 0) or 0)
+        priority = int(form.get('priority', 100) or 100)
+        product_ids = [int(part) for part in form.get('product_ids', '').replace('،', ',').split(',') if part.strip()]
+        starts_at = _parse_promotion_datetime(form.get('starts_at'))
+        ends_at = _parse_promotion_datetime(form.get('ends_at'))
+    except ValueError:
+        raise ValueError('تأكد من القيم الرقمية والتواريخ')
+    if amount < 0 or (discount_type == 'percent' and amount > 100):
+        raise ValueError('قيمة الخصم غير صالحة')
+    if starts_at and ends_at and ends_at < starts_at:
+        raise ValueError('تاريخ النهاية قبل تاريخ البداية')
+
+    rule.slug = slug
+    rule.name = name
+    rule.message = form.get('message', '').strip()
+    rule.target = target
+    rule.discount_type = discount_type
+    rule.amount = amount
+    rule.priority = priority
+    rule.product_ids = json.dumps(sorted(set(product_ids)))
+    rule.city_ids = json.dumps(sorted({city_id for city_id in form.getlist('city_ids') if city_id}))
+    rule.starts_at = starts_at
+    rule.ends_at = ends_at
+    rule.is_active = form.get('is_active') == 'on'
+
+
+@admin.route('/promotions')
+@admin_required
+def promotions():
+    rules = PromotionRule.query.order_by(PromotionRule.priority.asc(), PromotionRule.id.asc()).all()
+    cities = City.query.order_by(City.name.asc()).all()
+    return render_template('admin/promotions.html', rules=rules, cities=cities, now=datetime.now())
+
+
+@admin.route('/promotions/add', methods=['POST'])
+@admin_required
+def promotion_add():
+    try:
+        rule = PromotionRule()
+        _apply_promotion_form(rule, request.form)
+        db.session.add(rule)
+        db.session.commit()
+        promotion_cache.invalidate()
+        flash('تمت إضافة العرض بنجاح!', 'success')
+    except ValueError as e:
+        db.session.rollback()
+        flash(str(e), 'error')
+    except Exception as e:
+        db.session.rollback()
+        app.logger.error(f'promotion_add error: {e}')
+        flash('حدث خطأ أثناء إضافة العرض', 'error')
+    return redirect(url_for('admin.promotions'))
+
+
+@admin.route('/promotions/edit/<int:rule_id>', methods=['POST'])
+@admin_required
+def promotion_edit(rule_id):
+    rule = db.session.get(PromotionRule, rule_id)
+    if not rule:
+        abort(404)
+    try:
+        _apply_promotion_form(rule, request.form)
+        db.session.commit()
+        promotion_cache.invalidate()
+        flash('تم تحديث العرض بنجاح!', 'success')
+    except ValueError as e:
+        db.session.rollback()
+        flash(str(e), 'error')
+    except Exception as e:
+        db.session.rollback()
+        app.logger.error(f'promotion_edit error: {e}')
+        flash('حدث خطأ أثناء تحديث العرض', 'error')
+    return redirect(url_for('admin.promotions'))
+
+
+@admin.route('/promotions/delete/<int:rule_id>', methods=['POST'])
+@admin_required
+def promotion_delete(rule_id):
+    rule = db.session.get(PromotionRule, rule_id)
+    if not rule:
+        abort(404)
+    db.session.delete(rule)
+    db.session.commit()
+    promotion_cache.invalidate()
+    flash('تم حذف العرض', 'success')
+    return redirect(url_for('admin.promotions'))
+
+
+@admin.route('/promotions/toggle/<int:rule_id>', methods=['POST'])
+@admin_required
+def promotion_toggle(rule_id):
+    rule = db.session.get(PromotionRule, rule_id)
+    if not rule:
+        abort(404)
+    rule.is_active = not rule.is_active
+    db.session.commit()
+    promotion_cache.invalidate()
+    state = 'مفعّل' if rule.is_active else 'متوقف'
+    flash(f'العرض الآن {state}', 'info')
+    return redirect(url_for('admin.promotions'))
+
+
 # ─── Homepage Showcase Section ────────────────────────────────
 
 @admin.route('/showcase')
@@ -3233,6 +5330,7 @@ def showcase_add():
         )
         db.session.add(item)
         db.session.commit()
+        home_showcase_cache.invalidate()
         flash('تمت إضافة البطاقة بنجاح!', 'success')
     except Exception as e:
         db.session.rollback()
@@ -3266,6 +5364,7 @@ def showcase_edit(item_id):
         if new_image_url:
             item.image_url = new_image_url
         db.session.commit()
+        home_showcase_cache.invalidate()
         flash('تم تعديل البطاقة بنجاح!', 'success')
     except Exception as e:
         db.session.rollback()
@@ -3282,6 +5381,7 @@ def showcase_delete(item_id):
         abort(404)
     db.session.delete(item)
     db.session.commit()
+    home_showcase_cache.invalidate()
     flash('تم حذف البطاقة', 'success')
     return redirect(url_for('admin.showcase'))
 
@@ -3294,12 +5394,50 @@ def showcase_toggle(item_id):
         abort(404)
     item.is_active = not item.is_active
     db.session.commit()
+    home_showcase_cache.invalidate()
     flash('تم تغيير الحالة', 'info')
     return redirect(url_for('admin.showcase'))
 
 
 # ─────────────────────────────────────────────────────────────
 
+# Display labels of the order fields, shared by the order list and detail pages
+SHIPPING_STATUS_LABELS = {
+    'pending': 'قيد الانتظار',
+    'shipped': 'تم الشحن',
+    'delivered': 'تم التوصيل',
+    'cancelled': 'ملغي',
+    'returned': 'تم الإرجاع',
+}
+PAYMENT_STATUS_LABELS = {
+    'pending': 'قيد الانتظار',
+    'paid': 'تم الدفع',
+    'failed': 'فشل الدفع',
+    'refunded': 'تم الاسترجاع',
+}
+PAYMENT_METHOD_LABELS = {
+    'cash_on_delivery': 'الدفع عند الاستلام',
+    'vodafone_cash': 'فودافون كاش',
+    'visa': 'الدفع بالفيزا',
+}
+# Filter dropdowns of the order list
+ORDER_FILTER_OPTIONS = {
+    'payment': [
+        {'value': 'cash_on_delivery', 'label': 'الدفع عند الاستلام'},
+        {'value': 'vodafone_cash', 'label': 'فودافون كاش'},
+        {'value': 'visa', 'label': 'فيزا / ماستركارد'},
+    ],
+    'status': [
+        {'value': 'pending', 'label': 'قيد الانتظار'},
+        {'value': 'completed', 'label': 'مكتمل'},
+        {'value': 'cancelled', 'label': 'ملغي'},
+    ],
+    'shipping': [
+        {'value': status, 'label': SHIPPING_STATUS_LABELS[status]}
+        for status in ('pending', 'shipped', 'delivered', 'returned', 'cancelled')
+    ],
+}
+
 @admin.route('/orders')
 @admin_required
 def orders():
@@ -3366,70 +5504,35 @@ def orders():
             except ValueError:
                 app.logger.warning(f"Invalid date format: end_date={end_date}")
         
-        # Get total count of filtered orders for stats
-        total_filtered = base_query.count()
-        
-        # Apply pagination
-        paginated_orders = base_query.paginate(page=page, per_page=per_page, error_out=False)
-        orders = paginated_orders.items
-        
-        # Add additional information to each order
-        for order in orders:
-            # Get city information
-            city = City.query.filter_by(city_id=order.city).first()
-            order.city_name = city.name if city else "غير معروف"
-            
-            # Get order items count
-            order.items_count = OrderItem.query.filter_by(order_id=order.id).count()
-            
-            # Get shipping status display name
-            shipping_statuses = {
-                'pending': 'قيد الانتظار',
-                'shipped': 'تم الشحن',
-                'delivered': 'تم التوصيل',
-                'cancelled': 'ملغي',
-                'returned': 'تم الإرجاع'
-            }
-            order.shipping_status_display = shipping_statuses.get(order.shipping_status, order.shipping_status)
-            
-            # Get payment status display name
-            payment_statuses = {
-                'pending': 'قيد الانتظار',
-                'paid': 'تم الدفع',
-                'failed': 'فشل الدفع',
-                'refunded': 'تم الاسترجاع'
-            }
-            order.payment_status_display = payment_statuses.get(order.payment_status, order.payment_status)
-            
-            # Get payment method display name
-            payment_methods = {
-                'cash_on_delivery': 'الدفع عند الاستلام',
-                'vodafone_cash': 'فودافون كاش',
-                'visa': 'الدفع بالفيزا'
-            }
-            order.payment_method_display = payment_methods.get(order.payment_method, order.payment_method)
-        
-        # Get filter options for dropdowns
-        payment_options = [
-            {'value': 'cash_on_delivery', 'label': 'الدفع عند الاستلام'},
-            {'value': 'vodafone_cash', 'label': 'فودافون كاش'},
-            {'value': 'visa', 'label': 'فيزا / ماستركارد'}
-        ]
-        
-        status_options = [
-            {'value': 'pending', 'label': 'قيد الانتظار'},
-            {'value': 'completed', 'label': 'مكتمل'},
-            {'value': 'cancelled', 'label': 'ملغي'}
-        ]
-        
-        shipping_options = [
-            {'value': 'pending', 'label': 'قيد الانتظار'},
-            {'value': 'shipped', 'label': 'تم الشحن'},
-            {'value': 'delivered', 'label': 'تم التوصيل'},
-            {'value': 'returned', 'label': 'تم الإرجاع'},
-            {'value': 'cancelled', 'label': 'ملغي'}
-        ]
-        
+        # One query for the page: city names and item counts come from
+        # grouped subqueries joined on the order (one row each)
+        city_names = (db.select(City.city_id, db.func.min(City.name).label('name'))
+                      .group_by(City.city_id).subquery())
+        item_counts = (db.select(OrderItem.order_id, db.func.count(OrderItem.id).label('items_count'))
+                       .group_by(OrderItem.order_id).subquery())
+        page_query = (base_query
+                      .outerjoin(city_names, city_names.c.city_id == Order.city)
+                      .outerjoin(item_counts, item_counts.c.order_id == Order.id)
+                      .add_columns(city_names.c.name, item_counts.c.items_count))
+
+        # Keyset pagination on the id; the total is counted once (cached per LIST_COUNT_MODE)
+        paginated_orders = keyset_paginate(
+            page_query, [(Order.id, True)], per_page,
+            cursor=request.args.get('cursor'), page=page,
+            signature='|'.join([search, status_filter, payment_filter, shipping_filter, start_date, end_date]),
+            key=lambda row: (row[0].id,), count_query=base_query,
+        )
+        total_filtered = paginated_orders.total
+        orders = []
+        for order, city_name, items_count in paginated_orders.items:
+            order.city_name = city_name or "غير معروف"
+            order.items_count = items_count or 0
+            order.shipping_status_display = SHIPPING_STATUS_LABELS.get(order.shipping_status, order.shipping_status)
+            order.payment_status_display = PAYMENT_STATUS_LABELS.get(order.payment_status, order.payment_status)
+            order.payment_method_display = PAYMENT_METHOD_LABELS.get(order.payment_method, order.payment_method)
+            orders.append(order)
+        paginated_orders.items = orders
+
         return render_template('admin/orders.html', 
                                orders=orders, 
                                pagination=paginated_orders,
@@ -3442,11 +5545,7 @@ def orders():
                                    'start_date': start_date,
                                    'end_date': end_date
                                },
-                               options={
-                                   'payment': payment_options,
-                                   'status': status_options,
-                                   'shipping': shipping_options
-                               })
+                               options=ORDER_FILTER_OPTIONS)
         
     except Exception as e:
         app.logger.error(f'Error in orders route: {str(e)}')
@@ -3462,13 +5561,9 @@ def order_detail(order_id):
         if not order:
             abort(404)
         
-        # Get city information
-        city = City.query.filter_by(city_id=order.city).first()
-        city_name = city.name if city else "غير معروف"
-        
-        # Get shipping cost
-        shipping_cost = ShippingCost.query.filter_by(city_id=order.city).first()
-        shipping_price = shipping_cost.price if shipping_cost else 0
+        # Get city name and shipping cost from the rate table
+        city_name = shipping_quotes.city_name(order.city, "غير معروف")
+        shipping_price = shipping_quotes.rate(order.city) or 0
         
         # Get order items with product details (LEFT JOIN للتعامل مع المنتجات المحذوفة)
         order_items_with_product = (
@@ -3518,31 +5613,10 @@ def order_detail(order_id):
         # Calculate final totals
         total_amount = subtotal + shipping_price
         
-        # Get payment method display name
-        payment_methods = {
-            'cash_on_delivery': 'الدفع عند الاستلام',
-            'vodafone_cash': 'فودافون كاش',
-            'visa': 'الدفع بالفيزا'
-        }
-        payment_method_display = payment_methods.get(order.payment_method, order.payment_method)
-        
-        # Get shipping status display name
-        shipping_statuses = {
-            'pending': 'قيد الانتظار',
-            'shipped': 'تم الشحن',
-            'delivered': 'تم التوصيل',
-            'cancelled': 'ملغي'
-        }
-        shipping_status_display = shipping_statuses.get(order.shipping_status, order.shipping_status)
-        
-        # Get payment status display name
-        payment_statuses = {
-            'pending': 'قيد الانتظار',
-            'paid': 'تم الدفع',
-            'failed': 'فشل الدفع',
-            'refunded': 'تم الاسترجاع'
-        }
-        payment_status_display = payment_statuses.get(order.payment_status, order.payment_status)
+        # Display names
+        payment_method_display = PAYMENT_METHOD_LABELS.get(order.payment_method, order.payment_method)
+        shipping_status_display = SHIPPING_STATUS_LABELS.get(order.shipping_status, order.shipping_status)
+        payment_status_display = PAYMENT_STATUS_LABELS.get(order.payment_status, order.payment_status)
         
         # Prepare order summary
         order_summary = {
@@ -3566,8 +5640,7 @@ def order_detail(order_id):
                              order_items=order_items,
                              order_summary=order_summary,
                              available_products=available_products,
-                             city_name=city_name,
-                             shipping_cost=shipping_cost)
+                             city_name=city_name)
                              
     except Exception as e:
         app.logger.error(f'Error in order_detail: {str(e)}')
@@ -3730,116 +5803,102 @@ def delete_order(order_id):
         
     return redirect(url_for('admin.orders'))
 
+# ─── Order export ─────────────────────────────────────────────
+# Orders are exported in keyset batches of ORDER_EXPORT_CHUNK_SIZE orders
+# (newest first, seeking on the id). Each batch is one joined query (order,
+# city name, items and product names) fetched whole in its own short read
+# transaction, so a slow download never holds a SQLite read lock that would
+# block checkouts in other workers. Rows are written out as they arrive
+# (models/spreadsheet.py) and memory stays flat however many orders there
+# are. ?format=csv streams from the first batch; xlsx, the default, is sent
+# as soon as the sheet is written.
+
+app.config['ORDER_EXPORT_CHUNK_SIZE'] = int(os.getenv('ORDER_EXPORT_CHUNK_SIZE', '500'))
+
+ORDER_EXPORT_HEADERS = (
+    'اسم العميل', 'تليفون (محمول فقط)', 'المدينة', 'المنطقة', 'العنوان', 'قيمة التحصيل النقدي',
+    'عدد القطع', 'وصف الشحنة', 'مرجع الطلب', 'قيمة الشحنة',
+)
+
+
+def _order_export_batch(city_names, order_ids, before_id, size):
+    """Item lines of the next ``size`` orders below ``before_id``, newest first."""
+    batch = db.select(Order.id).order_by(Order.id.desc()).limit(size)
+    if before_id is not None:
+        batch = batch.where(Order.id < before_id)
+    if order_ids is not None:
+        batch = batch.where(Order.id.in_(order_ids))
+    lines = db.session.execute(
+        db.select(Order.id, Order.name, Order.phone, city_names.c.name, Order.zone_id, Order.address,
+                  Order.cod_amount, Order.business_reference, OrderItem.quantity, Product.name)
+        .select_from(Order)
+        .outerjoin(city_names, city_names.c.city_id == Order.city)
+        .outerjoin(OrderItem, OrderItem.order_id == Order.id)
+        .outerjoin(Product, Product.id == OrderItem.product_id)
+        .where(Order.id.in_(batch.scalar_subquery()))
+        .order_by(Order.id.desc(), OrderItem.id)
+    ).all()
+    # Read-only: end the transaction so the connection holds no lock while
+    # the client downloads this batch
+    db.session.rollback()
+    return lines
+
+
+def order_export_rows(order_ids=None):
+    """Yield one export row per order, newest first, one keyset batch at a time."""
+    city_names = (db.select(City.city_id, db.func.min(City.name).label('name'))
+                  .group_by(City.city_id).subquery())
+    size = app.config['ORDER_EXPORT_CHUNK_SIZE']
+    before_id = None
+    while True:
+        lines = _order_export_batch(city_names, order_ids, before_id, size)
+        if not lines:
+            return
+        # Rows of one order are adjacent, one per item
+        orders = 0
+        for order_id, order_lines in groupby(lines, key=lambda line: line[0]):
+            order_lines = tuple(order_lines)
+            _, name, phone, city_name, zone_id, address, cod_amount, reference, _, _ = order_lines[0]
+            # Items of deleted products are left out, as on the order page
+            products = [(quantity, product_name) for *_, quantity, product_name in order_lines if product_name]
+            yield (name, phone, city_name or 'Unknown', zone_id, address, cod_amount,
+                   sum(quantity for quantity, _ in products),
+                   ', '.join(product_name for _, product_name in products), reference or '', cod_amount)
+            before_id = order_id
+            orders += 1
+        if orders < size:
+            return
+
+
+def order_export_response(rows, filename):
+    """Stream ``rows`` as an attachment in the requested ``format`` (xlsx or csv)."""
+    if request.values.get('format') == 'csv':
+        chunks, mimetype, filename = csv_chunks(ORDER_EXPORT_HEADERS, rows), CSV_MIMETYPE, f'{filename}.csv'
+    else:
+        chunks = xlsx_chunks(ORDER_EXPORT_HEADERS, rows, sheet_name='الطلبات')
+        mimetype, filename = XLSX_MIMETYPE, f'{filename}.xlsx'
+    response = Response(stream_with_context(chunks), mimetype=mimetype)
+    response.headers['Content-Disposition'] = f"attachment; filename*=UTF-8''{quote(filename)}"
+    response.headers['Cache-Control'] = 'no-store'
+    return response
+
+
 @admin.route('/export_orders')
 @admin_required
 def export_orders():
-    try:
-        # Get all orders with their items
-        orders = Order.query.order_by(Order.id.desc()).all()
-        
-        data = []
-        for order in orders:
-            order_items = db.session.query(OrderItem, Product).join(Product, OrderItem.product_id == Product.id).filter(OrderItem.order_id == order.id).all()
-            total_quantity = sum(item.OrderItem.quantity for item in order_items)
-            product_names = ', '.join([item.Product.name for item in order_items if item.Product])
-            city = City.query.filter_by(city_id=order.city).first()
-            city_name = city.name if city else 'Unknown'
-            
-            # Prepare order data
-            order_data = {
-                'اسم العميل': order.name,
-                'تليفون (محمول فقط)': order.phone,
-                'المدينة': city_name,
-                'المنطقة': order.zone_id,
-                'العنوان': order.address,
-                'قيمة التحصيل النقدي': order.cod_amount,
-                'عدد القطع': total_quantity,
-                'وصف الشحنة': product_names,
-                'مرجع الطلب': order.business_reference or '',
-                'قيمة الشحنة': order.cod_amount
-            }
-            data.append(order_data)
-        
-        # Create DataFrame
-        df = pd.DataFrame(data)
-        
-        # Create the file in memory
-        output = BytesIO()
-        with pd.ExcelWriter(output, engine='openpyxl') as writer:
-            df.to_excel(writer, index=False, sheet_name='الطلبات')
-        
-        output.seek(0)
-        
-        # Send the file as a response
-        return send_file(
-            output,
-            mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
-            as_attachment=True,
-            download_name='الطلبات.xlsx'
-        )
-        
-    except Exception as e:
-        app.logger.error(f'Error exporting orders: {str(e)}')
-        flash('حدث خطأ أثناء تصدير الطلبات', 'error')
-        return redirect(url_for('admin.orders'))
+    return order_export_response(order_export_rows(), 'الطلبات')
 
 @admin.route('/export_selected_orders', methods=['POST'])
 @admin_required
 def export_selected_orders():
     try:
-        selected_order_ids = request.form.getlist('order_ids')
-        if not selected_order_ids:
-            flash('الرجاء اختيار طلبات للتصدير', 'error')
-            return redirect(url_for('admin.orders'))
-            
-        order_ids = [int(order_id) for order_id in selected_order_ids]
-        orders = Order.query.filter(Order.id.in_(order_ids)).all()
-        
-        data = []
-        for order in orders:
-            order_items = db.session.query(OrderItem, Product).join(Product, OrderItem.product_id == Product.id).filter(OrderItem.order_id == order.id).all()
-            total_quantity = sum(item.OrderItem.quantity for item in order_items)
-            product_names = ', '.join([item.Product.name for item in order_items if item.Product])
-            city = City.query.filter_by(city_id=order.city).first()
-            city_name = city.name if city else 'Unknown'
-            
-            # Prepare order data
-            order_data = {
-                'اسم العميل': order.name,
-                'تليفون (محمول فقط)': order.phone,
-                'المدينة': city_name,
-                'المنطقة': order.zone_id,
-                'العنوان': order.address,
-                'قيمة التحصيل النقدي': order.cod_amount,
-                'عدد القطع': total_quantity,
-                'وصف الشحنة': product_names,
-                'مرجع الطلب': order.business_reference or '',
-                'قيمة الشحنة': order.cod_amount
-            }
-            data.append(order_data)
-        
-        # Create DataFrame
-        df = pd.DataFrame(data)
-        
-        # Create the file in memory
-        output = BytesIO()
-        with pd.ExcelWriter(output, engine='openpyxl') as writer:
-            df.to_excel(writer, index=False, sheet_name='الطلبات')
-        
-        output.seek(0)
-        
-        # Send the file as a response
-        return send_file(
-            output,
-            mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
-            as_attachment=True,
-            download_name='الطلبات المحددة.xlsx'
-        )
-        
-    except Exception as e:
-        app.logger.error(f'Error exporting selected orders: {str(e)}')
-        flash('حدث خطأ أثناء تصدير الطلبات المحددة', 'error')
+        order_ids = [int(order_id) for order_id in request.form.getlist('order_ids')]
+    except ValueError:
+        order_ids = []
+    if not order_ids:
+        flash('الرجاء اختيار طلبات للتصدير', 'error')
         return redirect(url_for('admin.orders'))
+    return order_export_response(order_export_rows(order_ids), 'الطلبات المحددة')
 
 @admin.route('/order/<int:order_id>/ship', methods=['POST'])
 @admin_required
@@ -3907,6 +5966,7 @@ def update_order_shipping_price(order_id):
         order.shipping_cost = new_shipping_price
         
         db.session.commit()
+        geography_cache.invalidate()
         
         flash('تم تحديث تكلفة الشحن بنجاح', 'success')
         return redirect(url_for('admin.order_detail', order_id=order_id))
@@ -4001,8 +6061,7 @@ def test_db():
 @shop.route('/get_zones/<string:city_id>')
 def get_zones(city_id):
     try:
-        zones = Zone.query.filter_by(city_id=city_id).all()
-        return jsonify(zones=[zone.serialize() for zone in zones])
+        return _city_geography_response(city_id, 'zones')
     except Exception as e:
         app.logger.error(f"Error fetching zones: {str(e)}")
         return jsonify({'error': 'Failed to fetch zones'}), 500
@@ -4011,23 +6070,10 @@ def get_zones(city_id):
 @shop.route('/get_districts/<string:city_id>')
 def get_districts(city_id):
     try:
-        # First find the city by its city_id string
-        city = City.query.filter_by(city_id=city_id).first()
-        if not city:
+        if city_id not in geography_snapshot().by_city:
             app.logger.error(f"City not found with city_id: {city_id}")
             return jsonify({'error': 'City not found'}), 404
-            
-        # Then get districts for this city
-        districts = District.query.filter_by(city_id=city_id).all()
-        app.logger.info(f"Found {len(districts)} districts for city_id: {city_id}")
-        
-        # Debug the districts data
-        for district in districts:
-            app.logger.info(f"District: id={district.id}, name={district.name}, city_id={district.city_id}")
-            
-        # Return districts in the format expected by the frontend
-        return jsonify(districts=[district.serialize() for district in districts])
-        
+        return _city_geography_response(city_id, 'districts')
     except Exception as e:
         app.logger.error(f"Error fetching districts: {str(e)}")
         return jsonify({'error': 'Failed to fetch districts'}), 500
@@ -4035,54 +6081,22 @@ def get_districts(city_id):
 @shop.route('/get_shipping_cost/<string:city_id>')
 def get_shipping_cost(city_id):
     try:
-        city = City.query.filter_by(city_id=city_id).first()
-        if not city:
+        if not shipping_quotes.city_name(city_id):
             return jsonify({'error': 'City not found'}), 404
         
         # Get cart items to check for discounts
-        user = Gusts.query.filter_by(session=session['session']).first()
-        cart_items = Cart.query.filter_by(user_id=user.id).all()
-        
-        # Check for Eid Al-Adha offer first
-        eid_offer_info = check_eid_shipping_offer(cart_items, city_id)
+        user = current_guest()
+        cart_items = Cart.query.filter_by(user_id=user.id).all() if user else []
         
-        # Check if the order qualifies for regular free shipping
-        discount_info = check_shipping_discount(cart_items)
-        
-        # Get standard shipping cost
-        shipping_cost = ShippingCost.query.filter_by(city_id=city.city_id).first()
-        if not shipping_cost:
-            # Return default shipping cost if not found
-            standard_cost = 80
-        else:
-            standard_cost = shipping_cost.price
-        
-        # Apply Eid offer if eligible (takes priority over regular discounts)
-        if eid_offer_info['eligible']:
-            discount_amount = standard_cost * eid_offer_info['discount']
-            final_cost = standard_cost - discount_amount
-            discount_message = eid_offer_info['message']
-            discount_applied = True
-        # Apply regular discount if eligible and no Eid offer
-        elif discount_info['eligible']:
-            # Free shipping
-            final_cost = 0
-            discount_message = ""
-            if discount_info['discount_type'] == "combo_1_2_3":
-                discount_message = "Free shipping - Special offer for products #1, #2, and #3"
-            discount_applied = True
-        else:
-            final_cost = standard_cost
-            discount_message = None
-            discount_applied = False
+        # Cities without a rate are quoted at the default of 80
+        shipping_quote = shipping_quotes.quote(city_id, cart_items, default=80)
         
         return jsonify({
-            'shipping_cost': final_cost,
-            'standard_cost': standard_cost,
-            'discount_applied': discount_applied,
-            'discount_message': discount_message,
-            'eid_offer_active': eid_offer_info.get('offer_active', False),
-            'eid_offer_type': eid_offer_info.get('offer_type', None)
+            'shipping_cost': shipping_quote.price,
+            'standard_cost': shipping_quote.base_price,
+            'discount_applied': shipping_quote.offer is not None,
+            'discount_message': shipping_quote.message,
+            'offer': shipping_quote.offer
         })
         
     except Exception as e:
@@ -4118,14 +6132,15 @@ def export_income_stats():
         )
         
         # Apply date filter if provided
+        product_day_filter = []
         if (start_date and end_date):
             try:
                 # Convert dates to datetime objects
                 start = datetime.strptime(start_date, '%Y-%m-%d')
                 end = datetime.strptime(end_date, '%Y-%m-%d')
                 # Add one day to end date to include the full day
-                end = end + timedelta(days=1)
-                query = query.filter(Order.created_at.between(start, end))
+                query = query.filter(Order.created_at >= start, Order.created_at < end + timedelta(days=1))
+                product_day_filter = [DailyProductSales.day.between(start.date(), end.date())]
             except ValueError as e:
                 app.logger.error(f'Error parsing dates: {str(e)}')
                 flash('خطأ في تنسيق التواريخ', 'error')
@@ -4138,8 +6153,9 @@ def export_income_stats():
             'سيروم الرموش': 35
         }
 
-        # Get all orders
+        # Get all orders and their shipping prices in one pass
         orders = query.all()
+        shipping_prices = shipping_quotes.quote_many(order.city for order in orders)
         
         data = []
         total_cash_collection = 0
@@ -4149,58 +6165,28 @@ def export_income_stats():
         delivered_count = 0
         returned_count = 0
 
-        # Initialize product stats
-        product_stats = {}
-        
         for order in orders:
             # Get shipping cost for the order
-            shipping_cost = ShippingCost.query.filter_by(city_id=order.city).first()
-            shipping_price = shipping_cost.price if shipping_cost else 0
+            shipping_price = shipping_prices[order.city]
             
             # Calculate manufacturing cost (20 per order)
             manufacturing_cost = 20
             
             # Calculate net amount based on order status
             if order.shipping_status == 'delivered':
+                delivered_count += 1
                 cash_collection = float(order.cod_amount) if order.cod_amount else 0
                 net_amount = cash_collection - shipping_price - manufacturing_cost
-                delivered_count += 1
-
-                # Process product details for delivered orders only
-                order_items = (
-                    db.session.query(OrderItem, Product)
-                    .join(Product, OrderItem.product_id == Product.id)
-                    .filter(OrderItem.order_id == order.id)
-                    .all()
-                )
-                
-                for item in order_items:
-                    product_name = item.Product.name
-                    quantity = item.OrderItem.quantity
-                    
-                    if product_name not in product_stats:
-                        product_stats[product_name] = {
-                            'quantity': 0,
-                            'revenue': 0,
-                            'cost': 0
-                        }
-                    
-                    product_stats[product_name]['quantity'] += quantity
-                    product_stats[product_name]['revenue'] += quantity * float(item.Product.price)
-                    production_cost = product_costs.get(product_name, 0)
-                    product_stats[product_name]['cost'] += quantity * production_cost
-
             else:  # returned
+                returned_count += 1
                 cash_collection = 0
                 net_amount = -shipping_price - manufacturing_cost  # Subtract both shipping and manufacturing costs
-                returned_count += 1
-            
-            # Add to totals
+
             total_cash_collection += cash_collection
             total_shipping_cost += shipping_price
             total_manufacturing_cost += manufacturing_cost
             total_net += net_amount
-            
+
             # Prepare order data
             order_data = {
                 'اسم العميل': order.name,
@@ -4214,6 +6200,20 @@ def export_income_stats():
             }
             data.append(order_data)
 
+        # Quantities sold come from the daily sales rollup, priced at today's prices
+        product_stats = {}
+        product_rows = db.session.execute(
+            db.select(Product.name, Product.price, db.func.sum(DailyProductSales.quantity))
+            .join(Product, DailyProductSales.product_id == Product.id)
+            .where(*product_day_filter)
+            .group_by(Product.id, Product.name, Product.price)
+        ).all()
+        for product_name, price, quantity in product_rows:
+            stats = product_stats.setdefault(product_name, {'quantity': 0, 'revenue': 0, 'cost': 0})
+            stats['quantity'] += quantity
+            stats['revenue'] += quantity * float(price)
+            stats['cost'] += quantity * product_costs.get(product_name, 0)
+
         # Add summary row
         summary = {
             'اسم العميل': '',
@@ -4364,6 +6364,45 @@ def get_time_ago(created_at):
     else:
         return "منذ لحظات"
 
+@admin.route('/api/metrics/housekeeping')
+@admin_required
+def housekeeping_metrics():
+    """Per-task counters of this worker's housekeeping thread."""
+    return jsonify({'success': True, 'pid': os.getpid(), 'tasks': housekeeping_stats()})
+
+@admin.route('/api/metrics/cache')
+@admin_required
+def cache_metrics():
+    """Hit/miss counters of this worker's process-local caches."""
+    return jsonify({'success': True, 'pid': os.getpid(), 'caches': cache_stats()})
+
+@admin.route('/api/metrics/http')
+@admin_required
+def http_metrics():
+    """Per-endpoint latency/errors and circuit state of outbound API clients."""
+    return jsonify({'success': True, 'pid': os.getpid(), 'transports': transport_stats()})
+
+@admin.route('/api/metrics/notifications')
+@admin_required
+def notification_metrics():
+    """Outbox backlog per status and the latest dead letters."""
+    return jsonify({'success': True, **notification_outbox_stats()})
+
+@admin.route('/api/notifications/<int:entry_id>/retry', methods=['POST'])
+@admin_required
+def retry_notification(entry_id):
+    """Put a dead (or stuck) outbox entry back in the queue."""
+    entry = db.session.get(NotificationOutbox, entry_id)
+    if not entry:
+        return jsonify({'success': False, 'message': 'الإشعار غير موجود'}), 404
+    if entry.status == 'sent':
+        return jsonify({'success': False, 'message': 'تم إرسال الإشعار بالفعل'}), 400
+    entry.status = 'pending'
+    entry.attempts = 0
+    entry.next_attempt_at = utc_now()
+    db.session.commit()
+    return jsonify({'success': True, 'notification': entry.to_dict()})
+
 @admin.route('/order/<int:order_id>/update-payment-method', methods=['POST'])
 @admin_required
 def update_payment_method(order_id):
@@ -0,0 +1,77 @@
+"""Index hot lookup columns and make order_item.order_id a foreign key
+
+Revision ID: 37131384feed
+Revises:
+Create Date: 2026-10-17 10:12:00.000000
+
+Databases created before this revision were built by ``db.create_all()``
+without any of these indexes. Fresh databases already get them from the
+models, so every step is guarded and the revision is safe to run on both.
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '37131384feed'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+INDEXES = [
+    # check_session(): WHERE session = ?
+    ('ix_gusts_session', 'gusts', ['session']),
+    # cart page / badge count (user_id) and add_to_cart (user_id, product_id)
+    ('ix_cart_user_id_product_id', 'cart', ['user_id', 'product_id']),
+    ('ix_cart_product_id', 'cart', ['product_id']),
+    # cart_sweep: WHERE created_at < ?
+    ('ix_cart_created_at', 'cart', ['created_at']),
+    ('ix_order_user_id', 'order', ['user_id']),
+    # payment webhook: WHERE invoice_key = ?
+    ('ix_order_invoice_key', 'order', ['invoice_key']),
+    ('ix_order_created_at', 'order', ['created_at']),
+    ('ix_order_shipping_status_created_at', 'order', ['shipping_status', 'created_at']),
+    ('ix_order_item_order_id', 'order_item', ['order_id']),
+    ('ix_order_item_product_id', 'order_item', ['product_id']),
+    ('ix_city_city_id', 'city', ['city_id']),
+    ('ix_zone_city_id', 'zone', ['city_id']),
+    ('ix_district_city_id', 'district', ['city_id']),
+    ('ix_shipping_cost_city_id', 'shipping_cost', ['city_id']),
+    ('ix_product_created_at', 'product', ['created_at']),
+    ('ix_product_views', 'product', ['views']),
+    ('ix_product_discount', 'product', ['discount']),
+    ('ix_product_category_id_created_at', 'product', ['category_id', 'created_at']),
+    ('ix_promo_code_code', 'promo_code', ['code']),
+]
+
+ORDER_ITEM_FK = 'fk_order_item_order_id_order'
+# SQLite reflects foreign keys without names; batch mode needs one to drop it
+NAMING_CONVENTION = {'fk': 'fk_%(table_name)s_%(column_0_name)s_%(referred_table_name)s'}
+
+
+def _has_order_item_fk():
+    return any(fk['referred_table'] == 'order' and fk['constrained_columns'] == ['order_id']
+               for fk in sa.inspect(op.get_bind()).get_foreign_keys('order_item'))
+
+
+def upgrade():
+    for name, table, columns in INDEXES:
+        op.create_index(name, table, columns, unique=False, if_not_exists=True)
+
+    if not _has_order_item_fk():
+        # SQLite cannot add a constraint in place; batch mode copies the table
+        with op.batch_alter_table('order_item', recreate='always',
+                                  naming_convention=NAMING_CONVENTION) as batch_op:
+            batch_op.create_foreign_key(ORDER_ITEM_FK, 'order', ['order_id'], ['id'])
+
+
+def downgrade():
+    if _has_order_item_fk():
+        with op.batch_alter_table('order_item', recreate='always',
+                                  naming_convention=NAMING_CONVENTION) as batch_op:
+            batch_op.drop_constraint(ORDER_ITEM_FK, type_='foreignkey')
+
+    for name, table, _ in reversed(INDEXES):
+        op.drop_index(name, table_name=table, if_exists=True)
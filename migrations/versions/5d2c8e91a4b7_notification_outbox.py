@@ -0,0 +1,41 @@
+"""Add the notification outbox table
+
+Revision ID: 5d2c8e91a4b7
+Revises: 37131384feed
+Create Date: 2026-10-17 11:05:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5d2c8e91a4b7'
+down_revision = '37131384feed'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'notification_outbox',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('channel', sa.String(length=50), nullable=False),
+        sa.Column('payload', sa.Text(), nullable=False),
+        sa.Column('status', sa.String(length=20), nullable=False),
+        sa.Column('attempts', sa.Integer(), nullable=False),
+        sa.Column('next_attempt_at', sa.DateTime(), nullable=False),
+        sa.Column('last_error', sa.Text(), nullable=True),
+        sa.Column('created_at', sa.DateTime(), nullable=False),
+        sa.Column('sent_at', sa.DateTime(), nullable=True),
+        sa.PrimaryKeyConstraint('id'),
+        if_not_exists=True,
+    )
+    op.create_index('ix_notification_outbox_status_next_attempt_at', 'notification_outbox',
+                    ['status', 'next_attempt_at'], unique=False, if_not_exists=True)
+
+
+def downgrade():
+    op.drop_index('ix_notification_outbox_status_next_attempt_at',
+                  table_name='notification_outbox', if_exists=True)
+    op.drop_table('notification_outbox', if_exists=True)
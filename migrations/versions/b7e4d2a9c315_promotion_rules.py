@@ -0,0 +1,81 @@
+"""Add the promotion rule table and the offers that used to be hardcoded
+
+Revision ID: b7e4d2a9c315
+Revises: 8f3a1c6d2e90
+Create Date: 2026-10-17 15:20:00.000000
+
+"""
+from datetime import datetime, timezone
+import json
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b7e4d2a9c315'
+down_revision = '8f3a1c6d2e90'
+branch_labels = None
+depends_on = None
+
+# Free shipping for the Eid offer went to cities whose name contains one of these
+EID_FREE_SHIPPING_CITIES = ('الاسكندريه', 'القاهره', 'الجيزه', 'البحيره')
+
+
+def upgrade():
+    promotion_rule = op.create_table(
+        'promotion_rule',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('slug', sa.String(length=50), nullable=False),
+        sa.Column('name', sa.String(length=120), nullable=False),
+        sa.Column('message', sa.String(length=255), nullable=False),
+        sa.Column('target', sa.String(length=20), nullable=False),
+        sa.Column('discount_type', sa.String(length=20), nullable=False),
+        sa.Column('amount', sa.Float(), nullable=False),
+        sa.Column('product_ids', sa.Text(), nullable=False),
+        sa.Column('city_ids', sa.Text(), nullable=False),
+        sa.Column('starts_at', sa.DateTime(), nullable=True),
+        sa.Column('ends_at', sa.DateTime(), nullable=True),
+        sa.Column('priority', sa.Integer(), nullable=False),
+        sa.Column('is_active', sa.Boolean(), nullable=False),
+        sa.Column('created_at', sa.DateTime(), nullable=False),
+        sa.Column('updated_at', sa.DateTime(), nullable=False),
+        sa.PrimaryKeyConstraint('id'),
+        sa.UniqueConstraint('slug'),
+        if_not_exists=True,
+    )
+
+    bind = op.get_bind()
+    if bind.execute(sa.text('SELECT COUNT(*) FROM promotion_rule')).scalar():
+        return
+    eid_cities = [
+        str(city_id) for city_id, name in bind.execute(sa.text('SELECT city_id, name FROM city'))
+        if any(fragment in (name or '') for fragment in EID_FREE_SHIPPING_CITIES)
+    ]
+    now = datetime.now(timezone.utc).replace(tzinfo=None)
+    eid_window = {'starts_at': datetime(2025, 6, 5), 'ends_at': datetime(2025, 6, 11, 23, 59, 59)}
+    rules = [
+        dict(slug='promo_10_jan_2026', name='خصم 10%', message='خصم 10% على جميع الطلبات! 🎉',
+             target='items', discount_type='percent', amount=10, product_ids='[]', city_ids='[]',
+             starts_at=datetime(2026, 1, 4), ends_at=datetime(2026, 1, 9, 23, 59, 59), priority=10,
+             is_active=True),
+        dict(slug='eid_free_shipping', name='عرض عيد الأضحى - شحن مجاني',
+             message='🎉 شحن مجاني - عرض عيد الأضحى على باقة العناية الكاملة',
+             target='shipping', discount_type='percent', amount=100, product_ids='[4]',
+             city_ids=json.dumps(eid_cities), priority=10, is_active=bool(eid_cities), **eid_window),
+        dict(slug='eid_50_percent', name='عرض عيد الأضحى - خصم 50% على الشحن',
+             message='🎉 خصم 50% على الشحن - عرض عيد الأضحى على باقة العناية الكاملة',
+             target='shipping', discount_type='percent', amount=50, product_ids='[4]', city_ids='[]',
+             priority=20, is_active=True, **eid_window),
+        dict(slug='combo_1_2_3', name='شحن مجاني للمنتجات 1 و2 و3',
+             message='Free shipping - Special offer for products #1, #2, and #3',
+             target='shipping', discount_type='percent', amount=100, product_ids='[1, 2, 3]', city_ids='[]',
+             starts_at=None, ends_at=None, priority=30, is_active=True),
+    ]
+    for rule in rules:
+        rule.update(created_at=now, updated_at=now)
+    op.bulk_insert(promotion_rule, rules)
+
+
+def downgrade():
+    op.drop_table('promotion_rule', if_exists=True)
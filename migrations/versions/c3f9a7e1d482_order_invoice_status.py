@@ -0,0 +1,46 @@
+"""Track Fawaterak invoice creation on the order
+
+Revision ID: c3f9a7e1d482
+Revises: b7e4d2a9c315
+Create Date: 2026-10-17 17:05:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c3f9a7e1d482'
+down_revision = 'b7e4d2a9c315'
+branch_labels = None
+depends_on = None
+
+COLUMNS = (
+    ('invoice_status', sa.String(length=20)),
+    ('invoice_requested_at', sa.DateTime()),
+    ('invoice_error', sa.String(length=255)),
+)
+
+
+def _existing_columns():
+    return {column['name'] for column in sa.inspect(op.get_bind()).get_columns('order')}
+
+
+def upgrade():
+    existing = _existing_columns()
+    with op.batch_alter_table('order') as batch_op:
+        for name, type_ in COLUMNS:
+            if name not in existing:
+                batch_op.add_column(sa.Column(name, type_, nullable=True))
+
+    # Orders that already have an invoice link need no new one
+    order = sa.table('order', sa.column('invoice_url', sa.String), sa.column('invoice_status', sa.String))
+    op.execute(order.update().where(order.c.invoice_url.isnot(None)).values(invoice_status='ready'))
+
+
+def downgrade():
+    existing = _existing_columns()
+    with op.batch_alter_table('order') as batch_op:
+        for name, _ in reversed(COLUMNS):
+            if name in existing:
+                batch_op.drop_column(name)
@@ -0,0 +1,115 @@
+"""Add the daily sales rollup tables
+
+Revision ID: d8a2f4c6b013
+Revises: c3f9a7e1d482
+Create Date: 2026-10-17 18:30:00.000000
+
+Existing orders are rolled up here, with the same rules as
+refresh_daily_sales in app.py; `flask --app app backfill-daily-sales`
+rebuilds the rollup later if needed.
+"""
+from datetime import datetime, timezone
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd8a2f4c6b013'
+down_revision = 'c3f9a7e1d482'
+branch_labels = None
+depends_on = None
+
+# Order rows joined to their city's first shipping rate, as the app prices them
+RATED_ORDERS = """
+    "order" LEFT OUTER JOIN (
+        SELECT CAST(city_id AS VARCHAR) AS city_id, price FROM shipping_cost
+        WHERE id IN (SELECT MIN(id) FROM shipping_cost GROUP BY city_id)
+    ) AS rates ON rates.city_id = "order".city
+"""
+
+BACKFILL_DAILY_SALES = f"""
+    INSERT INTO daily_sales (day, orders_count, pending_count, shipped_count, delivered_count,
+                             returned_count, cancelled_count, cod_collected, shipping_cost,
+                             returned_shipping, net_revenue, items_sold, updated_at)
+    SELECT date("order".created_at), COUNT("order".id),
+           SUM(CASE WHEN shipping_status = 'pending' THEN 1 ELSE 0 END),
+           SUM(CASE WHEN shipping_status = 'shipped' THEN 1 ELSE 0 END),
+           SUM(CASE WHEN shipping_status = 'delivered' THEN 1 ELSE 0 END),
+           SUM(CASE WHEN shipping_status = 'returned' THEN 1 ELSE 0 END),
+           SUM(CASE WHEN shipping_status = 'cancelled' THEN 1 ELSE 0 END),
+           SUM(CASE WHEN shipping_status = 'delivered' THEN COALESCE(cod_amount, 0) ELSE 0 END),
+           SUM(CASE WHEN shipping_status = 'delivered' THEN COALESCE(price, 0) ELSE 0 END),
+           SUM(CASE WHEN shipping_status = 'returned' THEN COALESCE(price, 0) ELSE 0 END),
+           SUM(CASE WHEN shipping_status = 'delivered' AND cod_amount - COALESCE(price, 0) > 0
+                    THEN cod_amount - COALESCE(price, 0) ELSE 0 END),
+           0, :now
+    FROM {RATED_ORDERS}
+    WHERE "order".created_at IS NOT NULL
+    GROUP BY date("order".created_at)
+"""
+
+BACKFILL_DAILY_PRODUCT_SALES = """
+    INSERT INTO daily_product_sales (day, product_id, quantity, revenue)
+    SELECT date("order".created_at), order_item.product_id, SUM(order_item.quantity),
+           SUM(order_item.quantity * product.price)
+    FROM order_item
+    JOIN "order" ON order_item.order_id = "order".id
+    JOIN product ON order_item.product_id = product.id
+    WHERE "order".shipping_status = 'delivered' AND "order".created_at IS NOT NULL
+    GROUP BY date("order".created_at), order_item.product_id
+"""
+
+ITEMS_SOLD = """
+    UPDATE daily_sales SET items_sold = (
+        SELECT COALESCE(SUM(quantity), 0) FROM daily_product_sales
+        WHERE daily_product_sales.day = daily_sales.day
+    )
+"""
+
+
+def upgrade():
+    op.create_table(
+        'daily_sales',
+        sa.Column('day', sa.Date(), nullable=False),
+        sa.Column('orders_count', sa.Integer(), nullable=False),
+        sa.Column('pending_count', sa.Integer(), nullable=False),
+        sa.Column('shipped_count', sa.Integer(), nullable=False),
+        sa.Column('delivered_count', sa.Integer(), nullable=False),
+        sa.Column('returned_count', sa.Integer(), nullable=False),
+        sa.Column('cancelled_count', sa.Integer(), nullable=False),
+        sa.Column('cod_collected', sa.Float(), nullable=False),
+        sa.Column('shipping_cost', sa.Float(), nullable=False),
+        sa.Column('returned_shipping', sa.Float(), nullable=False),
+        sa.Column('net_revenue', sa.Float(), nullable=False),
+        sa.Column('items_sold', sa.Integer(), nullable=False),
+        sa.Column('updated_at', sa.DateTime(), nullable=False),
+        sa.PrimaryKeyConstraint('day'),
+        if_not_exists=True,
+    )
+    op.create_table(
+        'daily_product_sales',
+        sa.Column('day', sa.Date(), nullable=False),
+        sa.Column('product_id', sa.Integer(), nullable=False),
+        sa.Column('quantity', sa.Integer(), nullable=False),
+        sa.Column('revenue', sa.Float(), nullable=False),
+        sa.ForeignKeyConstraint(['product_id'], ['product.id'], ondelete='CASCADE'),
+        sa.PrimaryKeyConstraint('day', 'product_id'),
+        if_not_exists=True,
+    )
+    op.create_index('ix_daily_product_sales_product_id', 'daily_product_sales', ['product_id'],
+                    unique=False, if_not_exists=True)
+
+    # Roll up the existing orders so the dashboard is right straight after the upgrade
+    bind = op.get_bind()
+    if bind.execute(sa.text('SELECT COUNT(*) FROM daily_sales')).scalar():
+        return
+    bind.execute(sa.text(BACKFILL_DAILY_SALES), {'now': datetime.now(timezone.utc).replace(tzinfo=None)})
+    bind.execute(sa.text(BACKFILL_DAILY_PRODUCT_SALES))
+    bind.execute(sa.text(ITEMS_SOLD))
+
+
+def downgrade():
+    op.drop_index('ix_daily_product_sales_product_id', table_name='daily_product_sales', if_exists=True)
+    op.drop_table('daily_product_sales', if_exists=True)
+    op.drop_table('daily_sales', if_exists=True)
@@ -1,35 +1,52 @@
 import requests
 import os
 
+from models.http_client import HttpTransport, CircuitBreaker
+
 BOSTA_API_KEY = "Bearer eyJhbGciOiJIUzI1NiIsInR5cCI6IkpXVCJ9.eyJpZCI6InRHOU9wVE5YRzVXTDdnZkQyUXpRZCIsInJvbGVzIjpbIkJVU0lORVNTX0FETUlOIl0sImJ1c2luZXNzQWRtaW5JbmZvIjp7ImJ1c2luZXNzSWQiOiJEZGcwSHlGYnJBakVvSERsMFltR1kiLCJidXNpbmVzc05hbWUiOiJPcmZlIn0sImNvdW50cnkiOnsiX2lkIjoiNjBlNDQ4MmM3Y2I3ZDRiYzQ4NDljNGQ1IiwibmFtZSI6IkVneXB0IiwibmFtZUFyIjoi2YXYtdixIiwiY29kZSI6IkVHIn0sImVtYWlsIjoicHc5MTk5NDEzMi5vZmZpY2VAZ21haWwuY29tIiwicGhvbmUiOiIrMjAxMDY5MzI0ODk1IiwiZ3JvdXAiOnsiX2lkIjoiWGFxbENGQSIsIm5hbWUiOiJCVVNJTkVTU19GVUxMX0FDQ0VTUyIsImNvZGUiOjExNX0sInRva2VuVHlwZSI6IkFDQ0VTUyIsInNlc3Npb25JZCI6IjAxSkswN0tCODM2M0FWSkNWSjE0QTdLUTVUIiwiaWF0IjoxNzM4Mzk1OTg3LCJleHAiOjE3Mzk2MDU1ODd9.J2YA8D82gkMdTY_2SQ0JuCur7a97YAw33hKx8IPym1Y"
 BASE_URL = "https://app.bosta.co/api/v2"
 
+# (connect, read) seconds; creating a delivery is the slowest call Bosta has
+CONNECT_TIMEOUT = float(os.getenv('BOSTA_CONNECT_TIMEOUT', '3.05'))
+READ_TIMEOUT = float(os.getenv('BOSTA_READ_TIMEOUT', '10'))
+DELIVERY_READ_TIMEOUT = float(os.getenv('BOSTA_DELIVERY_READ_TIMEOUT', '20'))
+
+
+def make_transport(base_url=BASE_URL, api_key=BOSTA_API_KEY):
+      """Pooled transport with Bosta's timeouts, retry and circuit breaker settings."""
+      return HttpTransport(
+            'bosta',
+            base_url,
+            headers={"Authorization": api_key},
+            default_timeout=(CONNECT_TIMEOUT, READ_TIMEOUT),
+            timeouts={'create_delivery': (CONNECT_TIMEOUT, DELIVERY_READ_TIMEOUT)},
+            retries=int(os.getenv('BOSTA_RETRIES', '2')),
+            backoff=float(os.getenv('BOSTA_RETRY_BACKOFF', '0.3')),
+            breaker=CircuitBreaker(
+                  failure_threshold=int(os.getenv('BOSTA_BREAKER_THRESHOLD', '5')),
+                  reset_timeout=float(os.getenv('BOSTA_BREAKER_RESET', '30')),
+            ),
+      )
+
+
 class BostaService:
-      def __init__(self):
+      def __init__(self, transport=None, base_url=BASE_URL):
             if not BOSTA_API_KEY:
                   raise ValueError("BOSTA_API_KEY environment variable not set")
             self.api_key = BOSTA_API_KEY
-            self.base_url = BASE_URL
+            self.base_url = base_url
+            self.transport = transport or make_transport(base_url, self.api_key)
 
       def get_cities(self):
-            url = f"{self.base_url}/cities?countryId=60e4482c7cb7d4bc4849c4d5"
-            headers = {"Authorization": self.api_key}
-            response = requests.get(url, headers=headers)
-            response.raise_for_status()
+            response = self.transport.get('cities', "cities?countryId=60e4482c7cb7d4bc4849c4d5")
             return response.json().get('data', {}).get('list', [])
 
       def get_zones(self, city_id):
-            url = f"{self.base_url}/cities/{city_id}/zones"
-            headers = {"Authorization": self.api_key}
-            response = requests.get(url, headers=headers)
-            response.raise_for_status()
+            response = self.transport.get('zones', f"cities/{city_id}/zones")
             return response.json().get('data', [])
 
       def get_districts(self, city_id):
-            url = f"{self.base_url}/cities/{city_id}/districts"
-            headers = {"Authorization": self.api_key}
-            response = requests.get(url, headers=headers)
-            response.raise_for_status()
+            response = self.transport.get('districts', f"cities/{city_id}/districts")
             return response.json().get('data', [])
       
       def get_shipping_fees(self, cod: float, dropoff_city: str, pickup_city: str, 
@@ -44,12 +61,6 @@ class BostaService:
         :param delivery_type: نوع التسليم (SEND, CASH_COLLECTION, etc.)
         :return: تكلفة الشحن
         """
-        url = f"{self.base_url}/pricing/shipment/calculator"
-        headers = {
-            "Authorization": self.api_key,
-            "Content-Type": "application/json"
-        }
-        
         params = {
             "cod": cod,
             "dropOffCity": dropoff_city,
@@ -59,8 +70,7 @@ class BostaService:
         }
         
         try:
-            response = requests.get(url, headers=headers, params=params)
-            response.raise_for_status()
+            response = self.transport.get('shipping_fees', "pricing/shipment/calculator", params=params)
             
             data = response.json()
             if not data.get('success', False):
@@ -76,12 +86,6 @@ class BostaService:
             raise
 
       def create_delivery(self, order_data):
-            url = f"{self.base_url}/deliveries"
-            headers = {
-                  "Authorization": self.api_key,
-                  "Content-Type": "application/json"
-            }
-            
             payload = {
                   "type": 10,
                   "specs": {
@@ -103,6 +107,6 @@ class BostaService:
                   }
             }
             
-            response = requests.post(url, json=payload, headers=headers)
-            response.raise_for_status()
+            # POST is not retried: a timed-out attempt may still have created the delivery
+            response = self.transport.post('create_delivery', "deliveries", json=payload)
             return response.json().get('data', {}).get('trackingNumber', None)
\ No newline at end of file
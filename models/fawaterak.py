@@ -0,0 +1,52 @@
+"""
+Fawaterak payment gateway client.
+
+Invoice creation goes through a pooled ``HttpTransport`` with strict timeouts.
+It is a POST, so the transport never retries it; callers make it idempotent
+by claiming the order before calling (see ``request_invoice`` in app.py).
+"""
+import os
+
+from models.http_client import HttpTransport, CircuitBreaker
+
+API_URL = os.getenv('FAWATERAK_API_URL', 'https://app.fawaterk.com/api/v2/createInvoiceLink')
+
+# (connect, read) seconds; the customer is waiting on a polling page meanwhile
+CONNECT_TIMEOUT = float(os.getenv('FAWATERAK_CONNECT_TIMEOUT', '3.05'))
+READ_TIMEOUT = float(os.getenv('FAWATERAK_READ_TIMEOUT', '15'))
+
+
+class FawaterakError(Exception):
+    """Fawaterak answered, but did not create the invoice."""
+
+
+def make_transport(api_url=API_URL, api_key=''):
+    """Pooled transport with Fawaterak's timeouts and circuit breaker settings."""
+    base_url = api_url.rsplit('/', 1)[0]
+    return HttpTransport(
+        'fawaterak',
+        base_url,
+        headers={'Authorization': f'Bearer {api_key}', 'Content-Type': 'application/json'},
+        default_timeout=(CONNECT_TIMEOUT, READ_TIMEOUT),
+        breaker=CircuitBreaker(
+            failure_threshold=int(os.getenv('FAWATERAK_BREAKER_THRESHOLD', '5')),
+            reset_timeout=float(os.getenv('FAWATERAK_BREAKER_RESET', '30')),
+        ),
+    )
+
+
+class FawaterakService:
+    def __init__(self, api_key='', api_url=API_URL, transport=None):
+        self.invoice_path = api_url.rsplit('/', 1)[1]
+        self.transport = transport or make_transport(api_url, api_key)
+
+    def create_invoice(self, payload):
+        """Create an invoice link; return its ``invoiceKey``, ``invoiceId`` and ``url``.
+
+        Raises ``FawaterakError`` when the gateway refuses the invoice and
+        ``requests.RequestException`` when it cannot be reached in time."""
+        response = self.transport.post('create_invoice', self.invoice_path, json=payload)
+        data = response.json()
+        if data.get('status') != 'success':
+            raise FawaterakError(f'Fawaterak refused the invoice: {str(data)[:200]}')
+        return data['data']
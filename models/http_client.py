@@ -0,0 +1,214 @@
+"""
+Shared HTTP transport for third-party APIs.
+
+One ``HttpTransport`` per upstream keeps a pooled keep-alive ``requests.Session``,
+applies (connect, read) timeouts per endpoint, retries idempotent calls with
+jittered exponential backoff and stops calling an upstream that keeps failing
+(circuit breaker). Latency and error counters are kept per endpoint label.
+"""
+import random
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+DEFAULT_TIMEOUT = (3.05, 10)
+RETRY_STATUSES = frozenset({429, 502, 503, 504})
+
+# name -> HttpTransport, for the admin metrics endpoint
+TRANSPORTS = {}
+
+
+class CircuitOpenError(requests.exceptions.ConnectionError):
+    """Raised without touching the network while the breaker is open."""
+
+
+class CircuitBreaker:
+    """Open after ``failure_threshold`` consecutive failures, probe after ``reset_timeout`` s."""
+
+    def __init__(self, failure_threshold=5, reset_timeout=30.0, clock=time.monotonic):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.clock = clock
+        self.failures = 0
+        self.opened_at = None
+        self._probing = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return 'closed'
+        if self.clock() - self.opened_at >= self.reset_timeout:
+            return 'half_open'
+        return 'open'
+
+    def allow(self):
+        """Whether a call may go out now; only one probe at a time when half open."""
+        with self._lock:
+            state = self.state
+            if state == 'closed':
+                return True
+            if state == 'half_open' and not self._probing:
+                self._probing = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._probing = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self._probing or self.failures >= self.failure_threshold:
+                self.opened_at = self.clock()
+            self._probing = False
+
+
+class EndpointStats:
+    """Call counters and latency of one endpoint label."""
+
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.retries = 0
+        self.rejected = 0
+        self.total_seconds = 0.0
+        self.max_seconds = 0.0
+        self.last_status = None
+        self.last_error = None
+
+    def to_dict(self):
+        return {
+            'calls': self.calls,
+            'errors': self.errors,
+            'retries': self.retries,
+            'rejected': self.rejected,
+            'avg_ms': round(self.total_seconds / self.calls * 1000, 1) if self.calls else None,
+            'max_ms': round(self.max_seconds * 1000, 1),
+            'last_status': self.last_status,
+            'last_error': self.last_error,
+        }
+
+
+class HttpTransport:
+    """Pooled, timeout-bounded client for one upstream API.
+
+    :param base_url: prefix joined with every request path
+    :param headers: sent with every request (e.g. Authorization)
+    :param timeouts: endpoint label -> (connect, read) seconds
+    :param retries: extra attempts for idempotent calls
+    :param backoff: base delay in seconds; attempt ``n`` waits up to ``backoff * 2**n``
+    """
+
+    def __init__(self, name, base_url, headers=None, timeouts=None, default_timeout=DEFAULT_TIMEOUT,
+                 retries=2, backoff=0.3, breaker=None, pool_size=10, register=True):
+        self.name = name
+        self.base_url = base_url.rstrip('/')
+        self.timeouts = dict(timeouts or {})
+        self.default_timeout = default_timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.breaker = breaker or CircuitBreaker()
+        self.session = requests.Session()
+        self.session.headers.update(headers or {})
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=0)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self._stats = {}
+        self._stats_lock = threading.Lock()
+        if register:
+            TRANSPORTS[name] = self
+
+    def _endpoint_stats(self, endpoint):
+        with self._stats_lock:
+            return self._stats.setdefault(endpoint, EndpointStats())
+
+    def _retry_delay(self, attempt):
+        return random.uniform(0, self.backoff * 2 ** attempt)
+
+    def request(self, method, endpoint, path, idempotent=None, **kwargs):
+        """Send a request and return the response; non-2xx raises ``HTTPError``.
+
+        ``endpoint`` is a stable label (e.g. ``'zones'``) used for timeouts and
+        metrics, so ids in ``path`` do not split the counters. Calls are
+        retried only when ``idempotent`` (GET/HEAD by default), on connection
+        errors, timeouts and 429/5xx gateway statuses.
+        """
+        if idempotent is None:
+            idempotent = method.upper() in ('GET', 'HEAD')
+        kwargs.setdefault('timeout', self.timeouts.get(endpoint, self.default_timeout))
+        stats = self._endpoint_stats(endpoint)
+        attempts = 1 + (self.retries if idempotent else 0)
+        url = f"{self.base_url}/{path.lstrip('/')}"
+
+        for attempt in range(attempts):
+            if not self.breaker.allow():
+                stats.rejected += 1
+                raise CircuitOpenError(f'{self.name} circuit is open; skipping {endpoint}')
+            if attempt:
+                stats.retries += 1
+            started = time.monotonic()
+            try:
+                response = self.session.request(method, url, **kwargs)
+            except requests.exceptions.RequestException as e:
+                self._record(stats, started, None, e)
+                self.breaker.record_failure()
+                transient = isinstance(e, (requests.exceptions.ConnectionError, requests.exceptions.Timeout))
+                if not transient or attempt + 1 >= attempts:
+                    raise
+            except Exception as e:
+                # Anything else (e.g. a bug in a hook or adapter) must still end
+                # a half-open probe, or the breaker never lets a call out again
+                self._record(stats, started, None, e)
+                self.breaker.record_failure()
+                raise
+            else:
+                failed = response.status_code >= 500 or response.status_code == 429
+                self._record(stats, started, response.status_code,
+                             f'HTTP {response.status_code}' if response.status_code >= 400 else None)
+                if failed:
+                    self.breaker.record_failure()
+                else:
+                    # A 4xx is our request's fault, not the upstream's health
+                    self.breaker.record_success()
+                if response.status_code not in RETRY_STATUSES or attempt + 1 >= attempts:
+                    response.raise_for_status()
+                    return response
+            time.sleep(self._retry_delay(attempt))
+
+    def _record(self, stats, started, status, error):
+        elapsed = time.monotonic() - started
+        with self._stats_lock:
+            stats.calls += 1
+            stats.total_seconds += elapsed
+            stats.max_seconds = max(stats.max_seconds, elapsed)
+            stats.last_status = status
+            if error is not None:
+                stats.errors += 1
+                stats.last_error = str(error)[:200]
+
+    def get(self, endpoint, path, **kwargs):
+        return self.request('GET', endpoint, path, **kwargs)
+
+    def post(self, endpoint, path, **kwargs):
+        return self.request('POST', endpoint, path, **kwargs)
+
+    def stats(self):
+        with self._stats_lock:
+            endpoints = {name: stats.to_dict() for name, stats in self._stats.items()}
+        return {
+            'base_url': self.base_url,
+            'circuit': self.breaker.state,
+            'consecutive_failures': self.breaker.failures,
+            'endpoints': endpoints,
+        }
+
+
+def transport_stats():
+    """Metrics of every registered transport, keyed by name."""
+    return {name: transport.stats() for name, transport in TRANSPORTS.items()}
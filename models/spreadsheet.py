@@ -0,0 +1,95 @@
+"""
+Streaming spreadsheet writers for exports.
+
+Both writers take a header row and an iterable of rows and return an
+iterator of byte chunks for a streamed Flask ``Response``, so an export never
+holds all of its rows in memory. CSV text that a spreadsheet would run as a
+formula is prefixed with a quote; XLSX cells are typed, so text starting
+with ``=`` is simply stored as a string. CSV chunks are produced as rows
+arrive.
+XLSX is a zip that can only be finished once the last row is known:
+openpyxl's write-only mode spools rows to disk, and the finished file is then
+read back in chunks.
+"""
+import csv
+import io
+import re
+import tempfile
+
+from openpyxl import Workbook
+from openpyxl.cell import WriteOnlyCell
+
+CSV_MIMETYPE = 'text/csv; charset=utf-8'
+XLSX_MIMETYPE = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+
+# Rows per CSV chunk and bytes per XLSX chunk
+CSV_ROWS_PER_CHUNK = 200
+XLSX_CHUNK_BYTES = 64 * 1024
+
+# CSV text starting with one of these is run as a formula by spreadsheet apps
+FORMULA_PREFIXES = ('=', '+', '-', '@', '\t', '\r')
+# ...unless it is a signed number or a phone number such as +20 100 123 4567
+PLAIN_NUMBER = re.compile(r'[+-]?[\d\s.]+')
+
+
+def safe_cell(value):
+    """Neutralise CSV text that a spreadsheet would run as a formula."""
+    if (isinstance(value, str) and value.startswith(FORMULA_PREFIXES)
+            and not PLAIN_NUMBER.fullmatch(value)):
+        return "'" + value
+    return value
+
+
+def text_cell(sheet, value):
+    """Keep XLSX text starting with ``=`` a string instead of a formula."""
+    if isinstance(value, str) and value.startswith('='):
+        cell = WriteOnlyCell(sheet, value)
+        cell.data_type = 's'
+        return cell
+    return value
+
+
+def csv_chunks(headers, rows, rows_per_chunk=CSV_ROWS_PER_CHUNK):
+    """Yield UTF-8 CSV text in chunks of ``rows_per_chunk`` rows.
+
+    Starts with a byte order mark so Excel reads Arabic text correctly."""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+
+    def take():
+        chunk = buffer.getvalue().encode('utf-8')
+        buffer.seek(0)
+        buffer.truncate()
+        return chunk
+
+    # The header goes out at once, before the first rows are fetched
+    buffer.write('\ufeff')
+    writer.writerow(headers)
+    yield take()
+    pending = 0
+    for row in rows:
+        writer.writerow([safe_cell(value) for value in row])
+        pending += 1
+        if pending >= rows_per_chunk:
+            yield take()
+            pending = 0
+    if pending:
+        yield take()
+
+
+def xlsx_chunks(headers, rows, sheet_name='Sheet', chunk_bytes=XLSX_CHUNK_BYTES):
+    """Yield an XLSX workbook with one sheet, written in write-only mode."""
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet(sheet_name)
+    sheet.append(list(headers))
+    for row in rows:
+        sheet.append([text_cell(sheet, value) for value in row])
+
+    with tempfile.TemporaryFile() as output:
+        workbook.save(output)
+        output.seek(0)
+        while True:
+            chunk = output.read(chunk_bytes)
+            if not chunk:
+                break
+            yield chunk
@@ -48,19 +48,46 @@ document.addEventListener('DOMContentLoaded', function () {
         }
     };
 
+    // Both charts start empty and are filled from /admin/api/metrics/timeseries
+    // once the page is shown; the period buttons refetch with another bucket.
+    const monthFormat = new Intl.DateTimeFormat('ar-EG', { month: 'long', year: 'numeric' });
+    const dayFormat = new Intl.DateTimeFormat('ar-EG', { day: 'numeric', month: 'short' });
+
+    function formatLabel(label, bucket) {
+        const date = new Date(`${label}T00:00:00`);
+        return bucket === 'month' ? monthFormat.format(date) : dayFormat.format(date);
+    }
+
+    function loadSeries(canvas, bucket) {
+        const chart = Chart.getChart(canvas);
+        const loader = document.getElementById(`${canvas.id}-loader`);
+        const params = new URLSearchParams({ metric: canvas.dataset.metric, bucket: bucket });
+        canvas.dataset.bucket = bucket;
+        loader.classList.remove('hidden');
+
+        return fetch(`${canvas.dataset.src}?${params}`, { credentials: 'same-origin' })
+            .then(response => response.json())
+            .then(data => {
+                // Ignore answers for a bucket the user has already switched away from
+                if (!data.success || canvas.dataset.bucket !== bucket) return;
+                chart.data.labels = data.labels.map(label => formatLabel(label, bucket));
+                chart.data.datasets[0].data = data.values;
+                chart.update();
+            })
+            .catch(error => console.error('Chart data failed to load', error))
+            .finally(() => loader.classList.add('hidden'));
+    }
+
     // Revenue Chart
     const revenueChart = document.getElementById('revenueChart');
     if (revenueChart) {
-        const labels = JSON.parse(revenueChart.dataset.labels);
-        const values = JSON.parse(revenueChart.dataset.values);
-
         new Chart(revenueChart, {
             type: 'line',
             data: {
-                labels: labels,
+                labels: [],
                 datasets: [{
                     label: 'الإيرادات',
-                    data: values,
+                    data: [],
                     borderColor: accentColor,
                     backgroundColor: accentLight,
                     fill: true,
@@ -84,61 +111,43 @@ document.addEventListener('DOMContentLoaded', function () {
                 }
             }
         });
+        loadSeries(revenueChart, revenueChart.dataset.bucket);
     }
 
     // Orders Chart
     const ordersChart = document.getElementById('ordersChart');
     if (ordersChart) {
-        const labels = JSON.parse(ordersChart.dataset.labels);
-        const values = JSON.parse(ordersChart.dataset.values);
-
         new Chart(ordersChart, {
             type: 'bar',
             data: {
-                labels: labels,
+                labels: [],
                 datasets: [{
                     label: 'الطلبات',
-                    data: values,
+                    data: [],
                     backgroundColor: accentColor,
                     borderRadius: 6
                 }]
             },
             options: commonOptions
         });
+        loadSeries(ordersChart, ordersChart.dataset.bucket);
     }
 
     // Toggle period buttons
-    document.querySelectorAll('[data-period]').forEach(button => {
+    document.querySelectorAll('[data-bucket][data-chart]').forEach(button => {
         button.addEventListener('click', function () {
-            const period = this.dataset.period;
-            const chartId = this.dataset.chart;
-            const container = this.closest('.chart-container');
+            const canvas = document.getElementById(this.dataset.chart);
+            if (!canvas) return;
 
             // Update active state
-            container.querySelectorAll('[data-period]').forEach(btn => {
-                btn.classList.remove('bg-sage-green-100', 'text-sage-green-600');
+            this.parentElement.querySelectorAll('[data-bucket]').forEach(btn => {
+                btn.classList.remove('bg-sage-100', 'text-sage-600');
                 btn.classList.add('bg-gray-100', 'text-gray-600');
             });
             this.classList.remove('bg-gray-100', 'text-gray-600');
-            this.classList.add('bg-sage-green-100', 'text-sage-green-600');
+            this.classList.add('bg-sage-100', 'text-sage-600');
 
-            // Show loader
-            document.getElementById(`${chartId}-loader`).classList.remove('hidden');
-
-            // Fetch new data (to be implemented in Flask)
-            fetch(`/admin/chart-data?chart=${chartId}&period=${period}`)
-                .then(response => response.json())
-                .then(data => {
-                    const chart = Chart.getChart(chartId);
-                    if (chart) {
-                        chart.data.labels = data.labels;
-                        chart.data.datasets[0].data = data.values;
-                        chart.update();
-                    }
-                })
-                .finally(() => {
-                    document.getElementById(`${chartId}-loader`).classList.add('hidden');
-                });
+            loadSeries(canvas, this.dataset.bucket);
         });
     });
-});
\ No newline at end of file
+});
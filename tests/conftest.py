@@ -4,13 +4,14 @@ Pytest configuration and fixtures for testing
 import pytest
 import os
 import sys
+import shutil
 import tempfile
 from datetime import datetime
 
 # Add parent directory to path
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
-from app import app as flask_app, db
+from app import app as flask_app, db, clear_process_caches, run_housekeeping
 from app import (
     Category, Product, AdditionalImage, AdditionalData,
     Cart, Order, OrderItem, Admins, Gusts, DropshipProduct, BannerSlide
@@ -18,6 +19,7 @@ from app import (
 
 # Create a single temp file for the test database (shared by the whole session)
 _db_fd, _db_path = tempfile.mkstemp(suffix='.sqlite3', prefix='test_alhamed_')
+_cache_dir = tempfile.mkdtemp(prefix='test_alhamed_cache_')
 
 
 @pytest.fixture(scope='session')
@@ -36,6 +38,7 @@ def app():
     flask_app.config['WTF_CSRF_ENABLED'] = False
     flask_app.config['SECRET_KEY'] = 'test-secret-key'
     flask_app.config['UPLOAD_FOLDER'] = 'static/uploads'
+    flask_app.config['CACHE_VERSION_DIR'] = _cache_dir
 
     with flask_app.app_context():
         db.create_all()
@@ -53,6 +56,7 @@ def app():
         os.unlink(_db_path)
     except OSError:
         pass
+    shutil.rmtree(_cache_dir, ignore_errors=True)
 
 
 @pytest.fixture(scope='function')
@@ -65,16 +69,22 @@ def client(app):
 def db_session(app):
     """Provide a clean DB session for each test function.
 
-    Cleans all rows after each test so tests remain independent.
+    Cleans all rows after each test so tests remain independent, and empties
+    the process-local caches so no test sees data cached by another.
     """
+    clear_process_caches()
     yield db.session
     db.session.rollback()
+    # Drain write-behind buffers so nothing lands on rows of the next test
+    run_housekeeping(force=True, only_at_exit=True)
     for table in reversed(db.metadata.sorted_tables):
         try:
             db.session.execute(table.delete())
         except Exception:
             db.session.rollback()
     db.session.commit()
+    db.session.expunge_all()
+    clear_process_caches()
 
 
 @pytest.fixture
@@ -190,3 +200,42 @@ def guest_session(client):
     with client.session_transaction() as sess:
         sess['user_id'] = 1
     return client
+
+
+class QueryCounter:
+    """Counts the SQL statements run while it is active."""
+
+    def __init__(self):
+        self.statements = []
+
+    def _record(self, conn, cursor, statement, params, context, executemany):
+        self.statements.append(statement)
+
+    def __enter__(self):
+        from sqlalchemy import event
+        event.listen(db.engine, 'before_cursor_execute', self._record)
+        return self
+
+    def __exit__(self, *exc_info):
+        from sqlalchemy import event
+        event.remove(db.engine, 'before_cursor_execute', self._record)
+
+    @property
+    def count(self):
+        return len(self.statements)
+
+    def assert_at_most(self, limit):
+        assert self.count <= limit, (
+            f'{self.count} statements, expected at most {limit}:\n' + '\n'.join(self.statements)
+        )
+
+
+@pytest.fixture
+def query_counter(app):
+    """Factory of QueryCounter context managers, for catching N+1 queries:
+
+        with query_counter() as queries:
+            client.get('/cart')
+        queries.assert_at_most(8)
+    """
+    return QueryCounter
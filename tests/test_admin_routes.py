@@ -4,6 +4,7 @@ Tests for admin routes
 import pytest
 from flask import session
 from io import BytesIO
+from datetime import datetime, timedelta
 
 class TestAdminAuth:
     """Tests for admin authentication"""
@@ -58,6 +59,392 @@ class TestAdminDashboard:
         response = authenticated_client.get('/admin/')
         assert response.status_code == 200
 
+class TestDashboardAggregates:
+    """The dashboard is computed with aggregate queries"""
+
+    @staticmethod
+    def _orders(db_session, guest, count, status='delivered', city='99', cod=125.0, created_at=None):
+        from app import Order, utc_now
+        for _ in range(count):
+            db_session.add(Order(user_id=guest.id, name='x', email='x@example.com', phone='1', address='a',
+                                 status='pending', city=city, cod_amount=cod, payment_method='cash_on_delivery',
+                                 shipping_status=status, created_at=created_at or utc_now()))
+        db_session.commit()
+
+    @staticmethod
+    def _context(client):
+        from flask import template_rendered
+        captured = {}
+
+        def record(sender, template, context, **extra):
+            captured.update(context)
+
+        template_rendered.connect(record)
+        try:
+            assert client.get('/admin/').status_code == 200
+        finally:
+            template_rendered.disconnect(record)
+        return captured
+
+    @pytest.fixture
+    def rated_city(self, db_session):
+        from app import City, ShippingCost
+        db_session.add_all([City(name='Cairo', city_id='99'), ShippingCost(city_id=99, price=25.0)])
+        db_session.commit()
+
+    def test_revenue_is_net_of_shipping(self, authenticated_client, db_session, sample_guest, rated_city):
+        self._orders(db_session, sample_guest, 2)
+        self._orders(db_session, sample_guest, 1, city='unknown', cod=50.0)
+        self._orders(db_session, sample_guest, 1, status='pending')
+        self._orders(db_session, sample_guest, 1, cod=10.0)
+
+        context = self._context(authenticated_client)
+        assert context['orders_count'] == 5
+        assert context['delivered_orders'] == 4
+        assert context['pending_orders'] == 1
+        assert context['total_shipping_cost'] == pytest.approx(75.0)
+        # 2 x (125 - 25) + 50 + max(0, 10 - 25)
+        assert context['total_revenue'] == pytest.approx(250.0)
+        assert context['daily_revenue'] == pytest.approx(250.0)
+        assert context['avg_order_value'] == pytest.approx(62.5)
+
+    def test_charts_are_not_computed_with_the_page(self, authenticated_client):
+        html = authenticated_client.get('/admin/').get_data(as_text=True)
+        assert 'data-src="/admin/api/metrics/timeseries"' in html
+        assert 'data-metric="delivered_orders"' in html
+
+    def test_query_count_does_not_grow_with_orders(self, authenticated_client, db_session, sample_guest,
+                                                   rated_city, query_counter):
+        self._orders(db_session, sample_guest, 1)
+        authenticated_client.get('/admin/')  # warm the per-worker caches
+        with query_counter() as few:
+            authenticated_client.get('/admin/')
+
+        self._orders(db_session, sample_guest, 40)
+        self._orders(db_session, sample_guest, 20, status='pending')
+        with query_counter() as many:
+            authenticated_client.get('/admin/')
+
+        assert many.count == few.count
+        many.assert_at_most(12)
+
+
+class TestMetricsTimeseries:
+    """/admin/api/metrics/timeseries buckets the daily rollup in one query"""
+
+    URL = '/admin/api/metrics/timeseries'
+
+    @pytest.fixture
+    def orders(self, db_session, sample_guest):
+        TestDashboardAggregates._orders(db_session, sample_guest, 2, created_at=datetime(2026, 3, 31, 23, 0))
+        TestDashboardAggregates._orders(db_session, sample_guest, 1, created_at=datetime(2026, 1, 1, 0, 30))
+        TestDashboardAggregates._orders(db_session, sample_guest, 1, created_at=datetime(2026, 3, 2, 8, 0),
+                                        status='pending')
+
+    def test_calendar_months_are_zero_filled(self, authenticated_client, orders):
+        data = authenticated_client.get(
+            f'{self.URL}?metric=delivered_orders&bucket=month&from=2025-10-15&to=2026-03-31').get_json()
+        assert data['labels'] == ['2025-10-01', '2025-11-01', '2025-12-01', '2026-01-01', '2026-02-01', '2026-03-01']
+        assert data['values'] == [0, 0, 0, 1, 0, 2]
+
+        data = authenticated_client.get(f'{self.URL}?metric=revenue&bucket=month&from=2026-01-01&to=2026-03-31').get_json()
+        assert data['values'] == [125.0, 0, 250.0]
+
+    def test_weeks_start_on_monday(self, authenticated_client, orders):
+        data = authenticated_client.get(
+            f'{self.URL}?metric=orders&bucket=week&from=2026-03-01&to=2026-03-31').get_json()
+        # 2026-03-01 is a Sunday, so the first bucket is the week of Monday 23 February
+        assert data['labels'][0] == '2026-02-23'
+        assert data['labels'][-1] == '2026-03-30'
+        assert dict(zip(data['labels'], data['values'])) == {
+            '2026-02-23': 0, '2026-03-02': 1, '2026-03-09': 0, '2026-03-16': 0, '2026-03-23': 0, '2026-03-30': 2}
+
+    def test_default_range_ends_today(self, authenticated_client):
+        data = authenticated_client.get(f'{self.URL}?bucket=day').get_json()
+        assert len(data['labels']) == 30
+        assert data['to'] == data['labels'][-1]
+
+    @pytest.mark.parametrize('query', [
+        'metric=secret', 'bucket=year', 'from=2026-13-01', 'from=2026-03-01&to=2026-02-01',
+        'bucket=day&from=2000-01-01&to=2026-01-01',
+    ])
+    def test_bad_parameters(self, authenticated_client, query):
+        response = authenticated_client.get(f'{self.URL}?{query}')
+        assert response.status_code == 400
+        assert response.get_json()['success'] is False
+
+    def test_one_query_per_series(self, authenticated_client, orders, query_counter):
+        authenticated_client.get(f'{self.URL}?bucket=day')  # warm the admin lookup
+        with query_counter() as counter:
+            authenticated_client.get(f'{self.URL}?bucket=day&from=2025-01-01&to=2026-01-31')
+        counter.assert_at_most(2)
+
+
+class TestDailySalesRollup:
+    """daily_sales follows order changes and can be rebuilt from scratch"""
+
+    DAY = datetime(2026, 5, 10, 14, 0)
+
+    @pytest.fixture
+    def order(self, db_session, sample_guest, sample_product):
+        from app import City, ShippingCost, Order, OrderItem
+        db_session.add_all([City(name='Cairo', city_id='99'), ShippingCost(city_id=99, price=25.0)])
+        order = Order(user_id=sample_guest.id, name='x', email='x@example.com', phone='1', address='a',
+                      status='pending', city='99', cod_amount=125.0, payment_method='cash_on_delivery',
+                      created_at=self.DAY)
+        db_session.add(order)
+        db_session.flush()
+        db_session.add(OrderItem(order_id=order.id, product_id=sample_product.id, quantity=2))
+        db_session.commit()
+        return order
+
+    @staticmethod
+    def _day(db_session):
+        from app import DailySales
+        db_session.expire_all()
+        return db_session.get(DailySales, TestDailySalesRollup.DAY.date())
+
+    def test_new_order_is_rolled_up(self, db_session, order):
+        day = self._day(db_session)
+        assert (day.orders_count, day.pending_count, day.delivered_count) == (1, 1, 0)
+        assert day.cod_collected == 0
+
+    def test_status_change_moves_the_order(self, authenticated_client, db_session, order, sample_product):
+        from app import DailyProductSales
+        authenticated_client.post(f'/admin/update_shipping_status/{order.id}', data={'status': 'delivered'})
+
+        day = self._day(db_session)
+        assert (day.orders_count, day.pending_count, day.delivered_count) == (1, 0, 1)
+        assert (day.cod_collected, day.shipping_cost, day.net_revenue) == (125.0, 25.0, 100.0)
+        assert day.items_sold == 2
+        product_day = db_session.get(DailyProductSales, (self.DAY.date(), sample_product.id))
+        assert (product_day.quantity, product_day.revenue) == (2, 30000.0)
+
+        authenticated_client.post(f'/admin/update_shipping_status/{order.id}', data={'status': 'returned'})
+        day = self._day(db_session)
+        assert (day.delivered_count, day.returned_count, day.returned_shipping) == (0, 1, 25.0)
+        assert db_session.get(DailyProductSales, (self.DAY.date(), sample_product.id)) is None
+
+    def test_deleted_order_leaves_the_rollup(self, authenticated_client, db_session, order):
+        authenticated_client.post(f'/admin/delete_order/{order.id}')
+        assert self._day(db_session) is None
+
+    def test_income_export_reads_the_rollup(self, authenticated_client, order):
+        import pandas as pd
+        authenticated_client.post(f'/admin/update_shipping_status/{order.id}', data={'status': 'delivered'})
+        response = authenticated_client.get('/admin/export_income_stats?start_date=2026-05-10&end_date=2026-05-10')
+        sheets = pd.read_excel(BytesIO(response.data), sheet_name=None)
+
+        stats = sheets['إحصائيات الدخل'].iloc[-1]
+        assert stats['صافي'] == 'صافي المستحق: 80.0'  # 125 - 25 shipping - 20 manufacturing
+        products = sheets['إحصائيات المنتجات']
+        assert products['الكمية المباعة'].tolist() == [2]
+
+    @staticmethod
+    def _wait_for_jobs():
+        import app as app_module
+        for thread in tuple(app_module._job_threads.values()):
+            thread.join(timeout=10)
+
+    def test_rate_change_refreshes_the_rollup(self, authenticated_client, db_session, order):
+        authenticated_client.post(f'/admin/update_shipping_status/{order.id}', data={'status': 'delivered'})
+        authenticated_client.post('/admin/update_shipping_cost', data={'city_id': '99', 'price': '40'})
+        self._wait_for_jobs()
+
+        day = self._day(db_session)
+        assert (day.shipping_cost, day.net_revenue) == (40.0, 85.0)
+
+        authenticated_client.post(f'/admin/admin/order/{order.id}/update-shipping-price',
+                                  data={'shipping_price': '10'})
+        self._wait_for_jobs()
+        assert self._day(db_session).shipping_cost == 10.0
+
+    def test_deleting_the_city_drops_its_rate_from_the_rollup(self, authenticated_client, db_session, order):
+        from app import City, shipping_quotes
+        authenticated_client.post(f'/admin/update_shipping_status/{order.id}', data={'status': 'delivered'})
+        city = City.query.filter_by(city_id='99').one()
+
+        authenticated_client.get(f'/admin/delete_city/{city.id}')
+        self._wait_for_jobs()
+
+        day = self._day(db_session)
+        assert shipping_quotes.quote_many(['99'])['99'] == 0.0
+        assert (day.shipping_cost, day.net_revenue) == (0.0, 125.0)
+
+    def test_repricing_runs_in_batches(self, app, db_session, order, monkeypatch):
+        from app import Order, reprice_daily_sales
+        monkeypatch.setitem(app.config, 'DAILY_SALES_REPRICE_BATCH', 1)
+        for offset in (1, 2):
+            db_session.add(Order(user_id=order.user_id, name='x', email='x@example.com', phone='1',
+                                 address='a', status='pending', city='99', cod_amount=10.0,
+                                 payment_method='cash_on_delivery',
+                                 created_at=self.DAY - timedelta(days=offset)))
+        db_session.commit()
+        reports = []
+
+        result = reprice_daily_sales(['99'], lambda done, total: reports.append((done, total)))
+        assert result == {'cities': ['99'], 'days': 3}
+        assert reports == [(1, 3), (2, 3), (3, 3)]
+
+    def test_income_export_totals_match_its_rows(self, authenticated_client, db_session, order):
+        import pandas as pd
+        authenticated_client.post(f'/admin/update_shipping_status/{order.id}', data={'status': 'delivered'})
+        authenticated_client.post('/admin/update_shipping_cost', data={'city_id': '99', 'price': '40'})
+        self._wait_for_jobs()
+        response = authenticated_client.get('/admin/export_income_stats')
+        rows = pd.read_excel(BytesIO(response.data), sheet_name='إحصائيات الدخل')
+
+        assert rows['قيمه الشحن'].iloc[0] == 40
+        assert rows['قيمه الشحن'].iloc[-1] == 'اجمالي مصاريف الشحن: 40.0'
+        assert rows['صافي'].iloc[-1] == 'صافي المستحق: 65.0'  # 125 - 40 shipping - 20 manufacturing
+
+    def test_upgrade_rolls_up_existing_orders(self, authenticated_client, db_session, order):
+        import os
+        from flask_migrate import downgrade, upgrade
+        from app import db, DailyProductSales, DailySales
+
+        def rollup():
+            db_session.expire_all()
+            columns = [c for c in DailySales.__table__.columns if c.name != 'updated_at']
+            return (db_session.execute(db.select(*columns)).all(),
+                    db_session.execute(db.select(DailyProductSales.__table__)).all())
+
+        authenticated_client.post(f'/admin/update_shipping_status/{order.id}', data={'status': 'delivered'})
+        expected = rollup()
+        db_session.commit()
+        migrations = os.path.join(os.path.dirname(__file__), '..', 'migrations')
+        upgrade(directory=migrations)
+        downgrade(directory=migrations, revision='c3f9a7e1d482')
+        upgrade(directory=migrations)
+
+        assert rollup() == expected
+        assert expected[0][0].delivered_count == 1
+
+    def test_backfill_matches_incremental_rollup(self, app, db_session, order):
+        from app import DailySales, Order, rebuild_daily_sales
+        Order.query.filter_by(id=order.id).update({'shipping_status': 'delivered'})  # bypasses the listener
+        db_session.commit()
+        assert self._day(db_session).delivered_count == 0
+
+        result = app.test_cli_runner().invoke(args=['backfill-daily-sales'])
+        assert 'Rolled up 1 days' in result.output
+        day = self._day(db_session)
+        assert (day.delivered_count, day.net_revenue, day.items_sold) == (1, 100.0, 2)
+        assert DailySales.query.count() == rebuild_daily_sales() == 1
+
+
+class TestOrderExport:
+    """Orders are exported from one streamed query as XLSX or CSV"""
+
+    @pytest.fixture
+    def orders(self, db_session, sample_guest, sample_product):
+        from app import City, Order, OrderItem
+        db_session.add(City(name='القاهرة', city_id='99'))
+        placed = []
+        for i in range(5):
+            order = Order(user_id=sample_guest.id, name=f'عميل {i}', email='a@b.c', phone='0100', address='x',
+                          status='pending', city='99' if i else 'gone', cod_amount=100.0 + i,
+                          payment_method='cash_on_delivery')
+            db_session.add(order)
+            db_session.flush()
+            db_session.add_all([OrderItem(order_id=order.id, product_id=sample_product.id, quantity=2),
+                                OrderItem(order_id=order.id, product_id=sample_product.id, quantity=1)])
+            placed.append(order)
+        db_session.commit()
+        return placed
+
+    def test_xlsx_export(self, app, authenticated_client, orders, sample_product, query_counter, monkeypatch):
+        import openpyxl
+        monkeypatch.setitem(app.config, 'ORDER_EXPORT_CHUNK_SIZE', 3)  # two batches of orders
+        authenticated_client.get('/admin/orders')  # warm the admin lookup
+        with query_counter() as counter:
+            response = authenticated_client.get('/admin/export_orders')
+            data = response.get_data()
+        assert response.mimetype == 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+        assert 'attachment' in response.headers['Content-Disposition']
+        counter.assert_at_most(3)  # the admin lookup and one query per batch
+
+        rows = list(openpyxl.load_workbook(BytesIO(data)).active.values)
+        assert rows[0][:3] == ('اسم العميل', 'تليفون (محمول فقط)', 'المدينة')
+        assert [row[0] for row in rows[1:]] == ['عميل 4', 'عميل 3', 'عميل 2', 'عميل 1', 'عميل 0']
+        assert rows[1][2] == 'القاهرة' and rows[-1][2] == 'Unknown'
+        assert rows[1][6] == 3
+        assert rows[1][7] == f'{sample_product.name}, {sample_product.name}'
+
+    def test_csv_export_of_selected_orders(self, authenticated_client, orders):
+        import csv
+        response = authenticated_client.post('/admin/export_selected_orders',
+                                             data={'order_ids': [orders[0].id, orders[2].id], 'format': 'csv'})
+        assert response.mimetype == 'text/csv'
+        rows = list(csv.reader(response.get_data(as_text=True).lstrip('\ufeff').splitlines()))
+        assert [row[0] for row in rows[1:]] == ['عميل 2', 'عميل 0']
+        assert rows[1][5] == '102.0'
+
+    def test_export_does_not_lock_the_database_between_batches(self, app, db_session, orders, monkeypatch):
+        import sqlite3
+        from app import db, order_export_rows
+        monkeypatch.setitem(app.config, 'ORDER_EXPORT_CHUNK_SIZE', 2)
+        rows = order_export_rows()
+        assert next(rows)[0] == 'عميل 4'
+
+        # Another worker writes while the download is half way through
+        other = sqlite3.connect(db.engine.url.database, timeout=0)
+        try:
+            other.execute("UPDATE \"order\" SET address = 'y'")
+            other.commit()
+        finally:
+            other.close()
+        assert [row[0] for row in rows] == ['عميل 3', 'عميل 2', 'عميل 1', 'عميل 0']
+
+    def test_formulas_are_not_exported(self, authenticated_client, db_session, orders):
+        import csv
+        import openpyxl
+        orders[0].name = '=HYPERLINK("http://evil.example","x")'
+        orders[0].address = '@SUM(1+1)'
+        db_session.commit()
+
+        text = authenticated_client.get('/admin/export_orders?format=csv').get_data(as_text=True)
+        last = list(csv.reader(text.splitlines()))[-1]
+        assert last[0] == '\'=HYPERLINK("http://evil.example","x")'
+        assert last[4] == "'@SUM(1+1)"
+
+        data = authenticated_client.get('/admin/export_orders').get_data()
+        sheet = openpyxl.load_workbook(BytesIO(data)).active
+        cell = sheet.cell(row=sheet.max_row, column=1)
+        assert cell.data_type == 's' and cell.value == '=HYPERLINK("http://evil.example","x")'
+
+    def test_phone_numbers_are_exported_unchanged(self, authenticated_client, db_session, orders):
+        import csv
+        import openpyxl
+        orders[0].phone = '+201001234567'
+        orders[0].address = '- شارع النصر'
+        db_session.commit()
+
+        text = authenticated_client.get('/admin/export_orders?format=csv').get_data(as_text=True)
+        last = list(csv.reader(text.splitlines()))[-1]
+        assert last[1] == '+201001234567'
+        assert last[4] == "'- شارع النصر"
+
+        data = authenticated_client.get('/admin/export_orders').get_data()
+        sheet = openpyxl.load_workbook(BytesIO(data)).active
+        row = [cell.value for cell in sheet[sheet.max_row]]
+        assert (row[1], row[4]) == ('+201001234567', '- شارع النصر')
+
+    def test_csv_header_is_sent_before_rows_are_read(self):
+        from models.spreadsheet import csv_chunks
+
+        def rows():
+            raise AssertionError('rows read too early')
+            yield
+
+        chunks = csv_chunks(['a', 'b'], rows())
+        assert next(chunks) == '\ufeffa,b\r\n'.encode('utf-8')
+
+    def test_selected_export_needs_orders(self, authenticated_client):
+        response = authenticated_client.post('/admin/export_selected_orders', data={})
+        assert response.status_code == 302
+
+
 class TestAdminProducts:
     """Tests for admin product management"""
     
@@ -200,3 +587,49 @@ class TestAdminOrders:
         """Test orders are displayed"""
         response = authenticated_client.get('/admin/orders')
         assert response.status_code == 200
+
+    def test_orders_paginate_with_cursor(self, authenticated_client, db_session, sample_guest):
+        """Order list pages are walked newest-first with opaque cursors"""
+        import re
+        from html import unescape
+        from app import Order
+        for i in range(14):
+            db_session.add(Order(user_id=sample_guest.id, name=f'عميل {i}', email='a@b.c',
+                                 phone='0100', address='x', status='pending', payment_method='cod'))
+        db_session.commit()
+        ids = sorted(o.id for o in Order.query.all())
+
+        html = authenticated_client.get('/admin/orders').data.decode('utf-8')
+        assert f'#{ids[-1]}' in html and f'data-order-id="{ids[1]}"' not in html
+        next_url = unescape(re.search(r'href="(/admin/orders\?cursor=[^"]+)"', html).group(1))
+
+        html = authenticated_client.get(next_url).data.decode('utf-8')
+        assert f'data-order-id="{ids[0]}"' in html and f'data-order-id="{ids[-1]}"' not in html
+
+    @staticmethod
+    def _orders_with_items(db_session, guest, product, count):
+        from app import City, Order, OrderItem
+        if not City.query.filter_by(city_id='99').first():
+            db_session.add(City(name='القاهرة', city_id='99'))
+        for _ in range(count):
+            order = Order(user_id=guest.id, name='x', email='a@b.c', phone='0100', address='x', status='pending',
+                          city='99', payment_method='visa', payment_status='paid', shipping_status='returned')
+            db_session.add(order)
+            db_session.flush()
+            db_session.add_all([OrderItem(order_id=order.id, product_id=product.id, quantity=1) for _ in range(3)])
+        db_session.commit()
+
+    def test_orders_are_enriched_in_one_query(self, authenticated_client, db_session, sample_guest,
+                                              sample_product, query_counter):
+        self._orders_with_items(db_session, sample_guest, sample_product, 1)
+        authenticated_client.get('/admin/orders')  # warm the per-worker caches
+        with query_counter() as few:
+            html = authenticated_client.get('/admin/orders').get_data(as_text=True)
+        assert 'القاهرة' in html and '3 منتج' in html
+
+        self._orders_with_items(db_session, sample_guest, sample_product, 11)
+        with query_counter() as many:
+            html = authenticated_client.get('/admin/orders').get_data(as_text=True)
+        assert html.count('3 منتج') == 12
+        assert many.count == few.count
+        many.assert_at_most(4)
@@ -70,3 +70,86 @@ class TestProductImageAPI:
         
         data = json.loads(response.data)
         assert data['success'] is True
+
+class TestGeographySnapshotAPI:
+    """Checkout geography endpoints serve a cached, ETag-versioned snapshot"""
+
+    @pytest.fixture
+    def geography(self, db_session):
+        from app import City, Zone, District, ShippingCost
+        db_session.add_all([
+            City(name='Cairo', city_id='cai'),
+            City(name='Alexandria', city_id='alx'),
+            Zone(name='Nasr City', city_id='cai', zone_id='z-1'),
+            Zone(name='Maadi', city_id='cai', zone_id='z-2'),
+            District(name='First District', city_id='cai', district_id='d-1'),
+            ShippingCost(city_id='cai', price=40.0),
+        ])
+        db_session.commit()
+
+    @staticmethod
+    def _count_queries(fn):
+        from sqlalchemy import event
+        from app import db
+        statements = []
+
+        def record(conn, cursor, statement, params, context, executemany):
+            statements.append(statement)
+
+        event.listen(db.engine, 'before_cursor_execute', record)
+        try:
+            fn()
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', record)
+        return len([s for s in statements if 'FROM city' in s or 'FROM zone' in s or 'FROM district' in s])
+
+    def test_cities_tree(self, client, geography):
+        """The tree nests zones and districts under each city"""
+        data = client.get('/api/cities').get_json()
+        cairo = next(city for city in data['city'] if city['city_id'] == 'cai')
+        assert [zone['zone_id'] for zone in cairo['zones']] == ['z-1', 'z-2']
+        assert cairo['districts'][0]['name'] == 'First District'
+        assert cairo['shipping_price'] == 40.0
+
+    def test_snapshot_is_built_once(self, client, geography):
+        """Building the tree takes three queries; later requests take none"""
+        assert self._count_queries(lambda: client.get('/api/cities')) == 3
+        assert self._count_queries(lambda: client.get('/api/cities')) == 0
+        assert self._count_queries(lambda: client.get('/get_zones/cai')) == 0
+
+    def test_etag_revalidation_returns_304(self, client, geography):
+        """A matching If-None-Match gets an empty 304"""
+        first = client.get('/get_zones/cai')
+        assert first.status_code == 200
+        assert 'max-age' in first.headers['Cache-Control']
+        etag = first.headers['ETag']
+        assert not etag.startswith('W/')
+
+        second = client.get('/get_zones/cai', headers={'If-None-Match': etag})
+        assert second.status_code == 304
+        assert second.data == b''
+
+    def test_districts_of_unknown_city_is_404(self, client, geography):
+        assert client.get('/get_districts/nowhere').status_code == 404
+        assert client.get('/get_zones/nowhere').get_json() == {'zones': []}
+
+    def test_shipping_cost_update_changes_etag(self, authenticated_client, geography):
+        """An admin edit rebuilds the snapshot and the ETag moves"""
+        before = authenticated_client.get('/api/cities').headers['ETag']
+        authenticated_client.post('/admin/update_shipping_cost', data={'city_id': 'cai', 'price': '55'})
+
+        response = authenticated_client.get('/api/cities', headers={'If-None-Match': before})
+        assert response.status_code == 200
+        assert response.headers['ETag'] != before
+        cairo = next(city for city in response.get_json()['city'] if city['city_id'] == 'cai')
+        assert cairo['shipping_price'] == 55.0
+
+    def test_delete_city_rebuilds_snapshot(self, authenticated_client, geography):
+        from app import City
+        authenticated_client.get('/api/cities')
+        city = City.query.filter_by(city_id='alx').one()
+
+        authenticated_client.get(f'/admin/delete_city/{city.id}')
+
+        cities = authenticated_client.get('/api/cities').get_json()['city']
+        assert [city['city_id'] for city in cities] == ['cai']
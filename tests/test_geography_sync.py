@@ -0,0 +1,172 @@
+"""
+Tests for the Bosta geography sync and background jobs
+"""
+import threading
+
+import pytest
+
+import app as app_module
+from app import db, City, Zone, District, BackgroundJob
+
+
+FAKE_CITIES = [
+    {'_id': 'cai', 'name': 'Cairo'},
+    {'_id': 'alx', 'name': 'Alexandria'},
+    {'_id': 'gza', 'name': 'Giza'},
+]
+FAKE_ZONES = {
+    'cai': [{'_id': 'z-nasr', 'name': 'Nasr City'}, {'_id': 'z-maadi', 'name': 'Maadi'}],
+    'alx': [{'_id': 'z-smouha', 'name': 'Smouha'}],
+}
+# Bosta groups districts under their zone
+FAKE_DISTRICTS = {
+    'cai': [{'zoneId': 'z-nasr', 'districts': [{'districtId': 'd-1', 'districtName': 'First District'}]}],
+    'alx': [{'zoneId': 'z-smouha', 'districts': [{'districtId': 'd-9', 'districtName': 'Smouha North'}]}],
+}
+
+
+class FakeBosta:
+    """Stands in for BostaService; Giza's zones endpoint fails"""
+
+    def get_cities(self):
+        return FAKE_CITIES
+
+    def get_zones(self, city_id):
+        if city_id == 'gza':
+            raise ConnectionError('zones unavailable')
+        return FAKE_ZONES[city_id]
+
+    def get_districts(self, city_id):
+        return FAKE_DISTRICTS[city_id]
+
+
+@pytest.fixture
+def fake_bosta(monkeypatch):
+    monkeypatch.setattr(app_module, 'bosta_service', FakeBosta())
+
+
+def _names(model):
+    return {row.name for row in model.query.all()}
+
+
+class TestGeographySync:
+    """Fetched geography is diffed and applied in bulk"""
+
+    def test_sync_inserts_updates_and_deletes(self, app, db_session, fake_bosta):
+        db_session.add_all([
+            City(name='Cairo (old)', city_id='cai'),
+            City(name='Manual City', city_id='manual-1'),
+            City(name='Giza', city_id='gza'),
+            Zone(name='Nasr', city_id='cai', zone_id='z-nasr'),
+            Zone(name='Gone Zone', city_id='cai', zone_id='z-gone'),
+            Zone(name='Giza Zone', city_id='gza', zone_id='z-giza'),
+            Zone(name='Manual Zone', city_id='manual-1', zone_id='z-manual'),
+        ])
+        db_session.commit()
+
+        summary = app_module.sync_bosta_geography()
+
+        assert summary['cities'] == {'inserted': 1, 'updated': 1, 'deleted': 0}
+        assert summary['zones'] == {'inserted': 2, 'updated': 1, 'deleted': 1}
+        assert summary['districts'] == {'inserted': 2, 'updated': 0, 'deleted': 0}
+        assert summary['failed_cities'] == ['gza']
+        assert _names(City) == {'Cairo', 'Alexandria', 'Giza', 'Manual City'}
+        # the failed city and the manual city keep their zones
+        assert _names(Zone) == {'Nasr City', 'Maadi', 'Smouha', 'Giza Zone', 'Manual Zone'}
+        assert _names(District) == {'First District', 'Smouha North'}
+
+    def test_second_sync_is_a_no_op(self, app, db_session, fake_bosta):
+        app_module.sync_bosta_geography()
+        summary = app_module.sync_bosta_geography()
+
+        for name in ('cities', 'zones', 'districts'):
+            assert summary[name] == {'inserted': 0, 'updated': 0, 'deleted': 0}
+
+    def test_progress_is_reported_per_city(self, app, db_session, fake_bosta):
+        reports = []
+        app_module.sync_bosta_geography(lambda done, total, message: reports.append((done, total)))
+        assert reports[:3] == [(1, 3), (2, 3), (3, 3)]
+
+    def test_cli_command(self, app, db_session, fake_bosta):
+        result = app.test_cli_runner().invoke(args=['sync-geography'])
+        assert result.exit_code == 0, result.output
+        assert 'zones: +3' in result.output
+        assert City.query.count() == 3
+
+
+class TestSyncBackgroundJob:
+    """The admin button starts a background job and polls it"""
+
+    def _wait(self, job_id):
+        thread = app_module._job_threads.get(job_id)
+        if thread:
+            thread.join(timeout=10)
+
+    def test_admin_sync_runs_in_background(self, authenticated_client, db_session, fake_bosta):
+        response = authenticated_client.post('/admin/sync_bosta_cities',
+                                             headers={'Accept': 'application/json'})
+        assert response.status_code == 202
+        job_id = response.get_json()['job']['id']
+        self._wait(job_id)
+
+        job = authenticated_client.get(f'/admin/api/jobs/{job_id}').get_json()['job']
+        assert job['status'] == 'done'
+        assert job['progress'] == job['total'] == 3
+        assert job['result']['zones']['inserted'] == 3
+        assert Zone.query.count() == 3
+
+    def test_running_job_is_not_started_twice(self, authenticated_client, db_session):
+        running = BackgroundJob(kind='bosta_geography', status='running')
+        db_session.add(running)
+        db_session.commit()
+
+        response = authenticated_client.post('/admin/sync_bosta_cities',
+                                             headers={'Accept': 'application/json'})
+
+        data = response.get_json()
+        assert data['started'] is False
+        assert data['job']['id'] == running.id
+        assert BackgroundJob.query.count() == 1
+
+    def test_concurrent_claims_start_one_job(self, app, db_session):
+        barrier = threading.Barrier(4)
+        claimed = []
+
+        def claim():
+            with app.app_context():
+                barrier.wait()
+                claimed.append(app_module._claim_background_job('bosta_geography'))
+
+        threads = [threading.Thread(target=claim) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(timeout=10)
+
+        assert len([job_id for job_id in claimed if job_id is not None]) == 1
+        assert BackgroundJob.query.count() == 1
+
+    def test_stale_job_does_not_block_a_new_one(self, app, db_session):
+        from datetime import timedelta
+        stale = BackgroundJob(kind='bosta_geography', status='running',
+                              updated_at=app_module.utc_now() - timedelta(hours=1))
+        db_session.add(stale)
+        db_session.commit()
+
+        job_id = app_module._claim_background_job('bosta_geography')
+        assert job_id is not None and job_id != stale.id
+
+    def test_failed_job_records_error(self, app, db_session, monkeypatch):
+        class BrokenBosta(FakeBosta):
+            def get_cities(self):
+                raise ConnectionError('bosta down')
+
+        monkeypatch.setattr(app_module, 'bosta_service', BrokenBosta())
+        job, started = app_module.start_background_job('bosta_geography', app_module.sync_bosta_geography)
+        assert started
+        self._wait(job.id)
+
+        db_session.expire_all()
+        job = db_session.get(BackgroundJob, job.id)
+        assert job.status == 'failed'
+        assert 'bosta down' in job.error
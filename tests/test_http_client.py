@@ -0,0 +1,208 @@
+"""
+Tests for the shared HTTP transport, run against a local stub server
+"""
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+import requests
+
+from models.bosta import BostaService
+from models.fawaterak import FawaterakService, FawaterakError
+from models.http_client import HttpTransport, CircuitBreaker, CircuitOpenError
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """Answers from ``server.routes``: path -> list of (status, body, delay)"""
+
+    def _respond(self):
+        path = self.path.split('?')[0]
+        self.server.hits.append((self.command, path, self.headers.get('Authorization')))
+        script = self.server.routes.get(path, [(404, {}, 0)])
+        status, body, delay = script.pop(0) if len(script) > 1 else script[0]
+        if delay:
+            time.sleep(delay)
+        payload = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    do_GET = _respond
+    do_POST = _respond
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def stub_server():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+    server.routes = {}
+    server.hits = []
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    server.url = f'http://127.0.0.1:{server.server_address[1]}'
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def _transport(server, **kwargs):
+    kwargs.setdefault('backoff', 0)
+    kwargs.setdefault('default_timeout', (1, 1))
+    return HttpTransport('stub', server.url, headers={'Authorization': 'Bearer test'},
+                         register=False, **kwargs)
+
+
+class TestHttpTransport:
+    """Retries, timeouts, circuit breaking and metrics"""
+
+    def test_retries_idempotent_call_after_gateway_error(self, stub_server):
+        stub_server.routes['/cities'] = [(503, {}, 0), (200, {'ok': True}, 0)]
+        transport = _transport(stub_server)
+
+        assert transport.get('cities', 'cities').json() == {'ok': True}
+
+        assert len(stub_server.hits) == 2
+        stats = transport.stats()['endpoints']['cities']
+        assert stats['calls'] == 2
+        assert stats['retries'] == 1
+        assert stats['errors'] == 1
+
+    def test_post_is_not_retried(self, stub_server):
+        stub_server.routes['/deliveries'] = [(503, {}, 0), (200, {}, 0)]
+        transport = _transport(stub_server)
+
+        with pytest.raises(requests.exceptions.HTTPError):
+            transport.post('create_delivery', 'deliveries', json={})
+        assert len(stub_server.hits) == 1
+
+    def test_client_errors_are_not_retried(self, stub_server):
+        stub_server.routes['/cities'] = [(400, {}, 0), (200, {}, 0)]
+        transport = _transport(stub_server)
+
+        with pytest.raises(requests.exceptions.HTTPError):
+            transport.get('cities', 'cities')
+        assert len(stub_server.hits) == 1
+        assert transport.breaker.state == 'closed'
+
+    def test_read_timeout_bounds_a_hung_endpoint(self, stub_server):
+        stub_server.routes['/slow'] = [(200, {}, 1.0)]
+        transport = _transport(stub_server, retries=0, timeouts={'slow': (1, 0.2)})
+
+        started = time.monotonic()
+        with pytest.raises(requests.exceptions.Timeout):
+            transport.get('slow', 'slow')
+        assert time.monotonic() - started < 0.9
+
+    def test_breaker_opens_and_recovers(self, stub_server):
+        stub_server.routes['/cities'] = [(500, {}, 0), (500, {}, 0), (200, {}, 0)]
+        now = [0.0]
+        breaker = CircuitBreaker(failure_threshold=2, reset_timeout=30, clock=lambda: now[0])
+        transport = _transport(stub_server, retries=0, breaker=breaker)
+
+        for _ in range(2):
+            with pytest.raises(requests.exceptions.HTTPError):
+                transport.get('cities', 'cities')
+        assert breaker.state == 'open'
+
+        with pytest.raises(CircuitOpenError):
+            transport.get('cities', 'cities')
+        assert len(stub_server.hits) == 2
+        assert transport.stats()['endpoints']['cities']['rejected'] == 1
+
+        now[0] = 31.0
+        assert breaker.state == 'half_open'
+        transport.get('cities', 'cities')
+        assert breaker.state == 'closed'
+
+    def test_unexpected_error_ends_the_probe(self, stub_server, monkeypatch):
+        stub_server.routes['/cities'] = [(200, {}, 0)]
+        now = [0.0]
+        breaker = CircuitBreaker(failure_threshold=1, reset_timeout=30, clock=lambda: now[0])
+        transport = _transport(stub_server, retries=0, breaker=breaker)
+        breaker.record_failure()
+        now[0] = 31.0
+
+        def broken(*args, **kwargs):
+            raise ValueError('bad hook')
+
+        monkeypatch.setattr(transport.session, 'request', broken)
+        with pytest.raises(ValueError):
+            transport.get('cities', 'cities')
+        assert breaker.state == 'open'
+
+        monkeypatch.delattr(transport.session, 'request')
+        now[0] = 62.0
+        transport.get('cities', 'cities')
+        assert breaker.state == 'closed'
+
+    def test_connections_are_reused(self, stub_server):
+        stub_server.routes['/cities'] = [(200, {}, 0)]
+        transport = _transport(stub_server)
+        adapter = transport.session.get_adapter(stub_server.url)
+
+        for _ in range(3):
+            transport.get('cities', 'cities')
+
+        assert len(adapter.poolmanager.pools) == 1
+
+
+class TestBostaServiceTransport:
+    """BostaService goes through the shared transport"""
+
+    def test_get_cities_and_zones(self, stub_server):
+        stub_server.routes['/cities'] = [(200, {'data': {'list': [{'_id': 'c1', 'name': 'Cairo'}]}}, 0)]
+        stub_server.routes['/cities/c1/zones'] = [(200, {'data': [{'_id': 'z1'}]}, 0)]
+        service = BostaService(transport=_transport(stub_server))
+
+        assert service.get_cities() == [{'_id': 'c1', 'name': 'Cairo'}]
+        assert service.get_zones('c1') == [{'_id': 'z1'}]
+        assert all(auth == 'Bearer test' for _, _, auth in stub_server.hits)
+        assert set(service.transport.stats()['endpoints']) == {'cities', 'zones'}
+
+    def test_create_delivery_returns_tracking_number(self, stub_server):
+        stub_server.routes['/deliveries'] = [(200, {'data': {'trackingNumber': 'T-1'}}, 0)]
+        service = BostaService(transport=_transport(stub_server))
+
+        tracking = service.create_delivery({
+            'package_size': 'SMALL', 'package_type': 'Parcel', 'cod_amount': 100,
+            'city': 'c1', 'zone_id': 'z1', 'district_id': 'd1', 'address': 'Addr',
+            'business_reference': 'ref-1', 'first_name': 'Test', 'phone': '01000000000',
+        })
+
+        assert tracking == 'T-1'
+        assert stub_server.hits == [('POST', '/deliveries', 'Bearer test')]
+
+    def test_http_metrics_endpoint(self, authenticated_client):
+        response = authenticated_client.get('/admin/api/metrics/http')
+        assert response.status_code == 200
+        assert response.get_json()['transports']['bosta']['circuit'] == 'closed'
+
+
+class TestFawaterakServiceTransport:
+    """FawaterakService creates invoices over the shared transport"""
+
+    def _service(self, server):
+        return FawaterakService(api_url=f'{server.url}/createInvoiceLink', transport=_transport(server))
+
+    def test_create_invoice(self, stub_server):
+        invoice = {'invoiceKey': 'k1', 'invoiceId': 7, 'url': 'https://pay.example/7'}
+        stub_server.routes['/createInvoiceLink'] = [(200, {'status': 'success', 'data': invoice}, 0)]
+
+        assert self._service(stub_server).create_invoice({'cartTotal': '10'}) == invoice
+        assert stub_server.hits == [('POST', '/createInvoiceLink', 'Bearer test')]
+
+    def test_refusal_and_gateway_errors_are_not_retried(self, stub_server):
+        stub_server.routes['/createInvoiceLink'] = [(200, {'status': 'error', 'message': 'bad'}, 0)]
+        with pytest.raises(FawaterakError):
+            self._service(stub_server).create_invoice({})
+
+        stub_server.routes['/createInvoiceLink'] = [(503, {}, 0)]
+        with pytest.raises(requests.exceptions.HTTPError):
+            self._service(stub_server).create_invoice({})
+        assert len(stub_server.hits) == 2
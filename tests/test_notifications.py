@@ -0,0 +1,158 @@
+"""
+Tests for the outbound notification outbox
+"""
+import json
+from datetime import timedelta
+from unittest.mock import patch, Mock
+
+import pytest
+
+from app import app as flask_app, NotificationOutbox, Order
+from test_production import _create_full_catalog, _checkout_form
+
+
+@pytest.fixture
+def discord_webhook(monkeypatch):
+    """Configure a Discord webhook URL for the duration of a test"""
+    monkeypatch.setenv('DISCORD_WEBHOOK_URL', 'https://discord.example/webhook')
+
+
+def _response(status_code):
+    response = Mock()
+    response.status_code = status_code
+    response.text = ''
+    return response
+
+
+class TestOrderNotificationQueue:
+    """Checkout writes the alert to the outbox instead of calling Discord"""
+
+    @patch('requests.post')
+    def test_checkout_queues_without_http_call(self, mock_post, client, db_session, discord_webhook):
+        """The order and its outbox entry are committed; nothing is sent inline"""
+        objects = _create_full_catalog(db_session)
+        with client.session_transaction() as sess:
+            sess['session'] = objects['guest'].session
+
+        response = client.post('/checkout/place_order', data=_checkout_form(objects['city']))
+
+        assert 'order_confirmation' in response.headers.get('Location', '')
+        mock_post.assert_not_called()
+        order = Order.query.one()
+        entry = NotificationOutbox.query.one()
+        assert entry.channel == 'discord'
+        assert entry.status == 'pending'
+        assert f'#{order.id}' in json.loads(entry.payload)['content']
+
+    def test_checkout_without_webhook_queues_nothing(self, client, db_session, monkeypatch):
+        """No webhook configured means no outbox entry"""
+        monkeypatch.delenv('DISCORD_WEBHOOK_URL', raising=False)
+        objects = _create_full_catalog(db_session)
+        with client.session_transaction() as sess:
+            sess['session'] = objects['guest'].session
+
+        client.post('/checkout/place_order', data=_checkout_form(objects['city']))
+
+        assert Order.query.count() == 1
+        assert NotificationOutbox.query.count() == 0
+
+
+class TestOutboxDrain:
+    """The background sender retries, backs off and dead-letters"""
+
+    def _queue(self, db_session):
+        from app import queue_notification
+        entry = queue_notification('discord', {'content': 'hello'})
+        db_session.commit()
+        return entry.id
+
+    @patch('requests.post')
+    def test_drain_sends_pending_entry(self, mock_post, app, db_session, discord_webhook):
+        """A successful send marks the entry as sent"""
+        from app import drain_notification_outbox
+        mock_post.return_value = _response(204)
+        entry_id = self._queue(db_session)
+
+        assert drain_notification_outbox() == 1
+
+        assert mock_post.call_args.kwargs['json'] == {'content': 'hello'}
+        assert mock_post.call_args.kwargs['timeout'] == flask_app.config['NOTIFICATION_SEND_TIMEOUT']
+        entry = db_session.get(NotificationOutbox, entry_id)
+        assert entry.status == 'sent'
+        assert entry.sent_at is not None
+
+    @patch('requests.post')
+    def test_failure_backs_off(self, mock_post, app, db_session, discord_webhook):
+        """A failed send is rescheduled into the future, not retried at once"""
+        from app import drain_notification_outbox
+        mock_post.return_value = _response(500)
+        entry_id = self._queue(db_session)
+
+        assert drain_notification_outbox() == 0
+        assert drain_notification_outbox() == 0
+
+        assert mock_post.call_count == 1
+        entry = db_session.get(NotificationOutbox, entry_id)
+        assert entry.status == 'pending'
+        assert entry.attempts == 1
+        assert '500' in entry.last_error
+        assert entry.next_attempt_at > entry.created_at
+
+    @patch('requests.post')
+    def test_entry_goes_dead_after_max_attempts(self, mock_post, app, db_session, discord_webhook):
+        """Retries stop at NOTIFICATION_MAX_ATTEMPTS"""
+        from app import drain_notification_outbox, db
+        mock_post.side_effect = ConnectionError('unreachable')
+        entry_id = self._queue(db_session)
+
+        for _ in range(flask_app.config['NOTIFICATION_MAX_ATTEMPTS']):
+            # Make the entry due again instead of waiting out the backoff
+            db_session.execute(db.update(NotificationOutbox).values(
+                next_attempt_at=NotificationOutbox.created_at - timedelta(seconds=1)))
+            db_session.commit()
+            drain_notification_outbox()
+
+        entry = db_session.get(NotificationOutbox, entry_id)
+        db_session.refresh(entry)
+        assert entry.status == 'dead'
+        assert entry.attempts == flask_app.config['NOTIFICATION_MAX_ATTEMPTS']
+        assert 'unreachable' in entry.last_error
+
+    def test_claim_is_exclusive(self, app, db_session):
+        """Only one worker can claim a due entry"""
+        from app import _claim_notification, utc_now
+        entry_id = self._queue(db_session)
+        now = utc_now()
+
+        assert _claim_notification(entry_id, now) is True
+        assert _claim_notification(entry_id, now) is False
+
+    def test_retry_delay_doubles_up_to_cap(self, app):
+        """Backoff grows exponentially, stays jittered below the cap"""
+        from app import notification_retry_delay
+        base = flask_app.config['NOTIFICATION_RETRY_BASE']
+        cap = flask_app.config['NOTIFICATION_RETRY_MAX']
+        assert base / 2 <= notification_retry_delay(1) <= base
+        assert base * 2 <= notification_retry_delay(3) <= base * 4
+        assert notification_retry_delay(50) <= cap
+
+
+class TestOutboxAdmin:
+    """Admin visibility into the outbox"""
+
+    def test_metrics_and_retry_dead_entry(self, authenticated_client, db_session):
+        """Dead letters are listed and can be re-queued"""
+        entry = NotificationOutbox(channel='discord', payload='{}', status='dead',
+                                   attempts=8, last_error='boom')
+        db_session.add(entry)
+        db_session.commit()
+
+        data = authenticated_client.get('/admin/api/metrics/notifications').get_json()
+        assert data['counts']['dead'] == 1
+        assert data['dead'][0]['last_error'] == 'boom'
+
+        response = authenticated_client.post(f'/admin/api/notifications/{entry.id}/retry')
+        assert response.status_code == 200
+        db_session.refresh(entry)
+        assert entry.status == 'pending'
+        assert entry.attempts == 0
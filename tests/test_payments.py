@@ -0,0 +1,131 @@
+"""
+Tests for background Fawaterak invoice creation
+"""
+from datetime import timedelta
+
+import pytest
+import requests
+
+import app as app_module
+from app import Order, claim_invoice, utc_now
+from models.fawaterak import FawaterakError
+from test_production import _create_full_catalog, _checkout_form
+
+
+class InlineExecutor:
+    """Runs submitted invoice jobs immediately, so tests need no waiting"""
+
+    def __init__(self):
+        self.submitted = []
+
+    def submit(self, fn, *args):
+        self.submitted.append(args)
+        fn(*args)
+
+
+class FakeFawaterak:
+    def __init__(self, error=None):
+        self.error = error
+        self.payloads = []
+
+    def create_invoice(self, payload):
+        self.payloads.append(payload)
+        if self.error:
+            raise self.error
+        number = len(self.payloads)
+        return {'invoiceKey': f'key-{number}', 'invoiceId': number, 'url': f'https://pay.example/{number}'}
+
+
+@pytest.fixture
+def executor(monkeypatch):
+    executor = InlineExecutor()
+    monkeypatch.setattr(app_module, '_invoice_executor', lambda: executor)
+    return executor
+
+
+@pytest.fixture
+def gateway(monkeypatch):
+    gateway = FakeFawaterak()
+    monkeypatch.setattr(app_module, 'fawaterak_service', gateway)
+    return gateway
+
+
+@pytest.fixture
+def visa_order(client, db_session, executor, gateway):
+    """A placed visa order of the logged-in guest"""
+    objects = _create_full_catalog(db_session)
+    with client.session_transaction() as sess:
+        sess['session'] = objects['guest'].session
+    response = client.post('/checkout/place_order',
+                           data=_checkout_form(objects['city'], payment_method='visa'))
+    order = Order.query.one()
+    assert response.headers['Location'].endswith(f'/payment/processing/{order.id}')
+    return order
+
+
+class TestInvoiceCreation:
+    """place_order() hands the invoice to a background worker"""
+
+    def test_invoice_is_stored_on_the_order(self, client, visa_order, gateway):
+        db_order = Order.query.one()
+        assert db_order.invoice_status == 'ready'
+        assert db_order.invoice_key == 'key-1'
+        assert db_order.invoice_url == 'https://pay.example/1'
+
+        payload = gateway.payloads[0]
+        # 100 + 25 shipping
+        assert payload['cartTotal'] == '125.0'
+        assert payload['redirectionUrls']['successUrl'].endswith(f'/payment/success/{db_order.id}')
+
+        data = client.get(f'/payment/status/{db_order.id}').get_json()
+        assert data == {'status': 'ready', 'url': 'https://pay.example/1'}
+        # The wait page sends customers who come back straight to the invoice
+        assert client.get(f'/payment/processing/{db_order.id}').headers['Location'] == 'https://pay.example/1'
+
+    def test_one_invoice_per_order(self, client, visa_order, gateway):
+        client.get(f'/payment/processing/{visa_order.id}')
+        client.post(f'/payment/retry/{visa_order.id}')
+        client.get(f'/payment/status/{visa_order.id}')
+        assert len(gateway.payloads) == 1
+
+    def test_claim_in_flight_is_not_taken_twice(self, visa_order, db_session):
+        Order.query.filter_by(id=visa_order.id).update(
+            {'invoice_status': 'creating', 'invoice_url': None, 'invoice_requested_at': utc_now()})
+        db_session.commit()
+        assert not claim_invoice(visa_order.id)
+
+        # A claim whose worker died is taken over after the lease
+        Order.query.filter_by(id=visa_order.id).update(
+            {'invoice_requested_at': utc_now() - timedelta(hours=1)})
+        db_session.commit()
+        assert claim_invoice(visa_order.id)
+
+    def test_status_is_private_to_the_guest(self, client, visa_order):
+        with client.session_transaction() as sess:
+            sess['session'] = 'someone-else'
+        assert client.get(f'/payment/status/{visa_order.id}').status_code == 404
+        assert client.get(f'/payment/processing/{visa_order.id}').status_code == 404
+
+
+class TestInvoiceFailures:
+    """A failed invoice is reported to the wait page and can be retried"""
+
+    @pytest.mark.parametrize('error', [FawaterakError('refused'), requests.exceptions.ReadTimeout('slow')])
+    def test_failure_then_retry(self, client, db_session, executor, gateway, error):
+        gateway.error = error
+        objects = _create_full_catalog(db_session)
+        with client.session_transaction() as sess:
+            sess['session'] = objects['guest'].session
+        client.post('/checkout/place_order', data=_checkout_form(objects['city'], payment_method='visa'))
+        order = Order.query.one()
+
+        assert client.get(f'/payment/status/{order.id}').get_json()['status'] == 'failed'
+        assert Order.query.one().invoice_error
+        # Polling does not retry on its own
+        assert len(gateway.payloads) == 1
+
+        gateway.error = None
+        response = client.post(f'/payment/retry/{order.id}')
+        assert response.headers['Location'].endswith(f'/payment/processing/{order.id}')
+        assert Order.query.one().invoice_status == 'ready'
+        assert len(gateway.payloads) == 2
@@ -12,13 +12,14 @@ Covers:
 """
 import json
 import os
+import threading
 import pytest
 from werkzeug.security import generate_password_hash
 
 from app import app as flask_app, db
 from app import (
-    Admins, Category, City, Gusts, Order, Product,
-    ShippingCost, Cart,
+    Admins, Category, City, Gusts, Order, OrderItem, Product,
+    ShippingCost, Cart, PromoCode,
 )
 
 
@@ -63,6 +64,22 @@ def _create_full_catalog(session):
     return {'category': category, 'product': product, 'city': city, 'guest': guest}
 
 
+def _checkout_form(city, **overrides):
+    """Form fields of a valid cash-on-delivery checkout."""
+    form = {
+        'name': 'Test',
+        'phone': '01000000000',
+        'address': 'Addr',
+        'city': city.city_id,
+        'zone_id': '10',
+        'district_id': '20',
+        'total': '125',
+        'payment_method': 'cash_on_delivery',
+    }
+    form.update(overrides)
+    return form
+
+
 # ---------------------------------------------------------------------------
 # 1. Production configuration
 # ---------------------------------------------------------------------------
@@ -325,6 +342,110 @@ class TestOrderPlacementCOD:
         assert '/checkout' in response.headers.get('Location', '')
 
 
+class TestOrderPlacementAtomicity:
+    """Stock, promo codes, order and cart change together or not at all."""
+
+    def _login(self, client, guest):
+        with client.session_transaction() as sess:
+            sess['session'] = guest.session
+
+    def test_order_decrements_stock_and_empties_cart(self, client, db_session):
+        objects = _create_full_catalog(db_session)
+        product_id = objects['product'].id
+        self._login(client, objects['guest'])
+
+        response = client.post('/checkout/place_order', data=_checkout_form(objects['city']))
+
+        assert 'order_confirmation' in response.headers.get('Location', '')
+        db_session.expire_all()
+        assert db_session.get(Product, product_id).stock == 9
+        assert Cart.query.filter_by(user_id=objects['guest'].id).count() == 0
+        order = Order.query.filter_by(user_id=objects['guest'].id).one()
+        assert OrderItem.query.filter_by(order_id=order.id).count() == 1
+
+    def test_insufficient_stock_leaves_everything_untouched(self, client, db_session):
+        objects = _create_full_catalog(db_session)
+        product_id = objects['product'].id
+        Cart.query.filter_by(user_id=objects['guest'].id).update({'quantity': 11})
+        db_session.add(PromoCode(code='EID', discount=10, count=3))
+        db_session.commit()
+        self._login(client, objects['guest'])
+
+        response = client.post('/checkout/place_order',
+                               data=_checkout_form(objects['city'], promo_code='eid'))
+
+        assert response.headers.get('Location', '').endswith('/cart')
+        db_session.expire_all()
+        assert db_session.get(Product, product_id).stock == 10
+        assert Order.query.count() == 0
+        assert Cart.query.filter_by(user_id=objects['guest'].id).count() == 1
+        # the redemption was rolled back with the failed reservation
+        assert PromoCode.query.filter_by(code='EID').one().count == 3
+
+    def test_promo_code_redemption_is_counted(self, client, db_session):
+        objects = _create_full_catalog(db_session)
+        db_session.add(PromoCode(code='EID', discount=10, count=1))
+        db_session.commit()
+        self._login(client, objects['guest'])
+
+        client.post('/checkout/place_order', data=_checkout_form(objects['city'], promo_code='eid'))
+
+        db_session.expire_all()
+        assert PromoCode.query.filter_by(code='EID').one().count == 0
+        # 100 - 10% + 25 shipping
+        assert Order.query.one().cod_amount == pytest.approx(115.0)
+
+    def test_exhausted_promo_code_is_not_applied(self, client, db_session):
+        objects = _create_full_catalog(db_session)
+        db_session.add(PromoCode(code='EID', discount=10, count=0))
+        db_session.commit()
+        self._login(client, objects['guest'])
+
+        client.post('/checkout/place_order', data=_checkout_form(objects['city'], promo_code='eid'))
+
+        db_session.expire_all()
+        assert PromoCode.query.filter_by(code='EID').one().count == 0
+        assert Order.query.one().cod_amount == pytest.approx(125.0)
+
+    def test_concurrent_checkouts_never_oversell(self, app, db_session):
+        """Several buyers race for the last unit; exactly one gets it."""
+        objects = _create_full_catalog(db_session)
+        product = objects['product']
+        product.stock = 1
+        buyers = []
+        for n in range(6):
+            guest = Gusts(session=f'race-{n}', name='Racer', phone='01000000000', address='Addr')
+            db_session.add(guest)
+            db_session.flush()
+            db_session.add(Cart(user_id=guest.id, product_id=product.id, quantity=1))
+            buyers.append(guest.session)
+        db_session.commit()
+        product_id, form = product.id, _checkout_form(objects['city'])
+
+        barrier = threading.Barrier(len(buyers))
+        statuses = []
+
+        def checkout(token):
+            client = app.test_client()
+            with client.session_transaction() as sess:
+                sess['session'] = token
+            barrier.wait()
+            statuses.append(client.post('/checkout/place_order', data=form).status_code)
+
+        threads = [threading.Thread(target=checkout, args=(token,)) for token in buyers]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert statuses == [302] * len(buyers)
+        db_session.expire_all()
+        stock = db_session.get(Product, product_id).stock
+        orders = Order.query.filter(Order.user_id != objects['guest'].id).count()
+        assert stock >= 0
+        assert orders + stock == 1
+
+
 # ---------------------------------------------------------------------------
 # 7. Payment webhook
 # ---------------------------------------------------------------------------
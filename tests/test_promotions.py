@@ -0,0 +1,210 @@
+"""
+Tests for the data-driven promotion rules
+"""
+import json
+from datetime import datetime, timedelta
+
+import pytest
+
+from app import db, City, Order, PromoCode, PromotionRule, PromotionEngine, promotion_engine, seed_default_promotions
+from test_production import _create_full_catalog, _checkout_form
+
+NOW = datetime(2026, 3, 1, 12, 0)
+
+
+def _rule(id, **fields):
+    """A compiled rule as PromotionEngine sees it."""
+    rule = PromotionRule(id=id, slug=fields.pop('slug', f'rule_{id}'), name=fields.pop('name', f'Rule {id}'),
+                         message=fields.pop('message', ''), target=fields.pop('target', 'items'),
+                         discount_type=fields.pop('discount_type', 'percent'), amount=fields.pop('amount', 10),
+                         product_ids=json.dumps(fields.pop('product_ids', [])),
+                         city_ids=json.dumps(fields.pop('city_ids', [])),
+                         priority=fields.pop('priority', 100), **fields)
+    return PromotionEngine.compile(rule)
+
+
+class TestPromotionEngine:
+    """Rule matching and discount arithmetic"""
+
+    def test_percent_off_items_inside_window(self):
+        engine = PromotionEngine([_rule(1, starts_at=NOW - timedelta(days=1), ends_at=NOW + timedelta(days=1))])
+
+        pricing = engine.evaluate({7}, 200.0, now=NOW)
+        assert pricing.items_discount == 20.0
+        assert pricing.items_total == 180.0
+        assert pricing.items_rule.slug == 'rule_1'
+
+        assert engine.evaluate({7}, 200.0, now=NOW + timedelta(days=2)).items_rule is None
+
+    def test_product_and_city_conditions(self):
+        engine = PromotionEngine([
+            _rule(1, target='shipping', amount=100, product_ids=[4], city_ids=['cai']),
+            _rule(2, target='shipping', amount=50, product_ids=[4], priority=200),
+        ])
+
+        assert engine.evaluate({1}, city_id='cai', shipping=60.0, now=NOW).shipping_rule is None
+        assert engine.evaluate({4}, city_id='cai', shipping=60.0, now=NOW).shipping_price == 0
+        # Other cities fall through to the lower-priority rule
+        assert engine.evaluate({4, 9}, city_id='asw', shipping=60.0, now=NOW).shipping_price == 30.0
+
+    def test_one_rule_per_target(self):
+        engine = PromotionEngine([
+            _rule(1, amount=10, priority=1),
+            _rule(2, amount=50, priority=2),
+            _rule(3, target='shipping', discount_type='fixed', amount=15),
+        ])
+
+        pricing = engine.evaluate({1}, 100.0, city_id='cai', shipping=40.0, now=NOW)
+        assert pricing.items_discount == 10.0
+        assert pricing.shipping_discount == 15.0
+        assert pricing.shipping_price == 25.0
+
+    def test_fixed_discount_is_capped(self):
+        engine = PromotionEngine([_rule(1, target='shipping', discount_type='fixed', amount=80)])
+        assert engine.evaluate(set(), shipping=50.0, now=NOW).shipping_price == 0
+
+    def test_shipping_rules_need_a_shipping_price(self):
+        engine = PromotionEngine([_rule(1, target='shipping')])
+        pricing = engine.evaluate({1}, 100.0, now=NOW)
+        assert pricing.shipping_rule is None
+        assert pricing.shipping_price is None
+
+
+class TestPromotionStorage:
+    """Rules are loaded from the database and refreshed on admin edits"""
+
+    def test_seed_resolves_eid_cities(self, app, db_session):
+        db_session.add_all([City(name='القاهره', city_id='cai'), City(name='أسوان', city_id='asw')])
+        db_session.commit()
+
+        assert seed_default_promotions() == 4
+        assert seed_default_promotions() == 0
+        eid = PromotionRule.query.filter_by(slug='eid_free_shipping').one()
+        assert eid.city_id_list == ['cai']
+        assert eid.is_active
+
+    def test_engine_is_cached_until_invalidated(self, app, db_session):
+        from sqlalchemy import event
+        statements = []
+
+        def record(conn, cursor, statement, params, context, executemany):
+            statements.append(statement)
+
+        promotion_engine()
+        event.listen(db.engine, 'before_cursor_execute', record)
+        try:
+            promotion_engine().evaluate({1, 2, 3}, 100.0, city_id='cai', shipping=50.0)
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', record)
+        assert statements == []
+
+    def test_admin_crud_refreshes_engine(self, authenticated_client, db_session):
+        assert promotion_engine().rules == ()
+
+        response = authenticated_client.post('/admin/promotions/add', data={
+            'name': 'خصم الصيف', 'slug': 'summer', 'target': 'items', 'discount_type': 'percent',
+            'amount': '15', 'priority': '5', 'product_ids': '1, 2', 'is_active': 'on',
+        })
+        assert response.status_code == 302
+        rule = PromotionRule.query.one()
+        assert rule.product_id_list == [1, 2]
+        assert [r.slug for r in promotion_engine().rules] == ['summer']
+
+        authenticated_client.post(f'/admin/promotions/toggle/{rule.id}')
+        assert promotion_engine().rules == ()
+
+        authenticated_client.post(f'/admin/promotions/delete/{rule.id}')
+        assert PromotionRule.query.count() == 0
+
+    def test_admin_rejects_invalid_percent(self, authenticated_client, db_session):
+        authenticated_client.post('/admin/promotions/add', data={
+            'name': 'Bad', 'slug': 'bad', 'target': 'items', 'discount_type': 'percent', 'amount': '150',
+        })
+        assert PromotionRule.query.count() == 0
+
+    def test_admin_page_lists_rules(self, authenticated_client, db_session):
+        seed_default_promotions()
+        response = authenticated_client.get('/admin/promotions')
+        assert response.status_code == 200
+        assert 'combo_1_2_3' in response.get_data(as_text=True)
+
+
+class TestCheckoutPricing:
+    """Checkout and order placement price with the active rules"""
+
+    @pytest.fixture
+    def catalog(self, db_session):
+        objects = _create_full_catalog(db_session)
+        db_session.add_all([
+            PromotionRule(slug='all_20', name='خصم 20%', message='خصم 20% على كل الطلبات',
+                          target='items', discount_type='percent', amount=20),
+            PromotionRule(slug='ship_5', name='شحن مخفض', target='shipping', discount_type='fixed', amount=5,
+                          product_ids=json.dumps([objects['product'].id]),
+                          city_ids=json.dumps([objects['city'].city_id])),
+        ])
+        db_session.commit()
+        return objects
+
+    def test_order_total_includes_item_and_shipping_offers(self, client, catalog):
+        with client.session_transaction() as sess:
+            sess['session'] = catalog['guest'].session
+
+        client.post('/checkout/place_order', data=_checkout_form(catalog['city']))
+
+        # 100 - 20% + (25 - 5)
+        assert Order.query.one().cod_amount == pytest.approx(100.0)
+
+    def test_checkout_page_shows_offer(self, client, catalog):
+        with client.session_transaction() as sess:
+            sess['session'] = catalog['guest'].session
+
+        html = client.get('/checkout').get_data(as_text=True)
+        assert 'خصم 20% على كل الطلبات' in html
+
+    def test_shipping_cost_endpoint_reports_offer(self, client, catalog):
+        with client.session_transaction() as sess:
+            sess['session'] = catalog['guest'].session
+
+        data = client.get(f"/get_shipping_cost/{catalog['city'].city_id}").get_json()
+        assert data['shipping_cost'] == 20.0
+        assert data['standard_cost'] == 25.0
+        assert data['offer'] == 'ship_5'
+
+    def test_cart_quote_matches_order_total(self, client, catalog, db_session):
+        db_session.add(PromoCode(code='SAVE10', discount=10, count=1))
+        db_session.commit()
+        with client.session_transaction() as sess:
+            sess['session'] = catalog['guest'].session
+
+        data = client.get(f"/api/cart/quote?city={catalog['city'].city_id}&promo_code=save10").get_json()
+        assert data['subtotal'] == 100.0
+        assert data['promotion']['discount'] == 20.0
+        assert data['promo_code']['discount'] == 8.0
+        assert data['shipping']['cost'] == 20.0
+        assert data['shipping']['offer'] == 'ship_5'
+        # 100 - 20% - 10% + (25 - 5)
+        assert data['total'] == 92.0
+        # Quoting does not use the code up
+        assert PromoCode.query.one().count == 1
+
+        client.post('/checkout/place_order', data=_checkout_form(catalog['city'], promo_code='SAVE10'))
+        assert Order.query.one().cod_amount == pytest.approx(data['total'])
+        assert PromoCode.query.one().count == 0
+
+    def test_cart_quote_without_city_prices_items_only(self, client, catalog):
+        with client.session_transaction() as sess:
+            sess['session'] = catalog['guest'].session
+
+        data = client.get('/api/cart/quote?promo_code=NOPE').get_json()
+        assert data['items_total'] == 80.0
+        assert data['shipping'] is None
+        assert data['total'] is None
+        assert data['promo_code']['valid'] is False
+        assert data['zones'] is None
+
+    def test_cart_quote_rejects_unknown_city_and_empty_cart(self, client, catalog):
+        assert client.get('/api/cart/quote').status_code == 404
+
+        with client.session_transaction() as sess:
+            sess['session'] = catalog['guest'].session
+        assert client.get('/api/cart/quote?city=nowhere').status_code == 404
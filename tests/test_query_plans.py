@@ -0,0 +1,80 @@
+"""
+Query plan checks for the hot lookup paths
+"""
+import os
+import re
+from datetime import datetime
+
+import pytest
+
+from app import (
+    db, Gusts, Cart, Order, OrderItem, City, Zone, District, ShippingCost, Product, PromoCode
+)
+
+SINCE = datetime(2026, 1, 1)
+
+HOT_QUERIES = {
+    'guest by session token': db.select(Gusts).where(Gusts.session == 'token'),
+    'cart by guest': db.select(Cart).where(Cart.user_id == 1),
+    'cart line by guest and product': db.select(Cart).where(Cart.user_id == 1, Cart.product_id == 2),
+    'cart lines of a product': db.select(Cart.id).where(Cart.product_id == 2),
+    'expired cart sweep': db.select(Cart.id).where(Cart.created_at < SINCE).limit(500),
+    'order by invoice key': db.select(Order).where(Order.invoice_key == 'key'),
+    'orders of a guest': db.select(Order).where(Order.user_id == 1),
+    'orders by shipping status': db.select(db.func.count(Order.id)).where(Order.shipping_status == 'pending'),
+    'orders since a date': db.select(Order).where(Order.created_at >= SINCE),
+    'items of an order': db.select(OrderItem).where(OrderItem.order_id == 1),
+    'city by bosta id': db.select(City).where(City.city_id == 'abc'),
+    'zones of a city': db.select(Zone).where(Zone.city_id == 1),
+    'districts of a city': db.select(District).where(District.city_id == 1),
+    'shipping cost of a city': db.select(ShippingCost).where(ShippingCost.city_id == 1),
+    'latest products': db.select(Product).order_by(Product.created_at.desc(), Product.id.desc()).limit(8),
+    'most viewed products': db.select(Product).order_by(Product.views.desc()).limit(8),
+    'products on sale': db.select(Product).where(
+        Product.discount > 0, Product.stock > 0).order_by(Product.discount.desc()).limit(6),
+    'category listing': db.select(Product).where(Product.category_id == 1).order_by(
+        Product.created_at.desc(), Product.id.desc()).limit(9),
+    'promo code lookup': db.select(PromoCode).where(PromoCode.code == 'EID'),
+}
+
+# "SCAN product" is a full table scan; "SCAN product USING INDEX ..." walks an index
+FULL_SCAN = re.compile(r'^SCAN (?!CONSTANT ROW)\S+$')
+
+
+class TestHotQueryPlans:
+    """Every hot lookup must be served by an index"""
+
+    @pytest.mark.parametrize('name', sorted(HOT_QUERIES))
+    def test_no_full_table_scan(self, app, db_session, name):
+        """EXPLAIN QUERY PLAN shows no plain table scan"""
+        compiled = HOT_QUERIES[name].compile(db.engine, compile_kwargs={'literal_binds': True})
+        plan = db_session.execute(db.text(f'EXPLAIN QUERY PLAN {compiled}')).all()
+        details = [row[-1] for row in plan]
+        assert not [d for d in details if FULL_SCAN.match(d)], f'{name}: {details}'
+
+    def test_order_item_order_id_is_foreign_key(self, app):
+        """order_item.order_id references order.id"""
+        fks = db.inspect(db.engine).get_foreign_keys('order_item')
+        assert any(fk['referred_table'] == 'order' and fk['constrained_columns'] == ['order_id']
+                   for fk in fks)
+
+
+class TestIndexMigration:
+    """The index pack migration applies to databases built without it"""
+
+    def test_downgrade_and_upgrade_round_trip(self, app):
+        """Downgrading drops the pack, upgrading restores it"""
+        from flask_migrate import downgrade, upgrade
+
+        def index_names():
+            inspector = db.inspect(db.engine)
+            return {ix['name'] for table in ('gusts', 'cart', 'order', 'product')
+                    for ix in inspector.get_indexes(table)}
+
+        migrations = os.path.join(os.path.dirname(__file__), '..', 'migrations')
+        upgrade(directory=migrations)
+        downgrade(directory=migrations, revision='base')
+        assert 'ix_gusts_session' not in index_names()
+        upgrade(directory=migrations)
+        assert {'ix_gusts_session', 'ix_cart_created_at', 'ix_order_invoice_key',
+                'ix_product_category_id_created_at'} <= index_names()
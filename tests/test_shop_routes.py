@@ -2,6 +2,7 @@
 Tests for shop routes
 """
 import pytest
+from io import BytesIO
 from flask import session
 
 class TestShopHomePage:
@@ -20,6 +21,66 @@ class TestShopHomePage:
         # Categories are injected via context processor
         assert sample_category.name in response.data.decode('utf-8') or 'إلكترونيات' in response.data.decode('utf-8')
 
+class TestHomeFragmentCache:
+    """Tests for the cached home page sections"""
+
+    def _add_banner(self, db_session, title):
+        from app import BannerSlide
+        banner = BannerSlide(image_url='https://cdn.example.com/b.jpg', title=title,
+                             link_url='/shop', is_active=True, sort_order=0)
+        db_session.add(banner)
+        db_session.commit()
+        return banner
+
+    def test_second_visit_hits_every_fragment(self, client, db_session):
+        """A warm home page is served from the fragment caches"""
+        from app import cache_stats
+
+        client.get('/')
+        client.get('/')
+        stats = cache_stats()
+        assert stats['home_banners']['hits'] == 1
+        assert stats['home_showcase']['hits'] == 1
+        assert stats['home_products']['hits'] == 2
+
+    def test_banner_fragment_is_stale_until_admin_edit(self, authenticated_client, db_session):
+        """Direct DB changes wait for an admin action to bump the version"""
+        banner = self._add_banner(db_session, 'بانر أول')
+        assert 'بانر أول' in authenticated_client.get('/').data.decode('utf-8')
+
+        banner.title = 'بانر معدل'
+        db_session.commit()
+        assert 'بانر أول' in authenticated_client.get('/').data.decode('utf-8')
+
+        authenticated_client.post(f'/admin/banners/toggle/{banner.id}')
+        authenticated_client.post(f'/admin/banners/toggle/{banner.id}')
+        assert 'بانر معدل' in authenticated_client.get('/').data.decode('utf-8')
+
+    def test_product_sections_expire_on_ttl(self, app, client, db_session, sample_product, monkeypatch):
+        """Product-driven sections are not version-bound and honour their TTL"""
+        from app import Product, home_products_cache
+        now = [1000.0]
+        monkeypatch.setattr(home_products_cache, 'clock', lambda: now[0])
+        monkeypatch.setitem(app.config, 'HOME_PRODUCTS_CACHE_TTL', 60)
+
+        client.get('/')
+        db_session.add(Product(name='منتج جديد للصفحة', price=10.0, discount=0.0, stock=1,
+                               description='x', image='static/x.jpg',
+                               category_id=sample_product.category_id))
+        db_session.commit()
+
+        now[0] += 59
+        assert 'منتج جديد للصفحة' not in client.get('/').data.decode('utf-8')
+        now[0] += 1
+        assert 'منتج جديد للصفحة' in client.get('/').data.decode('utf-8')
+
+    def test_cache_metrics_endpoint(self, authenticated_client):
+        """Admin metrics endpoint exposes per-cache counters"""
+        authenticated_client.get('/')
+        data = authenticated_client.get('/admin/api/metrics/cache').get_json()
+        assert data['success'] is True
+        assert {'categories', 'home_banners', 'home_showcase', 'home_products'} <= set(data['caches'])
+
 class TestProductListing:
     """Tests for product listing"""
 
@@ -45,6 +106,195 @@ class TestProductListing:
         response = client.get('/shop?min_price=10000&max_price=20000')
         assert response.status_code == 200
 
+class TestProductSearch:
+    """Tests for the FTS5 product search index"""
+
+    def _product(self, db_session, category_id, name, description='وصف'):
+        from app import Product
+        product = Product(name=name, price=10.0, discount=0.0, stock=5,
+                          description=description, image='static/x.jpg', category_id=category_id)
+        db_session.add(product)
+        db_session.commit()
+        return product
+
+    def _names(self, client, search):
+        html = client.get('/shop', query_string={'search': search}).data.decode('utf-8')
+        return html
+
+    def test_index_is_available(self, app):
+        """The test database supports FTS5, so the ILIKE fallback is not used"""
+        from app import search_index_enabled
+        assert search_index_enabled()
+
+    def test_failed_setup_is_not_latched(self, app, db_session, sample_product, monkeypatch):
+        """A worker that loses the startup race keeps using the index"""
+        import app as app_module
+        from sqlalchemy.exc import OperationalError
+
+        def locked(*args):
+            raise OperationalError('INSERT INTO product_search', {}, Exception('database is locked'))
+
+        index_product = app_module._index_product
+        monkeypatch.setattr(app_module, '_search_enabled', app_module._search_enabled)
+        connection = db_session.connection()
+        connection.execute(app_module.sa_text('DROP TABLE product_search'))
+        monkeypatch.setattr(app_module, '_index_product', locked)
+        app_module._create_search_index(None, connection)
+        assert app_module._search_enabled is None
+
+        monkeypatch.setattr(app_module, '_index_product', index_product)
+        assert app_module.search_index_enabled(connection)
+        db_session.commit()
+
+    def test_normalize_arabic_folds_spelling_variants(self):
+        """Alef/hamza, taa marbuta and diacritics are folded"""
+        from app import normalize_arabic
+        assert normalize_arabic('الإسكندرية') == normalize_arabic('الاسكندريه')
+        assert normalize_arabic('مُحَمَّد') == 'محمد'
+
+    def test_search_matches_across_spelling_variants(self, client, db_session, sample_category):
+        """Searching one spelling finds products stored with the other"""
+        self._product(db_session, sample_category.id, 'عطر الإسكندرية')
+        assert 'عطر الإسكندرية' in self._names(client, 'الاسكندريه')
+
+    def test_name_matches_rank_above_description_matches(self, client, db_session, sample_category):
+        """A hit in the name outranks a hit buried in the description"""
+        self._product(db_session, sample_category.id, 'منتج وصفي', description='يحتوي على زيت الورد')
+        self._product(db_session, sample_category.id, 'زيت الورد الطبيعي')
+        html = self._names(client, 'زيت')
+        assert html.index('زيت الورد الطبيعي') < html.index('منتج وصفي')
+
+    def test_index_follows_edits_and_deletes(self, db_session, sample_product):
+        """Mapper events keep the index in step with the product table"""
+        from app import Product, db, product_search_hits
+
+        def hits(term):
+            return [row.product_id for row in db.session.execute(db.select(product_search_hits(term)))]
+
+        assert hits('Dell') == [sample_product.id]
+        sample_product.name = 'لابتوب Lenovo'
+        sample_product.description = 'لابتوب Lenovo خفيف'
+        db_session.commit()
+        assert hits('Dell') == []
+        assert hits('lenovo') == [sample_product.id]
+
+        db_session.delete(db_session.get(Product, sample_product.id))
+        db_session.commit()
+        assert hits('lenovo') == []
+
+    def test_rebuild_search_index(self, db_session, sample_product):
+        """The reindex helper restores a wiped index"""
+        from app import db, rebuild_search_index, product_search_hits
+        db.session.execute(db.text('DELETE FROM product_search'))
+        db.session.commit()
+        assert rebuild_search_index() == 1
+        assert db.session.execute(db.select(product_search_hits('Dell'))).first() is not None
+
+class TestKeysetPagination:
+    """Tests for cursor-based listing pagination"""
+
+    def _products(self, db_session, category_id, count):
+        from app import Product, utc_now
+        # Shared timestamps force the id tie-breaker to matter
+        stamp = utc_now()
+        products = [Product(name=f'منتج {i:02d}', price=float(i), discount=0.0, stock=1,
+                            description='x', image='static/x.jpg', category_id=category_id,
+                            created_at=stamp) for i in range(count)]
+        db_session.add_all(products)
+        db_session.commit()
+        return products
+
+    def test_walks_every_row_once_in_order(self, app, db_session, sample_category):
+        """Following next cursors visits all rows in (created_at, id) order"""
+        from app import Product, keyset_paginate
+        products = self._products(db_session, sample_category.id, 7)
+        order = [(Product.created_at, True), (Product.id, True)]
+
+        seen, cursor = [], None
+        while True:
+            page = keyset_paginate(Product.query, order, 3, cursor=cursor)
+            seen.extend(p.id for p in page.items)
+            if not page.has_next:
+                break
+            cursor = page.next_cursor
+        assert seen == sorted((p.id for p in products), reverse=True)
+        assert page.number == 3
+
+    def test_prev_cursor_returns_previous_page(self, app, db_session, sample_category):
+        """Going back yields the same rows the forward walk showed"""
+        from app import Product, keyset_paginate
+        self._products(db_session, sample_category.id, 7)
+        order = [(Product.id, False)]
+
+        first = keyset_paginate(Product.query, order, 3)
+        second = keyset_paginate(Product.query, order, 3, cursor=first.next_cursor)
+        back = keyset_paginate(Product.query, order, 3, cursor=second.prev_cursor)
+        assert [p.id for p in back.items] == [p.id for p in first.items]
+        assert back.number == 1 and not back.has_prev and back.has_next
+
+    def test_foreign_or_tampered_cursor_restarts(self, app, db_session, sample_category):
+        """A cursor from another listing, or an edited one, is ignored"""
+        from app import Product, keyset_paginate
+        self._products(db_session, sample_category.id, 4)
+        order = [(Product.id, False)]
+        first = keyset_paginate(Product.query, order, 2, signature='a')
+
+        other = keyset_paginate(Product.query, order, 2, cursor=first.next_cursor, signature='b')
+        tampered = keyset_paginate(Product.query, order, 2, cursor=first.next_cursor + 'x', signature='a')
+        assert [p.id for p in other.items] == [p.id for p in first.items]
+        assert [p.id for p in tampered.items] == [p.id for p in first.items]
+
+    def test_shop_next_page_uses_seek_not_offset(self, client, db_session, sample_category):
+        """The storefront follows its next link without OFFSET"""
+        import re
+        from html import unescape
+        from sqlalchemy import event
+        from app import db
+        self._products(db_session, sample_category.id, 12)
+        html = client.get('/shop').data.decode('utf-8')
+        next_url = unescape(re.search(r'href="(/shop\?cursor=[^"]+)"', html).group(1))
+
+        statements = []
+
+        def record(conn, cursor, statement, params, context, executemany):
+            if 'OFFSET' in statement:
+                # SQLite always renders LIMIT ? OFFSET ?; the offset must stay 0
+                statements.append(params[-1])
+
+        event.listen(db.engine, 'before_cursor_execute', record)
+        try:
+            response = client.get(next_url)
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', record)
+        body = response.data.decode('utf-8')
+        assert 'منتج 02' in body and 'منتج 03' not in body
+        assert statements and not any(statements)
+
+    def test_legacy_page_links_still_work(self, client, db_session, sample_category):
+        """Old ?page=N links land on the right slice"""
+        self._products(db_session, sample_category.id, 12)
+        body = client.get('/shop?page=2').data.decode('utf-8')
+        assert 'منتج 02' in body and 'منتج 03' not in body
+
+    def test_search_results_paginate_by_relevance(self, app, client, db_session, sample_category):
+        """Relevance-ordered search results can be walked with cursors"""
+        import re
+        from html import unescape
+        self._products(db_session, sample_category.id, 12)
+        html = client.get('/shop', query_string={'search': 'منتج'}).data.decode('utf-8')
+        next_url = unescape(re.search(r'href="(/shop\?cursor=[^"]+)"', html).group(1))
+        assert client.get(next_url).status_code == 200
+
+    def test_cached_totals(self, app, db_session, sample_category):
+        """In cached mode the total is reused until the count cache expires"""
+        from app import Product, list_total
+        self._products(db_session, sample_category.id, 2)
+        assert list_total(Product.query) == 2
+        self._products(db_session, sample_category.id, 1)
+        assert list_total(Product.query) == 2
+        assert list_total(Product.query, mode='exact') == 3
+        assert list_total(Product.query, mode='none') is None
+
 class TestProductDetail:
     """Tests for product detail page"""
     
@@ -56,17 +306,126 @@ class TestProductDetail:
         assert str(sample_product.price) in response.data.decode('utf-8')
     
     def test_product_view_count(self, client, sample_product, db_session):
-        """Test product view count increments"""
+        """Test product view count increments once buffered views are flushed"""
+        from app import flush_product_views
         initial_views = sample_product.views
         client.get(f'/{sample_product.id}')
         db_session.refresh(sample_product)
+        assert sample_product.views == initial_views
+
+        flush_product_views()
+        db_session.refresh(sample_product)
         assert sample_product.views == initial_views + 1
+
+    def test_product_views_are_aggregated(self, client, sample_product, db_session):
+        """Several views collapse into a single additive update per product"""
+        from sqlalchemy import text
+        from app import flush_product_views
+        for _ in range(3):
+            client.get(f'/{sample_product.id}')
+        # A concurrent flush from another worker must not be overwritten
+        db_session.execute(text('UPDATE product SET views = views + 5 WHERE id = :id'),
+                           {'id': sample_product.id})
+        db_session.commit()
+
+        assert flush_product_views() == 1
+        db_session.refresh(sample_product)
+        assert sample_product.views == 8
     
     def test_nonexistent_product(self, client):
         """Test accessing nonexistent product returns 404"""
         response = client.get('/99999')
         assert response.status_code == 404
 
+class TestRelatedProducts:
+    """Tests for the related-products pool"""
+
+    def _product(self, db_session, name, category_id):
+        from app import Product
+        product = Product(name=name, price=10.0, discount=0.0, stock=5,
+                          description='x', image='static/x.jpg', category_id=category_id)
+        db_session.add(product)
+        db_session.commit()
+        return product
+
+    def test_co_purchased_products_come_first(self, app, db_session, sample_order, sample_product):
+        """Products bought in the same order fill the pool before category siblings"""
+        from app import Category, OrderItem, related_products
+        other = Category(name='أخرى')
+        db_session.add(other)
+        db_session.commit()
+        bought_together = self._product(db_session, 'مشترى معه', other.id)
+        for i in range(3):
+            self._product(db_session, f'نفس التصنيف {i}', sample_product.category_id)
+        db_session.add(OrderItem(order_id=sample_order.id, product_id=bought_together.id, quantity=1))
+        db_session.commit()
+
+        app.config['RELATED_PRODUCTS_POOL_SIZE'] = 1
+        try:
+            related = related_products(sample_product.id, limit=3)
+        finally:
+            app.config['RELATED_PRODUCTS_POOL_SIZE'] = 24
+        assert [p.id for p in related] == [bought_together.id]
+
+    def test_same_category_pool_excludes_current_product(self, db_session, sample_product):
+        """Category siblings are suggested and the product itself never is"""
+        from app import related_products
+        siblings = {self._product(db_session, f'شقيق {i}', sample_product.category_id).id for i in range(3)}
+
+        related_ids = {p.id for p in related_products(sample_product.id)}
+        assert related_ids == siblings
+
+    def test_falls_back_to_random_sample(self, db_session, sample_product):
+        """A product with no signal gets the cached random sample"""
+        from app import Category, related_products
+        lonely = Category(name='وحيد')
+        db_session.add(lonely)
+        db_session.commit()
+        alone = self._product(db_session, 'منتج وحيد', lonely.id)
+
+        assert {p.id for p in related_products(alone.id)} == {sample_product.id}
+
+    def test_small_category_is_topped_up(self, db_session, sample_product):
+        """A pool with too few siblings is filled from other categories"""
+        from app import Category, related_products
+        other = Category(name='أخرى')
+        db_session.add(other)
+        db_session.commit()
+        sibling = self._product(db_session, 'شقيق', sample_product.category_id)
+        elsewhere = {self._product(db_session, f'بعيد {i}', other.id).id for i in range(2)}
+
+        related_ids = {p.id for p in related_products(sample_product.id)}
+        assert related_ids == {sibling.id} | elsewhere
+
+    def test_new_product_is_suggested_at_once(self, authenticated_client, db_session, sample_product):
+        """Adding a product from the admin drops the cached pools"""
+        from app import Product, related_products
+        assert related_products(sample_product.id) == []
+
+        authenticated_client.post('/admin/add_product', content_type='multipart/form-data', data={
+            'name': 'منتج جديد', 'price': '500', 'quantity': '5',
+            'category': str(sample_product.category_id),
+            'image': (BytesIO(b'fake image data'), 'test.jpg'),
+        })
+        added = Product.query.filter_by(name='منتج جديد').one()
+        assert [p.id for p in related_products(sample_product.id)] == [added.id]
+
+    def test_product_page_does_not_sort_randomly(self, client, db_session, sample_product):
+        """The product page no longer issues ORDER BY random()"""
+        from sqlalchemy import event
+        from app import db
+        statements = []
+
+        def record(conn, cursor, statement, params, context, executemany):
+            statements.append(statement.lower())
+
+        event.listen(db.engine, 'before_cursor_execute', record)
+        try:
+            client.get(f'/{sample_product.id}')
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', record)
+        assert not any('random()' in s for s in statements)
+
 class TestCart:
     """Tests for cart functionality"""
     
@@ -110,6 +469,65 @@ class TestCart:
         response = client.get(f'/cart/remove/{cart_item.id}', follow_redirects=True)
         assert response.status_code == 200
 
+class TestCartQueries:
+    """Cart and checkout pages run a fixed number of statements, whatever the cart size"""
+
+    @staticmethod
+    def _fill_cart(db_session, guest, category, count):
+        from app import Cart, Product
+        for index in range(count):
+            product = Product(name=f'منتج {index}', price=10.0 + index, discount=0.0, stock=5,
+                              description='-', image=f'static/uploads/{index}.png', category_id=category.id)
+            db_session.add(product)
+            db_session.flush()
+            db_session.add(Cart(user_id=guest.id, product_id=product.id, quantity=1))
+        db_session.commit()
+
+    def _count(self, client, query_counter, path):
+        with query_counter() as queries:
+            response = client.get(path)
+        assert response.status_code == 200
+        return queries
+
+    @pytest.mark.parametrize('path', ['/cart', '/checkout'])
+    def test_no_query_per_cart_line(self, client, db_session, sample_guest, sample_category, query_counter, path):
+        with client.session_transaction() as sess:
+            sess['session'] = sample_guest.session
+        self._fill_cart(db_session, sample_guest, sample_category, 1)
+        client.get(path)  # warm the per-worker caches
+        single = self._count(client, query_counter, path)
+
+        self._fill_cart(db_session, sample_guest, sample_category, 5)
+        many = self._count(client, query_counter, path)
+
+        assert many.count == single.count
+        many.assert_at_most(4)
+
+    def test_update_cart_sums_in_sql(self, client, db_session, sample_guest, sample_category, query_counter):
+        from app import Cart
+        with client.session_transaction() as sess:
+            sess['session'] = sample_guest.session
+        self._fill_cart(db_session, sample_guest, sample_category, 3)
+        item = Cart.query.filter_by(user_id=sample_guest.id).order_by(Cart.id).first()
+
+        with query_counter() as queries:
+            response = client.post(f'/cart/update/{item.id}', json={'quantity': 2})
+        assert response.get_json()['new_subtotal'] == pytest.approx(10.0 * 2 + 11.0 + 12.0)
+        queries.assert_at_most(6)
+
+    def test_update_cart_ignores_other_guests_items(self, client, db_session, sample_guest, sample_product):
+        from app import Cart, Gusts
+        other = Gusts(session='other-session')
+        db_session.add(other)
+        db_session.flush()
+        item = Cart(user_id=other.id, product_id=sample_product.id, quantity=1)
+        db_session.add(item)
+        db_session.commit()
+        with client.session_transaction() as sess:
+            sess['session'] = sample_guest.session
+
+        assert client.post(f'/cart/update/{item.id}', json={'quantity': 2}).status_code == 404
+
 class TestCheckout:
     """Tests for checkout process"""
 
@@ -43,6 +43,98 @@ class TestSessionManagement:
                     user = db_session.get(Gusts, user_id)
                     assert user is not None
 
+    def test_read_only_pages_do_not_create_guests(self, client, db_session, sample_product):
+        """Catalog pages, crawler files and the cart page never insert Gusts rows"""
+        from app import Gusts
+
+        for path in ('/', '/shop', f'/{sample_product.id}', '/robots.txt', '/sitemap.xml', '/about', '/cart'):
+            response = client.get(path)
+            assert response.status_code == 200, path
+        assert Gusts.query.count() == 0
+
+    def test_add_to_cart_creates_guest_once(self, client, db_session, sample_product):
+        """The first add-to-cart inserts the guest row, later ones reuse it"""
+        from app import Gusts, Cart
+
+        client.get('/')
+        client.post(f'/cart/add/{sample_product.id}', data={'quantity': 1})
+        client.post(f'/cart/add/{sample_product.id}', data={'quantity': 1})
+
+        assert Gusts.query.count() == 1
+        guest = Gusts.query.first()
+        item = Cart.query.filter_by(user_id=guest.id).one()
+        assert item.quantity == 2
+        with client.session_transaction() as sess:
+            assert sess['session'] == guest.session
+
+    def test_recent_activity_is_not_rewritten(self, client, db_session, sample_guest):
+        """A guest seen within the granularity window causes no activity write"""
+        from app import Gusts, flush_guest_activity, utc_now
+
+        flush_guest_activity()
+        seen = utc_now() - timedelta(seconds=30)
+        sample_guest.last_activity = seen
+        db_session.commit()
+
+        with client.session_transaction() as sess:
+            sess['session'] = sample_guest.session
+        client.get('/about')
+
+        assert flush_guest_activity() == 0
+        db_session.refresh(sample_guest)
+        assert sample_guest.last_activity == seen
+
+    def test_stale_activity_is_buffered_then_flushed(self, client, db_session, sample_guest):
+        """Stale activity is queued in memory and written by the bulk flush"""
+        from app import flush_guest_activity, utc_now
+
+        flush_guest_activity()
+        stale = utc_now() - timedelta(hours=2)
+        sample_guest.last_activity = stale
+        db_session.commit()
+
+        with client.session_transaction() as sess:
+            sess['session'] = sample_guest.session
+        client.get('/about')
+
+        db_session.refresh(sample_guest)
+        assert sample_guest.last_activity == stale
+        assert flush_guest_activity() == 1
+        db_session.refresh(sample_guest)
+        assert sample_guest.last_activity > stale
+
+    def test_expiry_uses_buffered_activity(self, client, db_session, sample_guest):
+        """A pending buffered timestamp keeps an old stored value from expiring the session"""
+        from app import record_guest_activity, flush_guest_activity, utc_now
+
+        flush_guest_activity()
+        sample_guest.last_activity = utc_now() - timedelta(days=31)
+        db_session.commit()
+        record_guest_activity(sample_guest.id, utc_now() - timedelta(days=1))
+
+        with client.session_transaction() as sess:
+            sess['session'] = sample_guest.session
+        client.get('/about')
+
+        with client.session_transaction() as sess:
+            assert sess['session'] == sample_guest.session
+        flush_guest_activity()
+
+    def test_inactive_session_still_expires(self, client, db_session, sample_guest):
+        """30 days without activity still rotates the session"""
+        from app import flush_guest_activity, utc_now
+
+        flush_guest_activity()
+        sample_guest.last_activity = utc_now() - timedelta(days=31)
+        db_session.commit()
+
+        with client.session_transaction() as sess:
+            sess['session'] = sample_guest.session
+        client.get('/about')
+
+        with client.session_transaction() as sess:
+            assert sess['session'] != sample_guest.session
+
 class TestCartCleanup:
     """Tests for cart cleanup"""
     
@@ -67,14 +159,220 @@ class TestCartCleanup:
         )
         db_session.add(new_cart)
         db_session.commit()
+        old_id, new_id = old_cart.id, new_cart.id
 
         # Run cleanup (already inside active app context from the session fixture)
         cleanup_expired_cart_items()
         
         # Old item should be deleted
-        assert db_session.get(Cart, old_cart.id) is None
+        assert db_session.get(Cart, old_id) is None
         # New item should still exist
-        assert db_session.get(Cart, new_cart.id) is not None
+        assert db_session.get(Cart, new_id) is not None
+
+    def test_cleanup_returns_removed_count_in_batches(self, app, db_session, sample_guest, sample_product):
+        """Sweeper deletes in batches and reports how many rows it removed"""
+        from app import Cart, cleanup_expired_cart_items, utc_now
+
+        for _ in range(5):
+            item = Cart(user_id=sample_guest.id, product_id=sample_product.id, quantity=1)
+            item.created_at = utc_now() - timedelta(hours=30)
+            db_session.add(item)
+        db_session.commit()
+
+        app.config['CART_SWEEP_BATCH_SIZE'] = 2
+        try:
+            removed = cleanup_expired_cart_items()
+        finally:
+            app.config['CART_SWEEP_BATCH_SIZE'] = 500
+
+        assert removed == 5
+        assert Cart.query.count() == 0
+
+    def test_requests_do_not_purge_carts(self, client, db_session, sample_guest, sample_product):
+        """Expired items are left to the background sweeper, not the request path"""
+        from app import Cart, utc_now
+
+        old_cart = Cart(user_id=sample_guest.id, product_id=sample_product.id, quantity=1)
+        old_cart.created_at = utc_now() - timedelta(hours=25)
+        db_session.add(old_cart)
+        db_session.commit()
+
+        with client.session_transaction() as sess:
+            sess['session'] = sample_guest.session
+        client.get('/about')
+
+        assert db_session.get(Cart, old_cart.id) is not None
+
+    def test_housekeeping_counts_swept_rows(self, db_session, sample_guest, sample_product):
+        """run_housekeeping records per-sweep and cumulative removal counters"""
+        from app import Cart, run_housekeeping, housekeeping_stats, utc_now
+
+        before = housekeeping_stats()['cart_sweep']['total']
+        old_cart = Cart(user_id=sample_guest.id, product_id=sample_product.id, quantity=1)
+        old_cart.created_at = utc_now() - timedelta(hours=25)
+        db_session.add(old_cart)
+        db_session.commit()
+
+        run_housekeeping(force=True)
+
+        stats = housekeeping_stats()['cart_sweep']
+        assert stats['last_result'] == 1
+        assert stats['total'] == before + 1
+
+    def test_failed_sweep_is_reported(self, authenticated_client, db_session, monkeypatch):
+        """A sweep that raises shows up as the task's last error"""
+        import app as app_module
+
+        def broken_delete(*args, **kwargs):
+            raise RuntimeError('database is locked')
+
+        monkeypatch.setattr(app_module.Cart.query_class, 'delete', broken_delete)
+        app_module.run_housekeeping(force=True)
+
+        task = authenticated_client.get('/admin/api/metrics/housekeeping').get_json()['tasks']['cart_sweep']
+        assert task['last_error'] == 'database is locked'
+
+    def test_housekeeping_metrics_endpoint(self, authenticated_client):
+        """Admin metrics endpoint exposes the sweeper counters"""
+        response = authenticated_client.get('/admin/api/metrics/housekeeping')
+        assert response.status_code == 200
+        assert 'cart_sweep' in response.get_json()['tasks']
+
+class TestCategoryCache:
+    """Tests for the process-local category cache"""
+
+    @staticmethod
+    def _count_category_list_queries(app, fn):
+        """Count full category-list SELECTs (not per-product lazy loads)."""
+        from sqlalchemy import event
+        from app import db
+        statements = []
+
+        def record(conn, cursor, statement, params, context, executemany):
+            if 'FROM category' in statement and 'category.id = ' not in statement:
+                statements.append(statement)
+
+        event.listen(db.engine, 'before_cursor_execute', record)
+        try:
+            fn()
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', record)
+        return len(statements)
+
+    def test_steady_state_product_page_skips_category_queries(self, app, client, db_session, sample_product):
+        """Once warm, rendering a product page does not query categories"""
+        client.get(f'/{sample_product.id}')
+        queries = self._count_category_list_queries(
+            app, lambda: client.get(f'/{sample_product.id}'))
+        assert queries == 0
+
+    def test_snapshot_includes_product_count(self, db_session, sample_product):
+        """Cached entries carry a per-category product count"""
+        from app import cached_categories
+
+        snapshot = {cat.id: cat for cat in cached_categories()}
+        assert snapshot[sample_product.category_id].product_count == 1
+
+    def test_admin_add_category_invalidates(self, authenticated_client, db_session, sample_category):
+        """Adding a category from the admin is visible on the next read"""
+        from app import cached_categories
+
+        assert len(cached_categories()) == 1
+        authenticated_client.post('/admin/add_category', data={'name': 'عطور'})
+        assert {cat.name for cat in cached_categories()} == {'إلكترونيات', 'عطور'}
+
+    def test_version_bump_from_another_worker_invalidates(self, db_session, sample_category):
+        """A bumped version stamp (as written by another worker) forces a reload"""
+        from app import Category, bump_cache_version, cached_categories, category_cache
+
+        cached_categories()
+        db_session.add(Category(name='عطور'))
+        db_session.commit()
+        assert len(cached_categories()) == 1
+
+        bump_cache_version(category_cache.name)
+        assert len(cached_categories()) == 2
+
+class TestShippingQuotes:
+    """Shipping prices come from the process-local rate table"""
+
+    @pytest.fixture
+    def rates(self, db_session):
+        from app import City, ShippingCost, seed_default_promotions
+        db_session.add_all([
+            City(name='القاهره', city_id='cai'),
+            City(name='أسوان', city_id='asw'),
+            ShippingCost(city_id='cai', price=40.0),
+            ShippingCost(city_id='cai', price=99.0),
+            ShippingCost(city_id='asw', price=90.0),
+        ])
+        db_session.commit()
+        seed_default_promotions()
+
+    @staticmethod
+    def _cart(*product_ids):
+        from types import SimpleNamespace
+        return [SimpleNamespace(product_id=product_id) for product_id in product_ids]
+
+    def test_rate_and_quote_many(self, rates):
+        """The first rate row of a city wins; unknown cities use the default"""
+        from app import shipping_quotes
+
+        assert shipping_quotes.rate('cai') == 40.0
+        assert shipping_quotes.rate('nowhere') is None
+        assert shipping_quotes.quote_many(['cai', 'asw', 'nowhere', 'cai']) == {
+            'cai': 40.0, 'asw': 90.0, 'nowhere': 0.0}
+
+    def test_quote_applies_free_shipping_combo(self, rates):
+        from app import shipping_quotes
+
+        plain = shipping_quotes.quote('asw', self._cart(1))
+        assert (plain.base_price, plain.price, plain.offer) == (90.0, 90.0, None)
+
+        combo = shipping_quotes.quote('asw', self._cart(1, 2, 3))
+        assert combo.price == 0
+        assert combo.discount == 90.0
+        assert combo.offer == 'combo_1_2_3'
+
+    def test_quote_without_rate(self, rates):
+        from app import shipping_quotes
+
+        assert shipping_quotes.quote('nowhere') is None
+        assert shipping_quotes.quote('nowhere', default=80).price == 80
+
+    def test_warm_lookups_skip_the_database(self, app, rates):
+        """Pricing many orders costs no queries once the table is loaded"""
+        from sqlalchemy import event
+        from app import db, shipping_quotes
+        statements = []
+
+        def record(conn, cursor, statement, params, context, executemany):
+            statements.append(statement)
+
+        shipping_quotes.quote('cai', self._cart(4))
+        event.listen(db.engine, 'before_cursor_execute', record)
+        try:
+            shipping_quotes.quote_many(['cai', 'asw'] * 500)
+            shipping_quotes.quote('cai', self._cart(4))
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', record)
+        assert statements == []
+
+    def test_shipping_cost_endpoint(self, client, rates, db_session):
+        from app import City
+        db_session.add(City(name='الغردقه', city_id='hrg'))
+        db_session.commit()
+
+        assert client.get('/get_shipping_cost/nowhere').status_code == 404
+        assert client.get('/get_shipping_cost/cai').get_json()['shipping_cost'] == 40.0
+        assert client.get('/get_shipping_cost/hrg').get_json()['standard_cost'] == 80
+
+    def test_admin_price_change_is_picked_up(self, authenticated_client, rates):
+        from app import shipping_quotes
+
+        assert shipping_quotes.rate('asw') == 90.0
+        authenticated_client.post('/admin/update_shipping_cost', data={'city_id': 'asw', 'price': '70'})
+        assert shipping_quotes.rate('asw') == 70.0
 
 class TestCSRF:
     """Tests for CSRF protection"""